@@ -0,0 +1,242 @@
+import json
+import os
+import time
+from dataclasses import dataclass
+from google.api_core import exceptions as google_exceptions
+from models import DataItem
+from ocr_backends import BackendConfigError, BackendResponse, OcrBackend
+from rate_limiter import TokenBucket, is_throttling_error, DEFAULT_REQUESTS_PER_MIN, DEFAULT_TOKENS_PER_MIN
+
+APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+API_KEYS_FILE = os.path.join(APP_BASE_DIR, "api_keys.json")
+API_KEYS_ENV = "GEMINI_API_KEYS" # カンマ区切り。各要素は「キー」または「名前=キー」
+
+HEALTH_SMOOTHING = 0.2 # 健全性スコアの指数移動平均で、直近の1回の結果に与える重み
+MIN_HEALTH = 0.3 # これを下回ったキーは、他に健全なキーがある間は使わない（最後の失敗から休止時間が経つまで）
+THROTTLE_COOLDOWN_SECONDS = 30.0 # 429を受けたキーを割り当てから外す時間
+
+
+@dataclass
+class ApiKeyConfig:
+    """
+    APIキー1件分の設定です。api_keys.json の例:
+    [{"name": "main", "key": "AIza...", "requests_per_min": 60, "tokens_per_min": 1000000}, "AIza..."]
+    """
+    name: str
+    key: str
+    requests_per_min: int = DEFAULT_REQUESTS_PER_MIN
+    tokens_per_min: int = DEFAULT_TOKENS_PER_MIN
+
+
+def mask_key(key: str) -> str:
+    """画面やログに出すため、キーの末尾4文字以外を伏せます。"""
+    return f"…{key[-4:]}" if len(key) > 4 else "…"
+
+
+def load_api_keys(path: str = API_KEYS_FILE, environ=None) -> list[ApiKeyConfig]:
+    """
+    環境変数 GEMINI_API_KEYS と設定ファイル(api_keys.json)からAPIキーを読み込みます。
+    同じキーが両方にある場合は環境変数の設定を使います。ファイルの形式が不正な場合はその旨を表示して無視します。
+    """
+    environ = os.environ if environ is None else environ
+    configs = []
+    for index, entry in enumerate(filter(None, (e.strip() for e in environ.get(API_KEYS_ENV, "").split(","))), start=1):
+        name, _, key = entry.rpartition("=")
+        configs.append(ApiKeyConfig(name.strip() or f"env{index}", key.strip()))
+
+    if path and os.path.exists(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+            for index, entry in enumerate(entries, start=1):
+                if isinstance(entry, str):
+                    configs.append(ApiKeyConfig(f"key{index}", entry))
+                else:
+                    configs.append(ApiKeyConfig(
+                        str(entry.get("name") or f"key{index}"),
+                        str(entry["key"]),
+                        int(entry.get("requests_per_min", DEFAULT_REQUESTS_PER_MIN)),
+                        int(entry.get("tokens_per_min", DEFAULT_TOKENS_PER_MIN)),
+                    ))
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            print(f"APIキーの設定ファイルを読み込めませんでした ({path}): {e}")
+
+    unique = {}
+    for config in configs:
+        if config.key and config.key not in unique:
+            unique[config.key] = config
+    return list(unique.values())
+
+
+def is_key_error(exc: Exception) -> bool:
+    """キー自体が使えない（無効・権限なし）エラーかどうかを判定します。再試行しても解決しません。"""
+    if isinstance(exc, (google_exceptions.PermissionDenied, google_exceptions.Unauthenticated)):
+        return True
+    return isinstance(exc, google_exceptions.InvalidArgument) and "API key" in str(exc)
+
+
+class ApiKeyState:
+    """キー1件分のバックエンド（専用のクライアント）・レート制限・健全性スコア・統計です。"""
+
+    def __init__(self, config: ApiKeyConfig, backend: OcrBackend):
+        self.config = config
+        self.backend = backend
+        self.request_bucket = TokenBucket(config.requests_per_min)
+        self.token_bucket = TokenBucket(config.tokens_per_min)
+        self.in_flight = 0 # レート制限の待ちを含めて、このキーに割り当てた実行中の呼び出し数
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self.tokens = 0
+        self.latency_seconds = 0.0
+        self.health = 1.0 # 成功を1、失敗を0とした指数移動平均
+        self.cooldown_until = 0.0
+        self.last_failure_at = 0.0
+        self.disabled_reason = None
+        self.first_call_at = None
+
+    @property
+    def available(self) -> bool:
+        return self.disabled_reason is None and time.monotonic() >= self.cooldown_until
+
+    @property
+    def healthy(self) -> bool:
+        # 健全性が低くても、最後の失敗から時間が経てば試しに割り当てる（成功すればスコアが回復する）
+        return self.health >= MIN_HEALTH or time.monotonic() - self.last_failure_at >= THROTTLE_COOLDOWN_SECONDS
+
+    @property
+    def load(self) -> float:
+        """割り当ての負荷です。1分あたりの上限と健全性に対する、実行中の呼び出し数の比で表します。"""
+        return (self.in_flight + 1) / (self.config.requests_per_min * max(self.health, 0.05))
+
+    @property
+    def calls_per_min(self) -> float:
+        if self.first_call_at is None:
+            return 0.0
+        return self.calls * 60.0 / max(time.monotonic() - self.first_call_at, 1.0)
+
+    def record_success(self, latency: float, tokens: int):
+        self.health += HEALTH_SMOOTHING * (1.0 - self.health)
+        self.latency_seconds += latency
+        self.tokens += tokens
+
+    def record_failure(self, exc: Exception):
+        self.errors += 1
+        self.health -= HEALTH_SMOOTHING * self.health
+        self.last_failure_at = time.monotonic()
+        if is_throttling_error(exc):
+            self.throttled += 1
+            self.cooldown_until = time.monotonic() + THROTTLE_COOLDOWN_SECONDS
+        elif is_key_error(exc):
+            self.disabled_reason = str(exc)
+
+    def summary_text(self) -> str:
+        if self.disabled_reason:
+            state = "無効"
+        elif time.monotonic() < self.cooldown_until:
+            state = f"休止中 ({self.cooldown_until - time.monotonic():.0f}秒)"
+        else:
+            state = "正常"
+        mean_latency = self.latency_seconds / (self.calls - self.errors) if self.calls > self.errors else 0.0
+        return (
+            f"{self.config.name} ({mask_key(self.config.key)}): {state} | 健全性 {self.health:.2f} | 実行中 {self.in_flight}"
+            f" | 呼び出し {self.calls} 回 ({self.calls_per_min:.1f} 回/分) | エラー {self.errors} 回 (429 {self.throttled} 回)"
+            f" | 平均 {mean_latency:.2f}秒 | トークン {self.tokens:,}"
+        )
+
+
+class ApiKeyPool:
+    """
+    複数のAPIキーに呼び出しを振り分けます。キーごとに専用のクライアントとレート制限を持つため、
+    1つのキーのクォータに縛られず、キーを切り替えるためにグローバルな設定を書き換えることもありません。
+    呼び出しは、使えるキーのうち負荷(ApiKeyState.load)が最も小さいものに割り当てます。
+    429を受けたキーはしばらく外し、無効なキーはこのプールでは以後使いません。
+    """
+
+    def __init__(self, configs: list[ApiKeyConfig], backend_factory, previous: "ApiKeyPool | None" = None):
+        """previous を渡すと、設定が同じキーはその状態（健全性・休止・統計など）を引き継ぎます。"""
+        previous_states = {state.config.key: state for state in previous.keys} if previous is not None else {}
+        self.keys = []
+        for config in configs:
+            state = previous_states.get(config.key)
+            self.keys.append(state if state is not None and state.config == config else ApiKeyState(config, backend_factory(config)))
+
+    @property
+    def requests_per_min(self) -> int:
+        return sum(key.config.requests_per_min for key in self.keys)
+
+    @property
+    def tokens_per_min(self) -> int:
+        return sum(key.config.tokens_per_min for key in self.keys)
+
+    def select(self) -> ApiKeyState:
+        enabled = [key for key in self.keys if key.disabled_reason is None]
+        if not enabled:
+            raise BackendConfigError("使用できるAPIキーがありません。APIキーの設定を確認してください。")
+        available = [key for key in enabled if key.available]
+        healthy = [key for key in available if key.healthy]
+        if healthy or available:
+            return min(healthy or available, key=lambda key: key.load)
+        return min(enabled, key=lambda key: key.cooldown_until) # すべて休止中なら最も早く戻るキー
+
+    async def call(self, request, estimated_tokens: int):
+        """
+        request(バックエンド) が返すコルーチンを、選んだキーのレート制限の下で実行します。
+        失敗はキーの健全性に反映したうえでそのまま送出します（再試行は呼び出し元の GeminiThrottle が行い、別のキーが選ばれ得ます）。
+        """
+        key = self.select()
+        key.in_flight += 1
+        try:
+            await key.request_bucket.acquire(1)
+            await key.token_bucket.acquire(estimated_tokens)
+            if key.first_call_at is None:
+                key.first_call_at = time.monotonic()
+            key.calls += 1
+            started_at = time.monotonic()
+            try:
+                response = await request(key.backend)
+            except Exception as e:
+                key.record_failure(e)
+                raise
+            usage = getattr(response, "usage_metadata", None)
+            actual_tokens = getattr(usage, "total_token_count", None) if usage else None
+            key.record_success(time.monotonic() - started_at, actual_tokens or 0)
+            if actual_tokens:
+                key.token_bucket.adjust(actual_tokens - estimated_tokens)
+            return response
+        finally:
+            key.in_flight -= 1
+
+    def summary_lines(self) -> list[str]:
+        return [key.summary_text() for key in self.keys]
+
+
+class PooledBackend:
+    """ApiKeyPool のキーに呼び出しを振り分けるバックエンドです（OcrBackend と同じインターフェース）。"""
+
+    def __init__(self, pool: ApiKeyPool, model_name: str):
+        self.pool = pool
+        self.model_name = model_name
+
+    def estimate_tokens(self, image_count: int, data_items: list[DataItem]) -> int:
+        return self.pool.keys[0].backend.estimate_tokens(image_count, data_items)
+
+    async def extract_fields(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict,
+                             prompt_hint: str = "") -> BackendResponse:
+        return await self.pool.call(
+            lambda backend: backend.extract_fields(image_parts, data_items, response_schema, prompt_hint),
+            self.estimate_tokens(len(image_parts), data_items),
+        )
+
+    async def extract_fields_packed(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict) -> BackendResponse:
+        return await self.pool.call(
+            lambda backend: backend.extract_fields_packed(image_parts, data_items, response_schema),
+            self.estimate_tokens(len(image_parts), data_items),
+        )
+
+    async def extract_fields_stream(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict,
+                                    on_text, prompt_hint: str = "") -> BackendResponse:
+        return await self.pool.call(
+            lambda backend: backend.extract_fields_stream(image_parts, data_items, response_schema, on_text, prompt_hint),
+            self.estimate_tokens(len(image_parts), data_items),
+        )
@@ -0,0 +1,388 @@
+"""
+アップロードしたファイルの実体を、内容のSHA-256をキーにして images/blobs/ab/cd/<sha256>.<ext> に保存します。
+同じ内容のファイルを複数のリストに追加しても実体は1つで、参照数を blobs テーブル(models.Blob)で管理します。
+参照数が0になった実体はGC(collect_garbage)で削除します。
+
+images/<リストID>/ に保存していた以前のファイルは migrate_legacy_files で一度だけ移行します。
+移行・GC・容量の集計はコマンドラインからも実行できます:
+    python blob_store.py --migrate --gc --report
+"""
+import argparse
+import datetime
+import errno
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from sqlalchemy import func, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import create_db_and_tables, get_db, Blob, UploadedFile
+from scan_cache import compute_file_sha256
+
+APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+UPLOAD_DIR_NAME = "images"
+BLOB_DIR_NAME = "blobs"
+BLOB_BASE_DIR = os.path.join(APP_BASE_DIR, UPLOAD_DIR_NAME, BLOB_DIR_NAME)
+MIGRATION_CHUNK_SIZE = 200 # 移行をコミットする件数
+# 移行を終えた印。アップロードは最初から実体に保存するため、一度移行すれば以後の起動では移行元を調べない
+# （実体のディレクトリに置くと、DBにない実体ファイルとして削除されるため images/ に置く）
+MIGRATION_MARKER_PATH = os.path.join(APP_BASE_DIR, UPLOAD_DIR_NAME, ".legacy_migrated")
+ORPHAN_GRACE_SECONDS = 3600 # DBに行のない実体ファイルを削除するまでの猶予（取り込み途中のファイルを消さないように）
+
+PLACE_COPY_RANGE = "copy_file_range" # カーネル内で複製する（Btrfs・XFS などではデータを複製せずに共有する reflink になる）
+PLACE_COPY = "copy"
+PLACE_DEDUP = "dedup" # 同じ内容の実体が既にあったため置かなかった
+PLACE_LABELS = {PLACE_COPY_RANGE: "高速複製", PLACE_COPY: "複製", PLACE_DEDUP: "重複"}
+
+# copy_file_range に対応していない（別のファイルシステム・古いカーネルなど）ため、通常の複製を試せばよいエラー
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL}
+
+# 実体を置いたがDBにまだ参照を追加していない SHA-256 -> 件数。GCはこれらを削除しない
+_pending_lock = threading.Lock()
+_pending = Counter()
+
+
+@dataclass
+class StoredBlob:
+    sha256: str
+    path: str # 相対パス (images/blobs/ab/cd/<sha256>.<ext>)
+    size_bytes: int
+    method: str # PLACE_*
+
+
+def blob_dir(sha256: str) -> str:
+    """実体を置くディレクトリです。1つのディレクトリのファイル数が増えすぎないよう、先頭4文字で2段に分けます。"""
+    return os.path.join(BLOB_BASE_DIR, sha256[:2], sha256[2:4])
+
+
+def blob_relative_path(sha256: str, ext: str) -> str:
+    return f"{UPLOAD_DIR_NAME}/{BLOB_DIR_NAME}/{sha256[:2]}/{sha256[2:4]}/{sha256}{ext}"
+
+
+def _find_blob(sha256: str) -> str | None:
+    """同じ内容の実体の相対パスです（拡張子は最初に保存したファイルのもの）。"""
+    directory = blob_dir(sha256)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return None
+    name = next((name for name in names if os.path.splitext(name)[0] == sha256), None)
+    return blob_relative_path(sha256, os.path.splitext(name)[1]) if name else None
+
+
+def _copy_file_range(source_path: str, destination_path: str):
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        remaining = os.fstat(source.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(source.fileno(), destination.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+
+def place_file(source_path: str, destination_path: str) -> str:
+    """
+    source_path を destination_path に複製し、使った方法(PLACE_*)を返します。
+    copy_file_range を試し、使えなければ通常の複製を行います。
+    元のファイルへのハードリンクは使いません（元のファイルを上書きすると、共有している実体の内容が変わってしまうため）。
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            _copy_file_range(source_path, destination_path)
+            return PLACE_COPY_RANGE
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+    shutil.copyfile(source_path, destination_path)
+    return PLACE_COPY
+
+
+def _reserve(sha256: str):
+    with _pending_lock:
+        _pending[sha256] += 1
+
+
+def release_pending(blobs: list[StoredBlob]):
+    """store_file で置いた実体を、GCの対象に戻します（DBに参照を追加した後、または追加に失敗した後に呼びます）。"""
+    with _pending_lock:
+        for blob in blobs:
+            _pending[blob.sha256] -= 1
+            if _pending[blob.sha256] <= 0:
+                del _pending[blob.sha256]
+
+
+def store_file(source_path: str, ext: str) -> StoredBlob:
+    """
+    source_path の内容を実体として置きます。同じ内容の実体が既にあれば複製しません。スレッドプールから呼べます。
+    呼び出し側は add_references でDBに参照を追加した後、release_pending を呼んでください。
+    """
+    sha256 = compute_file_sha256(source_path)
+    _reserve(sha256)
+    try:
+        existing = _find_blob(sha256)
+        if existing is not None:
+            return StoredBlob(sha256, existing, os.path.getsize(os.path.join(APP_BASE_DIR, existing)), PLACE_DEDUP)
+        directory = blob_dir(sha256)
+        os.makedirs(directory, exist_ok=True)
+        relative_path = blob_relative_path(sha256, ext)
+        # 書き込み途中のファイルを実体として見せないよう、一時ファイルに複製してから名前を変える
+        temp_path = os.path.join(directory, f".{sha256}.{uuid.uuid4().hex}.tmp")
+        try:
+            method = place_file(source_path, temp_path)
+            os.replace(temp_path, os.path.join(APP_BASE_DIR, relative_path))
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return StoredBlob(sha256, relative_path, os.path.getsize(os.path.join(APP_BASE_DIR, relative_path)), method)
+    except Exception:
+        release_pending([StoredBlob(sha256, "", 0, "")])
+        raise
+
+
+def add_references(db, blobs: list[StoredBlob]):
+    """実体の参照数を増やします（blobs に行がなければ作成します）。コミットは呼び出し側で行います。"""
+    counts = Counter(blob.sha256 for blob in blobs)
+    first = {}
+    for blob in blobs:
+        first.setdefault(blob.sha256, blob)
+    now = datetime.datetime.now()
+    for sha256, count in counts.items():
+        blob = first[sha256]
+        statement = sqlite_insert(Blob).values(sha256=sha256, path=blob.path, size_bytes=blob.size_bytes, ref_count=count, created_at=now)
+        db.execute(statement.on_conflict_do_update(index_elements=[Blob.sha256], set_={"ref_count": Blob.ref_count + count}))
+
+
+def release_references(db, sha256s: list[str | None]):
+    """削除するファイルの実体の参照数を減らします（移行前のファイルの None は無視します）。コミットは呼び出し側で行います。"""
+    for sha256, count in Counter(sha256 for sha256 in sha256s if sha256).items():
+        db.execute(update(Blob).where(Blob.sha256 == sha256).values(ref_count=func.max(Blob.ref_count - count, 0)))
+
+
+def _remove_empty_dirs(directories):
+    for directory in sorted(set(directories), key=len, reverse=True):
+        try:
+            if os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+        except OSError as e:
+            print(f"空のディレクトリを削除できませんでした ({directory}): {e}")
+
+
+@dataclass
+class GcResult:
+    blobs_removed: int = 0
+    bytes_freed: int = 0
+    orphans_removed: int = 0
+    recounted: int = 0 # 参照数を数え直して修正した実体の数
+
+    def summary_text(self) -> str:
+        text = f"GC: 実体 {self.blobs_removed} 件を削除 ({self.bytes_freed / 1024 / 1024:.1f}MB)"
+        if self.orphans_removed:
+            text += f" | DBにない実体 {self.orphans_removed} 件を削除"
+        if self.recounted:
+            text += f" | 参照数を修正 {self.recounted} 件"
+        return text
+
+
+def collect_garbage(db) -> GcResult:
+    """参照数が0の実体を、取り込み中のものを除いて削除します。"""
+    result = GcResult()
+    directories = []
+    with _pending_lock:
+        for blob in db.query(Blob).filter(Blob.ref_count <= 0).all():
+            if blob.sha256 in _pending:
+                continue
+            physical_path = os.path.join(APP_BASE_DIR, blob.path)
+            try:
+                if os.path.exists(physical_path):
+                    os.remove(physical_path)
+            except OSError as e:
+                print(f"実体を削除できませんでした ({blob.path}): {e}")
+                continue
+            directories.append(os.path.dirname(physical_path))
+            result.blobs_removed += 1
+            result.bytes_freed += blob.size_bytes
+            db.delete(blob)
+        db.commit()
+    _remove_empty_dirs(directories + [os.path.dirname(directory) for directory in directories])
+    return result
+
+
+def verify_and_collect(db) -> GcResult:
+    """
+    参照数を uploaded_files から数え直してからGCを行い、DBに行のない実体ファイル（取り込みの途中で失敗したもの）も削除します。
+    すべての実体を調べるため、コマンドラインからの保守に使います。
+    """
+    actual = dict(db.query(UploadedFile.blob_sha256, func.count(UploadedFile.id))
+                  .filter(UploadedFile.blob_sha256 != None).group_by(UploadedFile.blob_sha256).all())
+    recounted = 0
+    known = set()
+    for blob in db.query(Blob).all():
+        known.add(blob.sha256)
+        if blob.ref_count != actual.get(blob.sha256, 0):
+            blob.ref_count = actual.get(blob.sha256, 0)
+            recounted += 1
+    db.commit()
+    result = collect_garbage(db)
+    result.recounted = recounted
+
+    now = time.time()
+    directories = []
+    with _pending_lock:
+        for root, _, names in os.walk(BLOB_BASE_DIR):
+            for name in names:
+                sha256 = name.lstrip(".").split(".")[0]
+                path = os.path.join(root, name)
+                if sha256 in known or sha256 in _pending or now - os.path.getmtime(path) < ORPHAN_GRACE_SECONDS:
+                    continue
+                os.remove(path)
+                directories.append(root)
+                result.orphans_removed += 1
+    _remove_empty_dirs(directories)
+    return result
+
+
+@dataclass
+class StorageReport:
+    files: int = 0
+    logical_bytes: int = 0 # ファイルごとに保存した場合の合計
+    blobs: int = 0
+    stored_bytes: int = 0 # 参照されている実体の合計
+    unreferenced_blobs: int = 0
+    unreferenced_bytes: int = 0
+    legacy_files: int = 0 # 移行前（images/<リストID>/）のファイル
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.logical_bytes - self.stored_bytes
+
+    def summary_text(self) -> str:
+        saved_ratio = self.saved_bytes / self.logical_bytes if self.logical_bytes else 0.0
+        text = (
+            f"保存容量: ファイル {self.files} 件 {self.logical_bytes / 1024 / 1024:.1f}MB"
+            f" → 実体 {self.blobs} 件 {self.stored_bytes / 1024 / 1024:.1f}MB"
+            f" (重複の排除で {self.saved_bytes / 1024 / 1024:.1f}MB 削減, {saved_ratio:.1%})"
+        )
+        if self.unreferenced_blobs:
+            text += f" | 未参照 {self.unreferenced_blobs} 件 {self.unreferenced_bytes / 1024 / 1024:.1f}MB"
+        if self.legacy_files:
+            text += f" | 未移行 {self.legacy_files} 件"
+        return text
+
+
+def storage_report(db) -> StorageReport:
+    report = StorageReport()
+    report.files, report.logical_bytes = db.query(func.count(UploadedFile.id), func.coalesce(func.sum(Blob.size_bytes), 0)) \
+        .join(Blob, Blob.sha256 == UploadedFile.blob_sha256).one()
+    report.blobs, report.stored_bytes = db.query(func.count(Blob.sha256), func.coalesce(func.sum(Blob.size_bytes), 0)) \
+        .filter(Blob.ref_count > 0).one()
+    report.unreferenced_blobs, report.unreferenced_bytes = db.query(func.count(Blob.sha256), func.coalesce(func.sum(Blob.size_bytes), 0)) \
+        .filter(Blob.ref_count <= 0).one()
+    report.legacy_files = db.query(func.count(UploadedFile.id)).filter(UploadedFile.blob_sha256 == None).scalar()
+    return report
+
+
+@dataclass
+class MigrationResult:
+    files: int = 0
+    blobs_created: int = 0
+    duplicates: int = 0 # 既にある実体と同じ内容だったファイル
+    bytes_freed: int = 0
+    missing: int = 0 # ファイルが見つからず移行できなかったもの
+    skipped: bool = False # 移行済みの印があったため何もしなかった
+
+    def summary_text(self) -> str:
+        text = (
+            f"実体への移行: {self.files} 件 (新しい実体 {self.blobs_created} 件, 重複 {self.duplicates} 件,"
+            f" {self.bytes_freed / 1024 / 1024:.1f}MB 削減)"
+        )
+        return text + (f" | 見つからないファイル {self.missing} 件" if self.missing else "")
+
+
+def _link_or_copy(source_path: str, destination_path: str):
+    # 移行元はアプリが保存したファイルのため、ハードリンクで複製せずに移す（移行元はコミット後に削除する）
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        place_file(source_path, destination_path)
+
+
+def migrate_legacy_files(db_context=get_db, force: bool = False) -> MigrationResult:
+    """
+    images/<リストID>/<uuid>.<ext> に保存していたファイルを実体に移し、UploadedFile.filepath を書き換えます。
+    MIGRATION_CHUNK_SIZE 件ずつコミットし、コミットした後で元のファイルを削除するため、途中で止まっても再実行で続きから移行できます。
+    最後まで終えたら MIGRATION_MARKER_PATH を作成し、以後は force を指定しない限り何もしません。
+    """
+    if not force and os.path.exists(MIGRATION_MARKER_PATH):
+        return MigrationResult(skipped=True)
+    result = MigrationResult()
+    db = next(db_context())
+    try:
+        last_id = 0
+        while True:
+            files = db.query(UploadedFile).filter(UploadedFile.blob_sha256 == None, UploadedFile.id > last_id) \
+                .order_by(UploadedFile.id).limit(MIGRATION_CHUNK_SIZE).all()
+            if not files:
+                break
+            last_id = files[-1].id
+            stored, to_remove = [], []
+            for file_obj in files:
+                source_path = os.path.join(APP_BASE_DIR, file_obj.filepath)
+                if not os.path.exists(source_path):
+                    continue
+                sha256 = compute_file_sha256(source_path)
+                size = os.path.getsize(source_path)
+                existing = _find_blob(sha256)
+                if existing is None:
+                    os.makedirs(blob_dir(sha256), exist_ok=True)
+                    existing = blob_relative_path(sha256, os.path.splitext(file_obj.filepath)[1].lower())
+                    _link_or_copy(source_path, os.path.join(APP_BASE_DIR, existing))
+                    result.blobs_created += 1
+                else:
+                    result.duplicates += 1
+                    result.bytes_freed += size
+                stored.append(StoredBlob(sha256, existing, size, PLACE_DEDUP))
+                to_remove.append(source_path)
+                file_obj.filepath = existing
+                file_obj.blob_sha256 = sha256
+            add_references(db, stored)
+            db.commit()
+            result.files += len(stored)
+            for path in to_remove:
+                os.remove(path)
+            _remove_empty_dirs(os.path.dirname(path) for path in to_remove)
+        result.missing = db.query(func.count(UploadedFile.id)).filter(UploadedFile.blob_sha256 == None).scalar()
+    finally:
+        db.close()
+    # 見つからなかったファイルは再実行しても移行できないため、印を付けて次回から調べない（--migrate で再実行できる）
+    os.makedirs(os.path.dirname(MIGRATION_MARKER_PATH), exist_ok=True)
+    with open(MIGRATION_MARKER_PATH, "w", encoding="utf-8") as f:
+        f.write(f"{datetime.datetime.now().isoformat(timespec='seconds')} {result.summary_text()}\n")
+    return result
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="アップロードしたファイルの実体の移行・GC・容量の集計")
+    parser.add_argument("--migrate", action="store_true", help="images/<リストID>/ のファイルを実体に移行する")
+    parser.add_argument("--gc", action="store_true", help="参照数を数え直し、参照されていない実体とDBにない実体ファイルを削除する")
+    parser.add_argument("--report", action="store_true", help="重複の排除による容量の削減を表示する（既定）")
+    args = parser.parse_args(argv)
+    create_db_and_tables()
+    if args.migrate:
+        print(migrate_legacy_files(force=True).summary_text())
+    db = next(get_db())
+    try:
+        if args.gc:
+            print(verify_and_collect(db).summary_text())
+        if args.report or not (args.migrate or args.gc):
+            print(storage_report(db).summary_text())
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,125 @@
+import re
+from models import DataItem
+from scan_calls import call_cost_usd
+
+VALUE_TYPE_TEXT = "text" # 型の確認をしない
+VALUE_TYPE_NUMBER = "number"
+VALUE_TYPE_DATE = "date"
+VALUE_TYPE_LABELS = {VALUE_TYPE_TEXT: "型指定なし", VALUE_TYPE_NUMBER: "数値", VALUE_TYPE_DATE: "日付"}
+
+FAIL_MISSING = "missing" # 値が読み取れなかった
+FAIL_TYPE = "type" # 数値・日付として解釈できない
+FAIL_PATTERN = "pattern" # 項目に設定した正規表現に一致しない
+FAIL_REASON_LABELS = {FAIL_MISSING: "欠落", FAIL_TYPE: "型", FAIL_PATTERN: "形式"}
+
+# 金額などの表記ゆれ（通貨記号・桁区切り・全角数字・単位）を許容する
+_NUMBER_RE = re.compile(r"^[+\-−]?\s*[¥￥$€£]?\s*[0-9０-９][0-9０-９,，]*([.．][0-9０-９]+)?\s*(円|%|％)?$")
+_DATE_RES = [
+    re.compile(r"^\d{4}[-/.]\d{1,2}[-/.]\d{1,2}$"),
+    re.compile(r"^\d{4}年\s*\d{1,2}月\s*\d{1,2}日$"),
+    re.compile(r"^(令和|平成|昭和|R|H|S)\s*(\d{1,2}|元)\s*[年.]\s*\d{1,2}\s*[月.]\s*\d{1,2}\s*日?$"),
+]
+
+
+def check_value(item: DataItem, value: str | None) -> str | None:
+    """抽出した値がデータ項目の型・正規表現に合うかを確認し、合わなければ理由(FAIL_*)を返します。"""
+    if value is None or not str(value).strip():
+        return FAIL_MISSING
+    value = str(value).strip()
+    value_type = item.value_type or VALUE_TYPE_TEXT
+    if value_type == VALUE_TYPE_NUMBER and not _NUMBER_RE.match(value):
+        return FAIL_TYPE
+    if value_type == VALUE_TYPE_DATE and not any(pattern.match(value) for pattern in _DATE_RES):
+        return FAIL_TYPE
+    if item.pattern:
+        try:
+            if not re.fullmatch(item.pattern, value):
+                return FAIL_PATTERN
+        except re.error:
+            print(f"警告: 項目「{item.name}」の正規表現が不正なため確認をスキップします: {item.pattern}")
+    return None
+
+
+def failing_items(data_items: list[DataItem], extracted: dict) -> list[tuple[DataItem, str]]:
+    """確認に失敗した (データ項目, 理由) のリストです。"""
+    failures = []
+    for item in data_items:
+        reason = check_value(item, extracted.get(item.name))
+        if reason is not None:
+            failures.append((item, reason))
+    return failures
+
+
+class CascadeStats:
+    """
+    安価なモデルから順に試すカスケードの、上位モデルへ回した割合と、
+    常に最上位のモデルで全項目を抽出した場合と比べた費用・所要時間を集計します。
+    最上位のモデルの費用は、最初の段の呼び出しと同じトークン数を最上位のモデルの単価で見積もります。
+    所要時間は、最上位のモデルの呼び出しで実際にかかった平均を1ファイルあたりの所要時間とみなします。
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.escalated_files = 0
+        self.fields = 0
+        self.escalated_fields = 0
+        self.unresolved_fields = 0 # 最後の段でも確認に失敗した項目数（値は null または確認に失敗した最後の段の値）
+        self.reasons = {} # 理由 -> 上位モデルへ回した項目数
+        self.calls_by_model = {}
+        self.cost_usd = 0.0
+        self.latency_seconds = 0.0
+        self.baseline_cost_usd = 0.0
+        self.strong_calls = 0
+        self.strong_latency_seconds = 0.0
+
+    def record(self, field_count: int, escalations: list[tuple[DataItem, str]], calls: list[tuple[str, float, object]], strong_model: str,
+               unresolved: list[tuple[DataItem, str]] | None = None):
+        """
+        1件分（ファイル・PDFの1ページ）の結果を加えます。
+        escalations は最初の段で確認に失敗した項目、calls は (モデル名, 所要時間, usage_metadata) のリスト、
+        unresolved は最後の段でも確認に失敗した項目です。
+        """
+        self.files += 1
+        self.fields += field_count
+        self.unresolved_fields += len(unresolved or [])
+        if escalations:
+            self.escalated_files += 1
+            self.escalated_fields += len(escalations)
+            for _, reason in escalations:
+                self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        for index, (model_name, latency, usage) in enumerate(calls):
+            prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+            candidates_tokens = getattr(usage, "candidates_token_count", 0) or 0
+            self.calls_by_model[model_name] = self.calls_by_model.get(model_name, 0) + 1
+            self.cost_usd += call_cost_usd(model_name, prompt_tokens, candidates_tokens)
+            self.latency_seconds += latency
+            if index == 0:
+                self.baseline_cost_usd += call_cost_usd(strong_model, prompt_tokens, candidates_tokens)
+            if model_name == strong_model:
+                self.strong_calls += 1
+                self.strong_latency_seconds += latency
+
+    @property
+    def escalation_rate(self) -> float:
+        return self.escalated_files / self.files if self.files else 0.0
+
+    @property
+    def baseline_latency_seconds(self) -> float | None:
+        if not self.strong_calls:
+            return None
+        return self.strong_latency_seconds / self.strong_calls * self.files
+
+    def summary_text(self) -> str:
+        if not self.files:
+            return "カスケード: まだ実行していません"
+        reasons = ", ".join(f"{FAIL_REASON_LABELS.get(reason, reason)} {count}" for reason, count in sorted(self.reasons.items()))
+        text = (
+            f"カスケード: 上位モデルへ {self.escalated_files}/{self.files} 件 ({self.escalation_rate:.1%})"
+            f" | 項目 {self.escalated_fields}/{self.fields}" + (f" ({reasons})" if reasons else "")
+            + (f" | 上位モデルでも失敗 {self.unresolved_fields} 項目" if self.unresolved_fields else "")
+            + f" | 費用 ${self.cost_usd:.4f} (上位モデルのみ ${self.baseline_cost_usd:.4f}, 差 ${self.baseline_cost_usd - self.cost_usd:.4f})"
+        )
+        baseline_latency = self.baseline_latency_seconds
+        if baseline_latency is not None:
+            text += f" | API所要時間 {self.latency_seconds:.1f}秒 (上位モデルのみ 約{baseline_latency:.1f}秒)"
+        return text
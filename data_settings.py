@@ -1,7 +1,13 @@
+import re
 import flet as ft
 # import time # No longer needed for the error display
 from models import get_db, Condition, DataItem # Import database functions and models
 from sqlalchemy.orm import joinedload
+from roi import ROI_LAYOUT_COLLAGE, ROI_LAYOUT_TILES, parse_roi, format_roi
+from cascade import VALUE_TYPE_LABELS, VALUE_TYPE_TEXT
+
+ROI_HINT_TEXT = "領域 x0,y0,x1,y1（0〜1の割合）"
+PATTERN_HINT_TEXT = "形式（正規表現・任意）"
 
 class DataSettingsScreen:
     def __init__(self, page: ft.Page):
@@ -19,6 +25,24 @@ class DataSettingsScreen:
             bgcolor=ft.Colors.WHITE,
             expand=True # Row内でスペースを適切に使うため
         )
+        # 条件全体の読み取り領域（データ項目に領域がない場合に使用）。空欄ならページ全体を送信します。
+        self.condition_roi_field = ft.TextField(
+            hint_text=ROI_HINT_TEXT + "、空欄でページ全体",
+            border=ft.InputBorder.OUTLINE,
+            border_radius=5,
+            bgcolor=ft.Colors.WHITE,
+            expand=True
+        )
+        self.roi_layout_dropdown = ft.Dropdown(
+            options=[
+                ft.dropdown.Option(ROI_LAYOUT_COLLAGE, "1枚にまとめる"),
+                ft.dropdown.Option(ROI_LAYOUT_TILES, "領域ごとに送る"),
+            ],
+            value=ROI_LAYOUT_COLLAGE,
+            width=200,
+            border_radius=5,
+            bgcolor=ft.Colors.WHITE,
+        )
 
         # This list will store the TextField controls for data items
         self.data_item_text_fields = []
@@ -51,20 +75,52 @@ class DataSettingsScreen:
         self.data_items_column.controls.append(new_item_row)
         self.data_item_text_fields.append(text_field)
 
-    def _create_data_item_row_controls(self, item_number: int, value: str = "") -> tuple[ft.Row, ft.TextField]:
-        """データ項目入力行を生成するヘルパー関数です。"""
+    def _create_data_item_row_controls(self, item_number: int, value: str = "", roi: str = "", value_type: str = VALUE_TYPE_TEXT,
+                                       pattern: str = "") -> tuple[ft.Row, ft.TextField]:
+        """
+        データ項目入力行を生成するヘルパー関数です。
+        領域・値の型・形式の入力欄は、項目名の入力欄の data に (領域, 型, 形式) として保持します。
+        型と形式はカスケード時に、安価なモデルの値を上位のモデルに聞き直すかどうかの確認に使います。
+        """
+        roi_field = ft.TextField(
+            value=roi,
+            hint_text=ROI_HINT_TEXT,
+            border=ft.InputBorder.OUTLINE,
+            border_radius=5,
+            bgcolor=ft.Colors.WHITE,
+            width=300
+        )
+        value_type_dropdown = ft.Dropdown(
+            value=value_type,
+            options=[ft.dropdown.Option(key, label) for key, label in VALUE_TYPE_LABELS.items()],
+            border_radius=5,
+            bgcolor=ft.Colors.WHITE,
+            width=140
+        )
+        pattern_field = ft.TextField(
+            value=pattern,
+            hint_text=PATTERN_HINT_TEXT,
+            border=ft.InputBorder.OUTLINE,
+            border_radius=5,
+            bgcolor=ft.Colors.WHITE,
+            width=200
+        )
         text_field = ft.TextField(
             value=value,
             hint_text="取得したいデータ項目を入力してください",
             border=ft.InputBorder.OUTLINE,
             border_radius=5,
             bgcolor=ft.Colors.WHITE,
-            expand=True
+            expand=True,
+            data=(roi_field, value_type_dropdown, pattern_field)
         )
         # 先にRowのコントロールリストを作成し、Rowインスタンスを生成します
         row_controls = [
             ft.Text(f"データ項目{item_number}", width=120, size=16),
             text_field,
+            roi_field,
+            value_type_dropdown,
+            pattern_field,
         ]
         row = ft.Row(controls=row_controls, vertical_alignment=ft.CrossAxisAlignment.CENTER)
 
@@ -137,11 +193,61 @@ class DataSettingsScreen:
         """Clears the input form."""
         self.condition_name_field.value = ""
         self.condition_name_field.border_color = None # Reset border color
+        self.condition_roi_field.value = ""
+        self.condition_roi_field.error_text = None
+        self.roi_layout_dropdown.value = ROI_LAYOUT_COLLAGE
         self._add_initial_data_item_row() # Resets data items column and counter
         self.current_editing_condition_id = None
         self.condition_name_field.update()
+        self.condition_roi_field.update()
+        self.roi_layout_dropdown.update()
         self.data_items_column.update()
 
+    def _collect_item_inputs(self) -> tuple[str | None, list[tuple[str, str | None, str | None, str | None]]] | None:
+        """
+        条件の領域と、(データ項目名, 領域, 値の型, 形式) のリストをフォームから読み取ります。
+        領域は正規化した文字列で返し、領域や形式（正規表現）に不正な値があればエラーを表示して None を返します。
+        """
+        try:
+            condition_roi = format_roi(parse_roi(self.condition_roi_field.value)) or None
+            self.condition_roi_field.error_text = None
+        except ValueError as ex:
+            self.condition_roi_field.error_text = "領域の形式が正しくありません。"
+            self.condition_roi_field.update()
+            self._show_snackbar(str(ex), ft.Colors.ERROR)
+            return None
+        self.condition_roi_field.update()
+
+        items = []
+        for tf in self.data_item_text_fields:
+            if not tf.value.strip():
+                continue
+            roi_field, value_type_dropdown, pattern_field = tf.data
+            try:
+                item_roi = format_roi(parse_roi(roi_field.value if roi_field else None)) or None
+            except ValueError as ex:
+                roi_field.error_text = "領域の形式が正しくありません。"
+                roi_field.update()
+                self._show_snackbar(f"{tf.value.strip()}: {ex}", ft.Colors.ERROR)
+                return None
+            if roi_field and roi_field.error_text:
+                roi_field.error_text = None
+                roi_field.update()
+            pattern = pattern_field.value.strip() or None
+            try:
+                if pattern:
+                    re.compile(pattern)
+            except re.error as ex:
+                pattern_field.error_text = "正規表現が正しくありません。"
+                pattern_field.update()
+                self._show_snackbar(f"{tf.value.strip()}: {ex}", ft.Colors.ERROR)
+                return None
+            if pattern_field.error_text:
+                pattern_field.error_text = None
+                pattern_field.update()
+            items.append((tf.value.strip(), item_roi, value_type_dropdown.value or None, pattern))
+        return condition_roi, items
+
     def _save_new_condition_action(self, e: ft.ControlEvent):
         """「新規保存」ボタンのクリックイベントです。"""
         condition_name = self.condition_name_field.value.strip()
@@ -152,8 +258,11 @@ class DataSettingsScreen:
         self.condition_name_field.border_color = None
         self.condition_name_field.update()
 
-        data_item_names = [tf.value.strip() for tf in self.data_item_text_fields if tf.value.strip()]
-        if not data_item_names:
+        roi_inputs = self._collect_item_inputs()
+        if roi_inputs is None:
+            return
+        condition_roi, data_item_inputs = roi_inputs
+        if not data_item_inputs:
             # Optionally, show an error if no data items are provided
             # For now, we allow saving conditions with no data items
             pass
@@ -168,9 +277,9 @@ class DataSettingsScreen:
                 return
             self.condition_name_field.error_text = None # Clear error
 
-            new_condition = Condition(name=condition_name)
-            for item_name in data_item_names:
-                new_condition.data_items.append(DataItem(name=item_name))
+            new_condition = Condition(name=condition_name, roi=condition_roi, roi_layout=self.roi_layout_dropdown.value)
+            for item_name, item_roi, value_type, pattern in data_item_inputs:
+                new_condition.data_items.append(DataItem(name=item_name, roi=item_roi, value_type=value_type, pattern=pattern))
             
             db.add(new_condition)
             db.commit()
@@ -202,6 +311,9 @@ class DataSettingsScreen:
         self.condition_name_field.value = condition.name
         self.condition_name_field.error_text = None # Clear any previous error
         self.condition_name_field.border_color = None
+        self.condition_roi_field.value = condition.roi or ""
+        self.condition_roi_field.error_text = None
+        self.roi_layout_dropdown.value = condition.roi_layout or ROI_LAYOUT_COLLAGE
 
         self.data_items_column.controls.clear()
         self.data_item_text_fields.clear()
@@ -210,7 +322,8 @@ class DataSettingsScreen:
         if condition.data_items:
             for item in condition.data_items:
                 self.data_item_counter += 1
-                row, text_field = self._create_data_item_row_controls(self.data_item_counter, item.name)
+                row, text_field = self._create_data_item_row_controls(self.data_item_counter, item.name, item.roi or "",
+                                                                      item.value_type or VALUE_TYPE_TEXT, item.pattern or "")
                 self.data_items_column.controls.append(row)
                 self.data_item_text_fields.append(text_field)
         else:
@@ -224,6 +337,8 @@ class DataSettingsScreen:
                  self.data_item_text_fields.append(text_field)
 
         self.condition_name_field.update()
+        self.condition_roi_field.update()
+        self.roi_layout_dropdown.update()
         self.data_items_column.update()
         self.page.update()
 
@@ -241,7 +356,11 @@ class DataSettingsScreen:
         self.condition_name_field.border_color = None
         self.condition_name_field.update()
 
-        new_data_item_names = [tf.value.strip() for tf in self.data_item_text_fields if tf.value.strip()]
+        roi_inputs = self._collect_item_inputs()
+        if roi_inputs is None:
+            return
+        condition_roi, new_data_item_inputs = roi_inputs
+        new_data_item_names = [name for name, *_ in new_data_item_inputs]
 
         db = next(self.db_context())
         try:
@@ -260,6 +379,8 @@ class DataSettingsScreen:
             condition_to_update = db.query(Condition).filter(Condition.id == self.current_editing_condition_id).options(joinedload(Condition.data_items)).first()
             if condition_to_update:
                 condition_to_update.name = new_condition_name
+                condition_to_update.roi = condition_roi
+                condition_to_update.roi_layout = self.roi_layout_dropdown.value
                 
                 # Efficiently update data items:
                 # Remove old items not in new list
@@ -284,8 +405,8 @@ class DataSettingsScreen:
                 db.flush() # Ensure deletions are processed before adding new items with potentially same names
 
                 # Then, add the new/updated data items
-                for item_name in new_data_item_names:
-                    condition_to_update.data_items.append(DataItem(name=item_name))
+                for item_name, item_roi, value_type, pattern in new_data_item_inputs:
+                    condition_to_update.data_items.append(DataItem(name=item_name, roi=item_roi, value_type=value_type, pattern=pattern))
 
                 db.commit()
                 self._clear_form()
@@ -328,6 +449,11 @@ class DataSettingsScreen:
                     ft.Text("条件名", width=120, size=16),
                     self.condition_name_field,
                 ], vertical_alignment=ft.CrossAxisAlignment.CENTER),
+                ft.Row([
+                    ft.Text("読み取り領域", width=120, size=16),
+                    self.condition_roi_field,
+                    self.roi_layout_dropdown,
+                ], vertical_alignment=ft.CrossAxisAlignment.CENTER),
                 self.data_items_column,
                 ft.Container(
                     content=ft.ElevatedButton(
@@ -135,12 +135,17 @@ class ExportScreen:
 
             self.files_table.rows = []
             for file in scanned_files:
-                row_cells_text = [file.filename]
-                file_scan_map = {data.data_item_name: data.extracted_value for data in file.scanned_data}
-                for item_name in sorted_data_item_names:
-                    row_cells_text.append(file_scan_map.get(item_name, "")) # 該当なしは空文字
-                # DataRowのselectedプロパティを初期化
-                self.files_table.rows.append(ft.DataRow(cells=[ft.DataCell(ft.Text(cell_value)) for cell_value in row_cells_text])) # selectedプロパティを削除
+                # PDFはページ毎に1行、画像ファイルはページ番号 None の1行
+                page_scan_maps = {}
+                for data in file.scanned_data:
+                    page_scan_maps.setdefault(data.page_number, {})[data.data_item_name] = data.extracted_value
+                for page_number in sorted(page_scan_maps, key=lambda p: p or 0):
+                    file_scan_map = page_scan_maps[page_number]
+                    row_cells_text = [f"{file.filename} (p.{page_number})" if page_number else file.filename]
+                    for item_name in sorted_data_item_names:
+                        row_cells_text.append(file_scan_map.get(item_name) or "") # 該当なし・読み取れなかった項目は空文字
+                    # DataRowのselectedプロパティを初期化
+                    self.files_table.rows.append(ft.DataRow(cells=[ft.DataCell(ft.Text(cell_value)) for cell_value in row_cells_text])) # selectedプロパティを削除
             logger.debug(f"ExportScreen: Table rows added: {len(self.files_table.rows)}")
         finally:
             db.close()
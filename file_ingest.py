@@ -0,0 +1,153 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from models import UploadedFile
+from pdf_pages import count_pdf_pages
+from near_duplicates import compute_image_hashes, to_db_hash, HASHABLE_FILE_TYPES
+from blob_store import APP_BASE_DIR, PLACE_LABELS, StoredBlob, add_references, release_pending, store_file
+from thumbnails import thumbnail_cache
+
+INGEST_WORKERS = 8 # 同時に取り込むファイル数（ほとんどの時間はディスクの読み書き待ち）
+INSERT_CHUNK_SIZE = 200 # UploadedFile をまとめて挿入する件数
+PROGRESS_INTERVAL_SECONDS = 0.2 # 進捗を通知する最短の間隔（数千件で画面の更新が詰まらないように）
+
+
+def ingest_file(original_filename: str, source_path: str, ocr_list_id: int) -> tuple[dict, StoredBlob]:
+    """
+    1件を実体(blob_store)として置き、(UploadedFile の行, 置いた実体) を返します。スレッドプールで実行します。
+    同じ内容の実体が既にあれば複製しません。
+    """
+    file_ext = os.path.splitext(original_filename)[1].lower()
+    blob = store_file(source_path, file_ext)
+    try:
+        save_path_absolute = os.path.join(APP_BASE_DIR, blob.path)
+        # スキャン前に類似画像（同じ書類の撮り直し・再スキャン）を見つけるための知覚ハッシュ
+        dhash_value = phash_value = None
+        if file_ext.replace(".", "") in HASHABLE_FILE_TYPES:
+            try:
+                dhash_value, phash_value = (to_db_hash(value) for value in compute_image_hashes(save_path_absolute))
+            except (OSError, ValueError) as hash_ex:
+                print(f"類似判定用ハッシュの計算に失敗しました ({original_filename}): {hash_ex}")
+        row = {
+            "filename": original_filename,
+            "filepath": blob.path,
+            "blob_sha256": blob.sha256,
+            "filetype": file_ext.replace(".", ""),
+            "ocr_list_id": ocr_list_id,
+            "page_count": count_pdf_pages(save_path_absolute) if file_ext == ".pdf" else None,
+            "dhash": dhash_value,
+            "phash": phash_value,
+        }
+        return row, blob
+    except Exception:
+        release_pending([blob])
+        raise
+
+
+class IngestProgress:
+    """取り込みの進捗（件数・バイト数・ファイル/秒・置いた方法ごとの件数）です。bytes は重複した実体を含みます。"""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.inserted = 0
+        self.bytes = 0
+        self.methods = {}
+        self.errors = [] # (ファイル名, エラー)
+        self.started_at = time.monotonic()
+        self.elapsed_seconds = 0.0
+
+    @property
+    def files_per_sec(self) -> float:
+        return self.done / self.elapsed_seconds if self.elapsed_seconds > 0 else 0.0
+
+    def summary_text(self) -> str:
+        methods = ", ".join(f"{PLACE_LABELS.get(method, method)} {count}" for method, count in sorted(self.methods.items()))
+        text = (
+            f"取り込み: {self.done}/{self.total} 件" + (f" (失敗 {self.failed})" if self.failed else "")
+            + f" | {self.files_per_sec:.1f} ファイル/秒 | {self.bytes / 1024 / 1024:.1f}MB"
+        )
+        return text + (f" | {methods}" if methods else "")
+
+
+def _insert_rows(db_context, rows: list[dict], blobs: list[StoredBlob]):
+    """UploadedFile の行と実体の参照数を1つのトランザクションで書き込みます。"""
+    db = next(db_context())
+    try:
+        add_references(db, blobs)
+        db.bulk_insert_mappings(UploadedFile, rows)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+        release_pending(blobs)
+
+
+async def ingest_files(picked_files: list[tuple[str, str]], ocr_list_id: int, db_context,
+                       on_progress=None, workers: int = INGEST_WORKERS) -> IngestProgress:
+    """
+    (元のファイル名, パス) のリストをスレッドプールで並行して取り込み、UploadedFile を INSERT_CHUNK_SIZE 件ずつ挿入します。
+    on_progress(IngestProgress) はイベントループ上で、PROGRESS_INTERVAL_SECONDS ごとと最後に呼びます。
+    挿入したファイルのサムネイルは thumbnails.thumbnail_cache がバックグラウンドで作成します。
+    挿入に失敗したチャンクは失敗として数えます（置いた実体は参照されないまま残り、blob_store のGCで削除されます）。
+    """
+    loop = asyncio.get_running_loop()
+    progress = IngestProgress(len(picked_files))
+    pending_rows = []
+    pending_blobs = []
+    last_notified_at = 0.0
+
+    async def flush():
+        rows, blobs = list(pending_rows), list(pending_blobs)
+        pending_rows.clear()
+        pending_blobs.clear()
+        if not rows:
+            return
+        try:
+            # 取り込み用のスレッドの待ち行列の後ろに並ばないよう、既定のスレッドプールで挿入する
+            await loop.run_in_executor(None, _insert_rows, db_context, rows, blobs)
+            progress.inserted += len(rows)
+            # 一覧・プレビューに表示するサムネイルを、取り込みの完了を待たずにバックグラウンドで作成し始める
+            thumbnail_cache.schedule([
+                (row["blob_sha256"], os.path.join(APP_BASE_DIR, row["filepath"]), row["filetype"]) for row in rows
+            ])
+        except Exception as e:
+            print(f"ファイル情報の保存に失敗しました: {e}")
+            progress.errors.extend((row["filename"], str(e)) for row in rows)
+            progress.failed += len(rows)
+
+    async def ingest_one(name: str, path: str):
+        try:
+            return name, await loop.run_in_executor(executor, ingest_file, name, path, ocr_list_id), None
+        except Exception as e:
+            return name, None, e
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ingest") as executor:
+        for next_result in asyncio.as_completed([ingest_one(name, path) for name, path in picked_files]):
+            name, result, error = await next_result
+            progress.done += 1
+            if error is not None:
+                progress.failed += 1
+                progress.errors.append((name, str(error)))
+                print(f"ファイルの取り込みに失敗しました ({name}): {error}")
+            else:
+                row, blob = result
+                pending_rows.append(row)
+                pending_blobs.append(blob)
+                progress.bytes += blob.size_bytes
+                progress.methods[blob.method] = progress.methods.get(blob.method, 0) + 1
+                if len(pending_rows) >= INSERT_CHUNK_SIZE:
+                    await flush()
+            progress.elapsed_seconds = time.monotonic() - progress.started_at
+            if on_progress is not None and time.monotonic() - last_notified_at >= PROGRESS_INTERVAL_SECONDS:
+                last_notified_at = time.monotonic()
+                on_progress(progress)
+        await flush()
+    progress.elapsed_seconds = time.monotonic() - progress.started_at
+    if on_progress is not None:
+        on_progress(progress)
+    return progress
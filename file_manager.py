@@ -1,9 +1,10 @@
 import flet as ft
 from models import get_db, OcrList, UploadedFile
+from file_ingest import IngestProgress, ingest_files
+from blob_store import collect_garbage, release_references, storage_report
+from thumbnails import SIZE_LIST, thumbnail_cache, thumbnail_key
 from sqlalchemy.orm import joinedload
 import os
-import shutil
-import uuid
 
 # プロジェクトのベースディレクトリを取得
 APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -52,6 +53,12 @@ class FileManagerScreen:
             ),
             tooltip="PNG, JPG, PDF ファイルを複数選択できます"
         )
+        # 取り込み中の進捗（件数・ファイル/秒）
+        self.ingest_progress_bar = ft.ProgressBar(value=0, visible=False)
+        self.ingest_progress_text = ft.Text("", size=12, color=ft.Colors.BLACK54)
+        self.ingesting = False
+        # 同じ内容のファイルを1つの実体で共有したことによる容量の削減
+        self.storage_text = ft.Text("", size=12, color=ft.Colors.BLACK54)
 
         self.select_all_checkbox = ft.Checkbox(label="一括選択/解除", on_change=self._toggle_select_all_files, disabled=True)
         self.delete_selected_button = ft.ElevatedButton(
@@ -72,15 +79,16 @@ class FileManagerScreen:
         self._load_ocr_lists()
         if self.selected_ocr_list_id:
             self._load_files_for_list()
+        self._refresh_storage_text()
 
-    def _get_ocr_list_upload_dir(self, ocr_list_id: int) -> str:
-        """特定のOCRリスト用のアップロードディレクトリパスを取得し、存在しなければ作成します。"""
-        if ocr_list_id is None:
-            return None
-        list_upload_dir = os.path.join(UPLOAD_BASE_DIR, str(ocr_list_id))
-        if not os.path.exists(list_upload_dir):
-            os.makedirs(list_upload_dir)
-        return list_upload_dir
+    def _refresh_storage_text(self):
+        db = next(self.db_context())
+        try:
+            self.storage_text.value = storage_report(db).summary_text()
+        finally:
+            db.close()
+        if self.storage_text.page:
+            self.storage_text.update()
 
     def _load_ocr_lists(self):
         db = next(self.db_context())
@@ -142,7 +150,8 @@ class FileManagerScreen:
                     self.file_checkboxes[f_obj.id] = checkbox
                     row = ft.Row([
                         checkbox,
-                        ft.Text(f_obj.filename, expand=True, tooltip=f_obj.filename),
+                        self._file_thumbnail(f_obj),
+                        ft.Text(f"{f_obj.filename} ({f_obj.page_count}ページ)" if f_obj.page_count else f_obj.filename, expand=True, tooltip=f_obj.filename),
                         ft.IconButton(ft.Icons.DELETE_OUTLINE, tooltip="削除", data=f_obj, on_click=self._delete_single_file_action)
                     ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN, vertical_alignment=ft.CrossAxisAlignment.CENTER)
                     container = ft.Container(row, border=ft.border.only(bottom=ft.border.BorderSide(1, ft.Colors.BLACK12)), padding=ft.padding.symmetric(vertical=2, horizontal=5))
@@ -157,53 +166,81 @@ class FileManagerScreen:
         if self.select_all_checkbox.page:
             self.select_all_checkbox.update()
 
-    def _on_files_picked(self, e: ft.FilePickerResultEvent):
+    def _file_thumbnail(self, f_obj: UploadedFile) -> ft.Container:
+        """一覧の行のサムネイルです。キャッシュに無ければバックグラウンドで作成し、できたら差し替えます。"""
+        container = ft.Container(
+            content=ft.Icon(ft.Icons.PICTURE_AS_PDF_OUTLINED if f_obj.filetype == "pdf" else ft.Icons.IMAGE_OUTLINED, color=ft.Colors.BLACK26),
+            width=40, height=40, alignment=ft.alignment.center, border_radius=4, clip_behavior=ft.ClipBehavior.HARD_EDGE,
+        )
+
+        def show(path: str | None):
+            if path:
+                container.content = ft.Image(src=path, width=40, height=40, fit=ft.ImageFit.COVER)
+                if container.page: container.update()
+
+        show(thumbnail_cache.get(thumbnail_key(f_obj), os.path.join(APP_BASE_DIR, f_obj.filepath), f_obj.filetype, SIZE_LIST, on_ready=show))
+        return container
+
+    async def _on_files_picked(self, e: ft.FilePickerResultEvent):
         if not self.selected_ocr_list_id:
             self.page.snack_bar = ft.SnackBar(ft.Text("先にOCRリストを選択してください。"), open=True)
             self.page.update()
             return
+        if self.ingesting:
+            self.page.snack_bar = ft.SnackBar(ft.Text("取り込みが終わるまでお待ちください。"), open=True)
+            self.page.update()
+            return
         if e.files:
-            self._save_picked_files(e.files)
-
-    def _save_picked_files(self, picked_files: list):
-        list_upload_dir = self._get_ocr_list_upload_dir(self.selected_ocr_list_id)
-        if not list_upload_dir:
+            await self._save_picked_files(e.files)
+
+    async def _save_picked_files(self, picked_files: list):
+        """
+        選択されたファイルをバックグラウンドのスレッドで並行して取り込みます（file_ingest.ingest_files）。
+        取り込み中も画面は操作でき、進捗バーに件数とファイル/秒を表示します。
+        """
+        ocr_list_id = self.selected_ocr_list_id
+        if ocr_list_id is None:
             return
 
-        db = next(self.db_context())
-        saved_count = 0
+        self.ingesting = True
+        self.upload_button.disabled = True
+        self.ingest_progress_bar.value = 0
+        self.ingest_progress_bar.visible = True
+        self.ingest_progress_text.value = f"取り込み: 0/{len(picked_files)} 件"
+        for control in (self.upload_button, self.ingest_progress_bar, self.ingest_progress_text):
+            if control.page: control.update()
         try:
-            for picked_file in picked_files:
-                original_filename = picked_file.name
-                source_path = picked_file.path
-                file_ext = os.path.splitext(original_filename)[1].lower()
-
-                unique_filename = f"{uuid.uuid4()}{file_ext}"
-                save_path_absolute = os.path.join(list_upload_dir, unique_filename)
-                
-                db_filepath = os.path.join(UPLOAD_DIR_NAME, str(self.selected_ocr_list_id), unique_filename).replace("\\", "/")
-
-                shutil.copy(source_path, save_path_absolute)
-
-                new_file_db = UploadedFile(
-                    filename=original_filename,
-                    filepath=db_filepath,
-                    filetype=file_ext.replace(".", ""),
-                    ocr_list_id=self.selected_ocr_list_id
-                )
-                db.add(new_file_db)
-            db.commit()
-            saved_count = len(picked_files)
-            self.page.snack_bar = ft.SnackBar(ft.Text(f"{saved_count} 個のファイルをアップロードしました。"), open=True)
-        except Exception as ex:
-            db.rollback()
-            print(f"Error saving files: {ex}")
+            progress = await ingest_files(
+                [(picked_file.name, picked_file.path) for picked_file in picked_files],
+                ocr_list_id, self.db_context, on_progress=self._show_ingest_progress,
+            )
         finally:
-            db.close()
-        
-        if saved_count > 0:
+            self.ingesting = False
+            self.upload_button.disabled = False
+            self.ingest_progress_bar.visible = False
+            for control in (self.upload_button, self.ingest_progress_bar):
+                if control.page: control.update()
+
+        saved_count = progress.inserted
+        print(progress.summary_text())
+        if progress.failed:
+            failed_names = ", ".join(name for name, _ in progress.errors[:3])
+            self.page.snack_bar = ft.SnackBar(
+                ft.Text(f"{saved_count} 個のファイルをアップロードしました（{progress.failed} 個は失敗: {failed_names}）。"),
+                bgcolor=ft.Colors.ERROR, open=True,
+            )
+        else:
+            self.page.snack_bar = ft.SnackBar(ft.Text(f"{saved_count} 個のファイルをアップロードしました。"), open=True)
+        if saved_count > 0 and self.selected_ocr_list_id == ocr_list_id:
             self._load_files_for_list()
-            self.page.update()
+        self._refresh_storage_text()
+        self.page.update()
+
+    def _show_ingest_progress(self, progress: IngestProgress):
+        self.ingest_progress_bar.value = progress.done / progress.total if progress.total else 1.0
+        self.ingest_progress_text.value = progress.summary_text()
+        for control in (self.ingest_progress_bar, self.ingest_progress_text):
+            if control.page: control.update()
 
     def _delete_single_file_action(self, e: ft.ControlEvent):
         file_to_delete: UploadedFile = e.control.data
@@ -234,13 +271,13 @@ class FileManagerScreen:
                 physical_file_path = os.path.join(APP_BASE_DIR, f_obj.filepath)
                 parent_dir = os.path.dirname(physical_file_path)
                 
-                # 1. 物理ファイルの削除
+                # 1. 物理ファイルの削除（実体は同じ内容の他のファイルと共有しているため、参照数を減らして 4 のGCで削除する）
                 try:
-                    if os.path.exists(physical_file_path):
+                    if f_obj.blob_sha256 is None and os.path.exists(physical_file_path):
                         os.remove(physical_file_path)
                         parent_dirs_affected.add(parent_dir)
                     # 物理ファイルが存在しなくても、DB削除は試行
-                    elif os.path.exists(parent_dir):
+                    elif f_obj.blob_sha256 is None and os.path.exists(parent_dir):
                          parent_dirs_affected.add(parent_dir)
                 except OSError as ose:
                     # 物理ファイルの削除に失敗した場合、このトランザクションを中止してエラーを報告
@@ -253,11 +290,15 @@ class FileManagerScreen:
                 # 2. DBレコードの削除
                 db.delete(f_obj)
                 deleted_count += 1
+            release_references(db, [f_obj.blob_sha256 for f_obj in files_to_delete])
             
             # 3. トランザクションのコミット
             db.commit()
 
-            # 4. 空になった親ディレクトリのクリーンアップ
+            # 4. 参照されなくなった実体と、空になった親ディレクトリのクリーンアップ
+            gc_result = collect_garbage(db)
+            if gc_result.blobs_removed:
+                print(gc_result.summary_text())
             for p_dir in sorted(list(parent_dirs_affected), key=len, reverse=True):
                 try:
                     if os.path.exists(p_dir) and not os.listdir(p_dir):
@@ -275,6 +316,7 @@ class FileManagerScreen:
             db.close()
             # 5. UIの更新
             self._load_files_for_list()
+            self._refresh_storage_text()
             self.page.update()
 
     def _on_file_checkbox_change(self, e: ft.ControlEvent):
@@ -313,8 +355,11 @@ class FileManagerScreen:
                 ft.Row([ft.Text("OCRリスト:", width=100, size=18, weight=ft.FontWeight.BOLD), self.ocr_list_dropdown], vertical_alignment=ft.CrossAxisAlignment.CENTER),
                 ft.Text("ファイルアップロード", size=18, weight=ft.FontWeight.W_600),
                 self.upload_button,
+                self.ingest_progress_bar,
+                self.ingest_progress_text,
                 ft.Divider(height=10),
                 ft.Text("アップロード済みファイル", size=18, weight=ft.FontWeight.W_600),
+                self.storage_text,
                 ft.Row([self.select_all_checkbox, self.delete_selected_button], alignment=ft.MainAxisAlignment.START, spacing=20, vertical_alignment=ft.CrossAxisAlignment.CENTER),
                 self.files_table_area,
             ]
@@ -0,0 +1,105 @@
+import asyncio
+import time
+from collections import deque
+from scan_calls import percentile
+
+DEFAULT_MAX_HEDGE_RATE = 0.05 # 重複リクエストを送る呼び出しの割合の上限（API使用量の増加をこの割合に抑える）
+HEDGE_PERCENTILE = 0.95 # 所要時間がこの百分位数を超えたら重複リクエストを送る
+LATENCY_WINDOW_SIZE = 200 # 百分位数の算出に使う直近の呼び出し数
+MIN_LATENCY_SAMPLES = 20 # これより少ない間は百分位数が不安定なため重複リクエストを送らない
+STATS_LATENCY_HISTORY = 5000 # 集計に使う直近の呼び出し数（長時間動かしてもメモリと並べ替えの時間が増え続けないように）
+
+
+class HedgeStats:
+    """重複リクエスト（ヘッジ）の送信率と、直近 STATS_LATENCY_HISTORY 回の呼び出しの所要時間の分布を集計します。"""
+
+    def __init__(self):
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0 # 重複リクエストの方が先に応答した回数
+        self.capped = 0 # 上限に達していたため重複リクエストを送らなかった回数
+        self.latencies = deque(maxlen=STATS_LATENCY_HISTORY) # 直近の呼び出しごとの所要時間（先に届いた応答まで）
+
+    @property
+    def hedge_rate(self) -> float:
+        return self.hedged / self.calls if self.calls else 0.0
+
+    def latency_percentile(self, ratio: float) -> float:
+        return percentile(sorted(self.latencies), ratio)
+
+    def summary_text(self) -> str:
+        latencies = sorted(self.latencies) # 3つの百分位数で並べ替えを1回にする
+        return (
+            f"ヘッジ: {self.hedged}/{self.calls} 回 ({self.hedge_rate:.1%}) | 重複側が先着 {self.hedge_wins} 回 | 上限で見送り {self.capped} 回"
+            f" | 所要時間 p50 {percentile(latencies, 0.5):.2f}秒 / p95 {percentile(latencies, 0.95):.2f}秒"
+            f" / p99 {percentile(latencies, 0.99):.2f}秒"
+        )
+
+
+class HedgingPolicy:
+    """
+    直近の呼び出しの所要時間の p95 を超えても応答がない呼び出しに、同じリクエストをもう1つ送ります。
+    先に成功した応答を使い、もう一方は取り消します。重複リクエストは max_hedge_rate の割合までに抑えます。
+    ストリーミングのように途中経過を通知する呼び出しは、通知が重複するため対象にしません。
+    """
+
+    def __init__(self, enabled: bool = False, max_hedge_rate: float = DEFAULT_MAX_HEDGE_RATE):
+        self.enabled = enabled
+        self.max_hedge_rate = max_hedge_rate
+        self.window = deque(maxlen=LATENCY_WINDOW_SIZE) # 1リクエストごとの所要時間（成功したもののみ）
+        self.stats = HedgeStats()
+
+    def configure(self, enabled: bool, max_hedge_rate: float):
+        self.enabled = enabled
+        self.max_hedge_rate = max_hedge_rate
+
+    def hedge_delay(self) -> float | None:
+        """重複リクエストを送るまでの待ち時間です。計測数が少ない間は None を返します。"""
+        if len(self.window) < MIN_LATENCY_SAMPLES:
+            return None
+        return percentile(sorted(self.window), HEDGE_PERCENTILE)
+
+    def _within_budget(self) -> bool:
+        return (self.stats.hedged + 1) / max(1, self.stats.calls) <= self.max_hedge_rate
+
+    async def _timed(self, request_factory):
+        started_at = time.monotonic()
+        response = await request_factory()
+        self.window.append(time.monotonic() - started_at)
+        return response
+
+    async def run(self, request_factory, acquire_hedge=None):
+        """
+        request_factory() を実行し、遅い場合は重複リクエストを送って先に成功した応答を返します（無効な場合は所要時間の集計のみ）。
+        acquire_hedge() が False を返した場合（レート制限の枠がないなど）は重複リクエストを送りません。
+        両方が失敗した場合は最初のリクエストの例外を送出します。
+        """
+        started_at = time.monotonic()
+        self.stats.calls += 1
+        primary = asyncio.ensure_future(self._timed(request_factory))
+        tasks = [primary]
+        try:
+            delay = self.hedge_delay() if self.enabled else None
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    if not self._within_budget():
+                        self.stats.capped += 1
+                    elif acquire_hedge is None or acquire_hedge():
+                        self.stats.hedged += 1
+                        tasks.append(asyncio.ensure_future(self._timed(request_factory)))
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and task.exception() is None:
+                        if task is not primary:
+                            self.stats.hedge_wins += 1
+                        self.stats.latencies.append(time.monotonic() - started_at)
+                        return task.result()
+            raise primary.exception()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
@@ -0,0 +1,133 @@
+import io
+from dataclasses import dataclass
+from PIL import Image, ImageOps
+
+# 出力形式ごとのMIMEタイプ
+OUTPUT_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+DEFAULT_MAX_PIXELS = 2_000_000 # 約 1600x1200。帳票の文字を読み取るには十分な解像度
+DEFAULT_QUALITY = 85
+
+
+@dataclass
+class PreprocessOptions:
+    """Gemini へ送信する前の画像処理の設定です。"""
+    enabled: bool = True
+    max_pixels: int = DEFAULT_MAX_PIXELS # 幅×高さの上限。超える場合は縦横比を保って縮小
+    grayscale: bool = False
+    output_format: str = "JPEG" # "JPEG" または "WEBP"
+    quality: int = DEFAULT_QUALITY
+
+    @property
+    def signature(self) -> str:
+        """キャッシュキーに含める識別子です。送信する画像が変わる設定を表します。"""
+        if not self.enabled:
+            return "original"
+        return f"{self.output_format.upper()}:q{self.quality}:px{self.max_pixels}" + (":gray" if self.grayscale else "")
+
+
+@dataclass
+class PreprocessResult:
+    data: bytes
+    mime_type: str
+    original_bytes: int
+    processed_bytes: int
+    original_size: tuple[int, int]
+    processed_size: tuple[int, int]
+
+
+class PreprocessStats:
+    """前処理前後のバイト数を累積し、削減量を集計します。"""
+
+    def __init__(self):
+        self.file_count = 0
+        self.original_bytes = 0
+        self.processed_bytes = 0
+
+    def record(self, result: PreprocessResult):
+        self.file_count += 1
+        self.original_bytes += result.original_bytes
+        self.processed_bytes += result.processed_bytes
+
+    @property
+    def savings_ratio(self) -> float:
+        if not self.original_bytes:
+            return 0.0
+        return 1 - self.processed_bytes / self.original_bytes
+
+    def summary_text(self) -> str:
+        return (
+            f"送信画像: {self.file_count} 件 {_format_bytes(self.original_bytes)} → {_format_bytes(self.processed_bytes)}"
+            f" (削減 {self.savings_ratio:.0%})"
+        )
+
+
+def _format_bytes(num_bytes: int) -> str:
+    if num_bytes >= 1024 * 1024:
+        return f"{num_bytes / (1024 * 1024):.1f}MB"
+    return f"{num_bytes / 1024:.0f}KB"
+
+
+def fit_size_to_pixel_budget(size: tuple[int, int], max_pixels: int) -> tuple[int, int]:
+    """縦横比を保ったまま 幅×高さ が max_pixels 以下になるサイズを返します。"""
+    width, height = size
+    if max_pixels <= 0 or width * height <= max_pixels:
+        return size
+    scale = (max_pixels / (width * height)) ** 0.5
+    return (max(1, int(width * scale)), max(1, int(height * scale)))
+
+
+def _fit_to_pixel_budget(image: Image.Image, max_pixels: int) -> Image.Image:
+    new_size = fit_size_to_pixel_budget(image.size, max_pixels)
+    if new_size == image.size:
+        return image
+    return image.resize(new_size, Image.Resampling.LANCZOS)
+
+
+def preprocess_image(image: Image.Image, options: PreprocessOptions) -> Image.Image:
+    """
+    画像を送信用に変換します。
+    EXIFの回転情報を画素に反映してから縮小・グレースケール化を行います。EXIF自体は再エンコード時に破棄されます。
+    """
+    image = ImageOps.exif_transpose(image)
+    image = _fit_to_pixel_budget(image, options.max_pixels)
+    if options.grayscale:
+        image = image.convert("L")
+    elif image.mode not in ("RGB", "L"):
+        # JPEGはアルファチャンネルを扱えないため白背景に合成する
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        else:
+            image = image.convert("RGB")
+    return image
+
+
+def encode_image(image: Image.Image, options: PreprocessOptions) -> tuple[bytes, str]:
+    output_format = options.output_format.upper()
+    if output_format not in OUTPUT_MIME_TYPES:
+        raise ValueError(f"サポートされていない出力形式です: {options.output_format}")
+    buffer = io.BytesIO()
+    image.save(buffer, format=output_format, quality=options.quality, optimize=True)
+    return buffer.getvalue(), OUTPUT_MIME_TYPES[output_format]
+
+
+def preprocess_image_bytes(raw_bytes: bytes, options: PreprocessOptions) -> PreprocessResult:
+    """画像のバイト列を前処理し、前後のサイズを含む結果を返します。"""
+    with Image.open(io.BytesIO(raw_bytes)) as image:
+        original_size = image.size
+        processed = preprocess_image(image, options)
+        data, mime_type = encode_image(processed, options)
+        return PreprocessResult(
+            data=data,
+            mime_type=mime_type,
+            original_bytes=len(raw_bytes),
+            processed_bytes=len(data),
+            original_size=original_size,
+            processed_size=processed.size,
+        )
@@ -1,12 +1,21 @@
+import multiprocessing
 import flet as ft
 from ui_components import AIOCRAppUI
 from models import create_db_and_tables
+from blob_store import migrate_legacy_files
 
 def main(page: ft.Page):
     create_db_and_tables() # Initialize database and tables
+    # images/<リストID>/ に保存していたファイルを、内容で共有する実体(images/blobs)に移す（移行済みの印があれば何もしない）
+    migration = migrate_legacy_files()
+    if migration.files:
+        print(migration.summary_text())
     ui = AIOCRAppUI(page)
 
-ft.app(target=main)
+if __name__ == "__main__":
+    # 画像前処理のプロセスプールが（Windowsでは）このファイルを読み込み直すため、アプリの起動は直接実行したときだけにする
+    multiprocessing.freeze_support()
+    ft.app(target=main)
 
 '''
 PythonにおけるFletを利用してAI-OCRデスクトップアプリを開発したい。
@@ -1,6 +1,7 @@
 # c:\Users\sugir\Documents\desktop-app\flet-ocr-app\database.py
 # from sqlalchemy import create_engine, Column, Integer, String, ForeignKey
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Boolean, DateTime
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Boolean, Date, DateTime, Float, Text, Index, UniqueConstraint, event, inspect, text
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 import os
 
@@ -15,8 +16,11 @@ class Condition(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True, nullable=False)
+    roi = Column(String, nullable=True) # 領域未指定のデータ項目に使う切り抜き領域 "x0,y0,x1,y1"（0〜1の割合）
+    roi_layout = Column(String, default="collage", nullable=True) # 切り抜いた領域の送り方 collage / tiles
 
     data_items = relationship("DataItem", back_populates="condition", cascade="all, delete-orphan")
+    scan_jobs = relationship("ScanJob", cascade="all, delete-orphan")
 
     def __repr__(self):
         return f"<Condition(id={self.id}, name='{self.name}')>"
@@ -27,6 +31,9 @@ class DataItem(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
     condition_id = Column(Integer, ForeignKey("conditions.id"), nullable=False)
+    roi = Column(String, nullable=True) # この項目が記載されている領域 "x0,y0,x1,y1"（0〜1の割合）
+    value_type = Column(String, nullable=True) # 抽出結果の確認に使う型 "text" / "number" / "date"（NULL と "text" は型を確認しない）
+    pattern = Column(String, nullable=True) # 抽出結果が一致すべき正規表現（NULLは確認しない）
 
     condition = relationship("Condition", back_populates="data_items")
 
@@ -49,25 +56,48 @@ class UploadedFile(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String, nullable=False) # 元のファイル名
-    filepath = Column(String, unique=True, nullable=False) # 保存先の相対パス (images/ocr_list_id/unique_filename)
+    # 保存先の相対パス。内容の同じファイルは同じ実体を参照する (images/blobs/ab/cd/<sha256>.<ext>、移行前は images/ocr_list_id/unique_filename)
+    filepath = Column(String, index=True, nullable=False)
+    blob_sha256 = Column(String, index=True, nullable=True) # 参照している Blob（移行前のファイルは None）
     filetype = Column(String, nullable=False) # png, jpg, pdfなど
     ocr_list_id = Column(Integer, ForeignKey("ocr_lists.id"), nullable=False)
     is_scanned = Column(Boolean, default=False, nullable=False)
     scanned_at = Column(DateTime, nullable=True)
+    page_count = Column(Integer, nullable=True) # PDFのページ数（画像ファイルは None）
+    dhash = Column(Integer, nullable=True) # 類似画像の判定用 dHash（64ビット、符号付きで保存。PDFは None）
+    phash = Column(Integer, index=True, nullable=True) # 類似画像の判定用 pHash（同上）
 
     ocr_list = relationship("OcrList", back_populates="uploaded_files")
     scanned_data = relationship("ScannedData", back_populates="uploaded_file", cascade="all, delete-orphan")
+    scan_jobs = relationship("ScanJob", cascade="all, delete-orphan")
 
     def __repr__(self):
         # return f"<UploadedFile(id={self.id}, filename='{self.filename}', ocr_list_id={self.ocr_list_id})>"
         return f"<UploadedFile(id={self.id}, filename='{self.filename}', ocr_list_id={self.ocr_list_id}, is_scanned={self.is_scanned})>"
 
+class Blob(Base):
+    """
+    アップロードしたファイルの実体（内容のSHA-256で一意）。同じ内容のファイルを複数のリストに追加しても1つだけ保存します。
+    ref_count は参照している UploadedFile の数で、0になった実体はGC(blob_store.collect_garbage)で削除します。
+    """
+    __tablename__ = "blobs"
+
+    sha256 = Column(String, primary_key=True)
+    path = Column(String, unique=True, nullable=False) # 保存先の相対パス (images/blobs/ab/cd/<sha256>.<ext>)
+    size_bytes = Column(Integer, nullable=False)
+    ref_count = Column(Integer, default=0, index=True, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<Blob(sha256='{self.sha256[:12]}...', size={self.size_bytes}, refs={self.ref_count})>"
+
 class ScannedData(Base):
     __tablename__ = "scanned_data"
 
     id = Column(Integer, primary_key=True, index=True)
     uploaded_file_id = Column(Integer, ForeignKey("uploaded_files.id"), nullable=False)
     condition_id = Column(Integer, ForeignKey("conditions.id"), nullable=False) # スキャン時に使用した条件
+    page_number = Column(Integer, nullable=True) # PDFのページ番号（1始まり、画像ファイルは None）
     data_item_name = Column(String, nullable=False) # DataItem.name
     extracted_value = Column(String, nullable=True) # 抽出された値
 
@@ -75,13 +105,153 @@ class ScannedData(Base):
     condition = relationship("Condition") # Simple relationship to Condition
 
     def __repr__(self):
-        return f"<ScannedData(id={self.id}, file_id={self.uploaded_file_id}, item='{self.data_item_name}', value='{self.extracted_value[:20]}...')>"
+        return f"<ScannedData(id={self.id}, file_id={self.uploaded_file_id}, item='{self.data_item_name}', value='{(self.extracted_value or '')[:20]}...')>"
+
+class ScanResultCache(Base):
+    """画像内容(SHA-256)・条件のデータ項目・モデル名をキーにしたGemini抽出結果のキャッシュ"""
+    __tablename__ = "scan_result_cache"
+
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, unique=True, index=True, nullable=False) # image_sha256 + 条件フィンガープリント + モデル名 のハッシュ
+    image_sha256 = Column(String, index=True, nullable=False)
+    model_name = Column(String, nullable=False)
+    result_json = Column(Text, nullable=False) # {データ項目名: 値} のJSON
+    size_bytes = Column(Integer, nullable=False) # result_json のバイト数（サイズ上限の判定用）
+    hit_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    last_used_at = Column(DateTime, index=True, nullable=False) # LRU追い出し用
+
+    def __repr__(self):
+        return f"<ScanResultCache(id={self.id}, image_sha256='{self.image_sha256[:12]}...', model='{self.model_name}', hits={self.hit_count})>"
+
+class ScanJob(Base):
+    """
+    一括スキャンの永続ジョブキュー（1ファイル×1条件で1件）
+    state: queued(待機) / running(実行中、lease_expires_at までリース) / done(完了) / failed(失敗)
+    """
+    __tablename__ = "scan_jobs"
+    __table_args__ = (
+        Index("ix_scan_jobs_state_lease", "state", "lease_expires_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    batch_id = Column(String, index=True, nullable=False) # 一括スキャン1回分の識別子
+    uploaded_file_id = Column(Integer, ForeignKey("uploaded_files.id"), index=True, nullable=False)
+    condition_id = Column(Integer, ForeignKey("conditions.id"), nullable=False)
+    state = Column(String, default="queued", nullable=False)
+    priority = Column(Integer, default=1, nullable=False) # 0: 対話 / 1: 通常 / 2: 一括。小さいものから取得する
+    attempts = Column(Integer, default=0, nullable=False) # 取得(claim)された回数
+    lease_owner = Column(String, nullable=True) # 実行中のワーカーの識別子
+    lease_expires_at = Column(DateTime, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<ScanJob(id={self.id}, file_id={self.uploaded_file_id}, state='{self.state}', attempts={self.attempts})>"
+
+class ScanCall(Base):
+    """
+    OCRバックエンド(Gemini API)の呼び出し1回分の記録（トークン数・送信量・所要時間・再試行・結果）
+    リスト・条件・日付ごとの集計に使うため、リストや条件を削除しても記録は残します（外部キー制約なし）。
+    """
+    __tablename__ = "scan_calls"
+    __table_args__ = (
+        Index("ix_scan_calls_list_date", "ocr_list_id", "call_date"),
+        Index("ix_scan_calls_condition_date", "condition_id", "call_date"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    call_date = Column(Date, index=True, nullable=False) # 集計用の日付（ローカル時刻）
+    created_at = Column(DateTime, nullable=False)
+    ocr_list_id = Column(Integer, nullable=True)
+    condition_id = Column(Integer, nullable=True)
+    uploaded_file_id = Column(Integer, nullable=True) # まとめ送信は NULL（file_count 件分）
+    page_number = Column(Integer, nullable=True)
+    file_count = Column(Integer, default=1, nullable=False) # 集計で数えるファイル数（まとめ送信は画像の枚数、PDFの2ページ目以降は0）
+    model_name = Column(String, nullable=False)
+    prompt_tokens = Column(Integer, default=0, nullable=False)
+    candidates_tokens = Column(Integer, default=0, nullable=False)
+    bytes_sent = Column(Integer, default=0, nullable=False)
+    latency_seconds = Column(Float, nullable=False) # 最後の試行の所要時間（レート制限・バックオフの待ち時間を除く）
+    retries = Column(Integer, default=0, nullable=False)
+    outcome = Column(String, nullable=False) # ok / parse_error / api_error
+
+    def __repr__(self):
+        return f"<ScanCall(id={self.id}, file_id={self.uploaded_file_id}, model='{self.model_name}', outcome='{self.outcome}')>"
+
+# スキャン中のDB操作はスレッドプールで実行するため、接続を作成したスレッド以外からの利用を許可する
+# （1つのセッションを複数のスレッドで同時に使うことはしない）
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WALモード: 書き込み中も他の接続から読み取れるため、並行スキャンの読み取りがコミット待ちで止まらない
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
 
-engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def _add_missing_columns():
+    """
+    既存のDBファイルに、後から追加したカラムを ALTER TABLE で追加します。
+    create_all は既存テーブルを変更しないため、NULL許容またはデフォルト値を持つカラムのみを対象とします。
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                default_clause = ""
+                if column.default is not None and column.default.is_scalar:
+                    default_value = column.default.arg
+                    if isinstance(default_value, bool):
+                        default_value = int(default_value)
+                    default_clause = f" DEFAULT {default_value!r}" if isinstance(default_value, str) else f" DEFAULT {default_value}"
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{default_clause}'))
+                if column.index:
+                    conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{table.name}_{column.name} ON {table.name} ({column.name})'))
+
+def _drop_removed_unique_constraints():
+    """
+    モデルから外した UNIQUE 制約を既存のDBファイルから取り除きます（UploadedFile.filepath など）。
+    SQLite は制約を ALTER TABLE で削除できないため、テーブルを作り直して行をコピーします。
+    外部キー制約は有効にしていないため、参照している他のテーブルはそのままで構いません。
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        model_uniques = {
+            tuple(column.name for column in constraint.columns)
+            for constraint in table.constraints if isinstance(constraint, UniqueConstraint)
+        }
+        db_uniques = {tuple(unique["column_names"]) for unique in inspector.get_unique_constraints(table.name)}
+        if db_uniques <= model_uniques:
+            continue
+        new_name = f"{table.name}_rebuild"
+        columns = ", ".join(column.name for column in table.columns)
+        create_sql = str(CreateTable(table).compile(dialect=engine.dialect)).replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE {new_name} ", 1)
+        with engine.begin() as conn:
+            conn.execute(text(create_sql))
+            conn.execute(text(f"INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {table.name}"))
+            conn.execute(text(f"DROP TABLE {table.name}"))
+            conn.execute(text(f"ALTER TABLE {new_name} RENAME TO {table.name}"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        print(f"テーブル {table.name} の UNIQUE 制約を更新しました。")
+
 def create_db_and_tables():
     Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
+    _drop_removed_unique_constraints()
 
 def get_db():
     db = SessionLocal()
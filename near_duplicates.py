@@ -0,0 +1,226 @@
+import os
+import threading
+import numpy as np
+from dataclasses import dataclass
+from PIL import Image, ImageOps
+from sqlalchemy.orm import Session
+from models import UploadedFile, ScannedData
+
+APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HASH_SIZE = 8 # 8x8 = 64ビットのハッシュ
+PHASH_SAMPLE_SIZE = 32 # pHash は 32x32 に縮小してからDCTをとる
+DEFAULT_MAX_DISTANCE = 6 # pHash のハミング距離がこれ以下なら類似とみなす（64ビット中）
+DHASH_MAX_DISTANCE = 12 # 誤検出を減らすため dHash の距離も確認する
+HASHABLE_FILE_TYPES = ["png", "jpg", "jpeg"] # PDFはページごとに内容が異なるため対象外
+
+
+def _grayscale_pixels(image: Image.Image, width: int, height: int) -> np.ndarray:
+    image = ImageOps.exif_transpose(image).convert("L")
+    return np.asarray(image.resize((width, height), Image.Resampling.LANCZOS), dtype=np.float64)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.astype(np.uint8).ravel()).tobytes(), "big")
+
+
+def dhash(image: Image.Image) -> int:
+    """隣り合う画素の明暗の差（横方向の勾配）の符号を並べた64ビットのハッシュです。"""
+    pixels = _grayscale_pixels(image, HASH_SIZE + 1, HASH_SIZE)
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.sqrt(2.0 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+    matrix[0, :] = np.sqrt(1.0 / size)
+    return matrix
+
+
+_DCT = _dct_matrix(PHASH_SAMPLE_SIZE)
+
+
+def phash(image: Image.Image) -> int:
+    """縮小画像の2次元DCTの低周波成分8x8が、その中央値より大きいかどうかを並べた64ビットのハッシュです。"""
+    pixels = _grayscale_pixels(image, PHASH_SAMPLE_SIZE, PHASH_SAMPLE_SIZE)
+    low_frequencies = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    median = np.median(low_frequencies.ravel()[1:]) # 直流成分(画像全体の明るさ)は除く
+    return _bits_to_int(low_frequencies > median)
+
+
+def compute_image_hashes(file_path: str) -> tuple[int, int]:
+    """画像ファイルの (dHash, pHash) を返します。"""
+    with Image.open(file_path) as image:
+        image.draft("L", (PHASH_SAMPLE_SIZE * 4, PHASH_SAMPLE_SIZE * 4)) # JPEGは縮小しながらデコードする
+        return dhash(image), phash(image)
+
+
+def to_db_hash(value: int) -> int:
+    """SQLiteのINTEGER(符号付き64ビット)に収まるよう、符号なし64ビットの値を変換します。"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def from_db_hash(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    ハミング距離で近いハッシュを探すためのBK木です。
+    三角不等式により、検索時は距離 d±max_distance の子だけをたどればよく、全件と比較せずに済みます。
+    """
+
+    def __init__(self):
+        self.root = None # (ハッシュ, 値のリスト, {距離: 子ノード})
+        self.size = 0
+
+    def add(self, hash_value: int, value):
+        self.size += 1
+        if self.root is None:
+            self.root = (hash_value, [value], {})
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(hash_value, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (hash_value, [value], {})
+                return
+            node = child
+
+    def search(self, hash_value: int, max_distance: int) -> list[tuple[int, object]]:
+        """距離 max_distance 以下の (距離, 値) を距離の近い順に返します。"""
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_hash, values, children = stack.pop()
+            distance = hamming_distance(hash_value, node_hash)
+            if distance <= max_distance:
+                results.extend((distance, value) for value in values)
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(results, key=lambda r: r[0])
+
+
+@dataclass
+class NearDuplicate:
+    """抽出結果を再利用できる類似ファイルです。"""
+    file_id: int
+    filename: str
+    ocr_list_id: int
+    distance: int # pHash のハミング距離
+
+
+class NearDuplicateStats:
+    """類似ファイルの検出と、抽出結果の再利用で省略できたAPI呼び出しを集計します。"""
+
+    def __init__(self):
+        self.checked = 0
+        self.found = 0
+        self.reused = 0
+
+    def summary_text(self) -> str:
+        return f"類似ファイル: 確認 {self.checked} 件 | 検出 {self.found} 件 | 抽出結果を再利用 {self.reused} 件 (API呼び出しを省略)"
+
+
+class NearDuplicateIndex:
+    """
+    条件ごとに、その条件でスキャン済みの画像ファイルの pHash をBK木に保持します。
+    BK木はその条件で初めて検索したときにDBから作り、以降はスキャンが完了するたびに追加します。
+    削除・再スキャンで古くなった候補は、見つかった時点でDBを確認して除外します。
+    """
+
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.trees = {} # 条件ID -> BKTree（値は (ファイルID, dHash)）
+        self._lock = threading.Lock() # 並行スキャンのスレッドが同じ条件のBK木を重複して作らないように
+
+    @staticmethod
+    def ensure_hashes(db: Session, file_obj: UploadedFile, commit: bool = True) -> bool:
+        """ハッシュ未計算（この機能より前にアップロードした）ファイルのハッシュを計算して保存します。"""
+        if file_obj.phash is not None:
+            return True
+        if file_obj.filetype.lower() not in HASHABLE_FILE_TYPES:
+            return False
+        try:
+            dhash_value, phash_value = compute_image_hashes(os.path.join(APP_BASE_DIR, file_obj.filepath))
+        except (OSError, ValueError) as e:
+            print(f"類似判定用ハッシュの計算に失敗しました ({file_obj.filename}): {e}")
+            return False
+        file_obj.dhash = to_db_hash(dhash_value)
+        file_obj.phash = to_db_hash(phash_value)
+        if commit:
+            db.commit()
+        return True
+
+    def _tree(self, db: Session, condition_id: int) -> BKTree:
+        with self._lock:
+            return self.trees.get(condition_id) or self._build_tree(db, condition_id)
+
+    def _build_tree(self, db: Session, condition_id: int) -> BKTree:
+        # この機能より前にスキャンしたファイルはハッシュがないため、最初の1回だけ計算して保存する
+        tree = BKTree()
+        scanned_with_condition = db.query(ScannedData.uploaded_file_id).filter(ScannedData.condition_id == condition_id)
+        candidates = db.query(UploadedFile).filter(
+            UploadedFile.is_scanned == True,
+            UploadedFile.filetype.in_(HASHABLE_FILE_TYPES),
+            UploadedFile.id.in_(scanned_with_condition),
+        ).all()
+        missing = [file_obj for file_obj in candidates if file_obj.phash is None]
+        for file_obj in missing:
+            self.ensure_hashes(db, file_obj, commit=False)
+        if missing:
+            db.commit()
+        for file_obj in candidates:
+            if file_obj.phash is not None:
+                tree.add(from_db_hash(file_obj.phash), (file_obj.id, from_db_hash(file_obj.dhash)))
+        self.trees[condition_id] = tree
+        return tree
+
+    def add(self, condition_id: int, file_obj: UploadedFile):
+        """スキャンが完了したファイルを、その条件の検索対象に加えます（BK木を作成済みの場合のみ）。"""
+        with self._lock:
+            tree = self.trees.get(condition_id)
+            if tree is not None and file_obj.phash is not None:
+                tree.add(from_db_hash(file_obj.phash), (file_obj.id, from_db_hash(file_obj.dhash)))
+
+    def find(self, db: Session, file_obj: UploadedFile, condition_id: int, item_names: set[str]) -> NearDuplicate | None:
+        """
+        file_obj と見た目が近く、条件のデータ項目 item_names がすべて保存済みのファイルを探します。
+        file_obj のハッシュは呼び出し前に ensure_hashes で計算しておきます。
+        """
+        if file_obj.phash is None:
+            return None
+        target_phash, target_dhash = from_db_hash(file_obj.phash), from_db_hash(file_obj.dhash)
+        for distance, (candidate_id, candidate_dhash) in self._tree(db, condition_id).search(target_phash, self.max_distance):
+            if candidate_id == file_obj.id or hamming_distance(target_dhash, candidate_dhash) > DHASH_MAX_DISTANCE:
+                continue
+            candidate = db.get(UploadedFile, candidate_id)
+            if candidate is None or not candidate.is_scanned:
+                continue
+            stored = {row.data_item_name for row in db.query(ScannedData.data_item_name).filter(
+                ScannedData.uploaded_file_id == candidate_id,
+                ScannedData.condition_id == condition_id,
+                ScannedData.page_number.is_(None),
+            ).distinct()}
+            if item_names <= stored:
+                return NearDuplicate(candidate.id, candidate.filename, candidate.ocr_list_id, distance)
+        return None
+
+    @staticmethod
+    def load_extraction(db: Session, source_file_id: int, condition_id: int, item_names: set[str]) -> dict:
+        """再利用する抽出結果 {データ項目名: 値} を読み出します。"""
+        rows = db.query(ScannedData.data_item_name, ScannedData.extracted_value).filter(
+            ScannedData.uploaded_file_id == source_file_id,
+            ScannedData.condition_id == condition_id,
+            ScannedData.page_number.is_(None),
+        ).all()
+        return {row.data_item_name: row.extracted_value for row in rows if row.data_item_name in item_names}
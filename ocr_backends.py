@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import json
+import random
+from dataclasses import dataclass
+from typing import Protocol
+import google.generativeai as genai # 標準的なエイリアスを使用
+from google.ai import generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
+from models import DataItem
+from request_packing import build_packed_prompt
+from rate_limiter import estimate_request_tokens
+
+GEMINI_MODEL_NAME = 'gemini-1.5-flash'
+FAKE_MODEL_NAME = 'fake-ocr'
+BACKEND_NAMES = ["gemini", "fake"]
+
+
+@dataclass
+class UsageMetadata:
+    """Gemini の usage_metadata と同じ属性名を持つトークン数です。"""
+    prompt_token_count: int = 0
+    candidates_token_count: int = 0
+    total_token_count: int = 0
+
+
+@dataclass
+class BackendResponse:
+    """
+    バックエンドの応答です。text はスキーマに沿ったJSON文字列で、解析は呼び出し側(ScanEngine)が行います。
+    usage_metadata はレート制限の実績トークン数の補正に使われます。
+    """
+    text: str
+    usage_metadata: object | None = None
+
+
+class BackendConfigError(Exception):
+    """APIキー未設定など、再試行しても解決しない設定上の問題です。"""
+
+
+class OcrBackend(Protocol):
+    """画像と条件のデータ項目から値を抽出するバックエンドのインターフェースです。"""
+    model_name: str # キャッシュキーやログに使う識別子
+
+    def estimate_tokens(self, image_count: int, data_items: list[DataItem]) -> int:
+        ...
+
+    async def extract_fields(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict,
+                             prompt_hint: str = "") -> BackendResponse:
+        """1件分の画像（通常は1枚、領域切り抜きのタイル送信時は複数枚）から項目を抽出します。"""
+        ...
+
+    async def extract_fields_packed(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict) -> BackendResponse:
+        ...
+
+    async def extract_fields_stream(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict,
+                                    on_text, prompt_hint: str = "") -> BackendResponse:
+        """extract_fields のストリーミング版です。応答テキストの断片を受信するたびに on_text(断片) を呼びます。"""
+        ...
+
+
+def build_prompt(data_items: list[DataItem], prompt_hint: str = "") -> str:
+    prompt_parts = [prompt_hint, "以下の画像から、次のデータ項目を抽出してください:\n"]
+    for item in data_items:
+        prompt_parts.append(f"{item.name}\n")
+    prompt_parts.append(
+        "\n抽出結果は、項目名をキー、読み取った値を文字列とするJSONオブジェクトのみで返してください。"
+        "値が読み取れない項目は null にしてください。"
+    )
+    # 例:
+    # {"請求書番号": "INV12345", "発行日": "2023-10-26", "合計金額": "10000"}
+    return "".join(prompt_parts)
+
+
+class GeminiBackend:
+    """Gemini API を使うバックエンドです。"""
+
+    def __init__(self, api_key: str, model_name: str = GEMINI_MODEL_NAME):
+        self.api_key = api_key
+        self.model_name = model_name
+        self._async_client = None
+
+    def _model(self):
+        if not self.api_key:
+            raise BackendConfigError("スキャンを実行する前にAPIキーを入力してください。")
+        # genai.configure はプロセス全体の設定を書き換えるため、異なるキーの同時スキャンが混ざらないよう
+        # バックエンドごとにこのキー専用のクライアントを作る（イベントループ上で作る必要があるため初回の呼び出し時）
+        if self._async_client is None:
+            self._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": self.api_key})
+        model = genai.GenerativeModel(self.model_name)
+        model._async_client = self._async_client # SDKにクライアントを渡す公開の方法がないため
+        return model
+
+    def estimate_tokens(self, image_count: int, data_items: list[DataItem]) -> int:
+        return estimate_request_tokens(image_count, build_prompt(data_items), 20 * len(data_items) * image_count)
+
+    async def _generate(self, contents: list, response_schema: dict, on_text=None) -> BackendResponse:
+        model = self._model()
+        # generation_config は呼び出しごとに作り直す（SDKが response_schema を変換して書き換えるため）
+        response = await model.generate_content_async(
+            contents,
+            generation_config={"response_mime_type": "application/json", "response_schema": response_schema},
+            stream=on_text is not None,
+        )
+        if on_text is not None:
+            async for chunk in response:
+                if chunk.parts:
+                    on_text(chunk.text)
+        text = ""
+        if response and hasattr(response, 'text') and response.text:
+            text = response.text
+            print(f"Geminiからの応答テキスト: {text}") # 生の応答をログ出力
+        else:
+            print("Geminiからの応答が空またはテキストがありません。")
+            if response and response.prompt_feedback:
+                print(f"プロンプトフィードバック: {response.prompt_feedback}")
+        return BackendResponse(text, getattr(response, "usage_metadata", None))
+
+    async def extract_fields(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict,
+                             prompt_hint: str = "") -> BackendResponse:
+        full_prompt = build_prompt(data_items, prompt_hint)
+        print(f"Geminiへのプロンプト: {full_prompt}") # デバッグ用にプロンプトをログ出力
+        return await self._generate([*image_parts, full_prompt], response_schema)
+
+    async def extract_fields_packed(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict) -> BackendResponse:
+        packed_prompt = build_packed_prompt(data_items, len(image_parts))
+        return await self._generate([*image_parts, packed_prompt], response_schema)
+
+    async def extract_fields_stream(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict,
+                                    on_text, prompt_hint: str = "") -> BackendResponse:
+        full_prompt = build_prompt(data_items, prompt_hint)
+        print(f"Geminiへのプロンプト(ストリーミング): {full_prompt}")
+        return await self._generate([*image_parts, full_prompt], response_schema, on_text)
+
+
+@dataclass
+class FakeBackendOptions:
+    """
+    フェイクバックエンドの振る舞いです。
+    レイテンシは対数正規分布（中央値 latency_median 秒、ばらつき latency_sigma）に従います。
+    failure_rate の確率で 503、throttle_rate の確率で 429 相当の例外を送出します。
+    missing_rate の確率で各項目の値を null にします（読み取れなかった項目の再現用）。
+    ストリーミング時は、レイテンシの first_chunk_ratio の時点で最初の断片を返し、残りを均等な間隔で返します。
+    """
+    latency_median: float = 1.0
+    latency_sigma: float = 0.5
+    failure_rate: float = 0.0
+    throttle_rate: float = 0.0
+    missing_rate: float = 0.0
+    seed: int = 0
+    tokens_per_image: int = 258
+    first_chunk_ratio: float = 0.3
+    stream_chunk_chars: int = 24
+
+
+class FakeBackend:
+    """
+    ネットワークもAPIキーも使わずに合成値を返すバックエンドです。
+    値・レイテンシ・失敗は (seed, 画像内容, その画像への呼び出し回数) から決まるため、
+    同時実行の順序に関係なく同じ入力に対して同じ結果になります。
+    スキャン処理のスループット・キューイング・DB書き込みの計測やテストに使います。
+    """
+
+    def __init__(self, options: FakeBackendOptions | None = None):
+        self.options = options or FakeBackendOptions()
+        self.model_name = FAKE_MODEL_NAME
+        self.call_count = 0
+        self._attempts_by_image = {}
+
+    def estimate_tokens(self, image_count: int, data_items: list[DataItem]) -> int:
+        return estimate_request_tokens(image_count, build_prompt(data_items), 20 * len(data_items) * image_count)
+
+    def _rng_for(self, image_parts: list[dict]) -> tuple[random.Random, str]:
+        digest = hashlib.sha256(b"".join(part["data"] for part in image_parts)).hexdigest()
+        attempt = self._attempts_by_image.get(digest, 0)
+        self._attempts_by_image[digest] = attempt + 1
+        return random.Random(f"{self.options.seed}:{digest}:{attempt}"), digest
+
+    async def _simulate_call(self, rng: random.Random, latency_ratio: float = 1.0) -> float:
+        """レイテンシの latency_ratio 分だけ待ってから、確率に応じて例外を送出します。レイテンシ全体を返します。"""
+        self.call_count += 1
+        latency = rng.lognormvariate(0, self.options.latency_sigma) * self.options.latency_median
+        roll = rng.random()
+        await asyncio.sleep(latency * latency_ratio)
+        if roll < self.options.throttle_rate:
+            raise google_exceptions.ResourceExhausted("フェイクバックエンド: クォータ超過 (429)")
+        if roll < self.options.throttle_rate + self.options.failure_rate:
+            raise google_exceptions.ServiceUnavailable("フェイクバックエンド: 一時的なエラー (503)")
+        return latency
+
+    def _synthetic_fields(self, digest: str, data_items: list[DataItem], rng: random.Random | None = None) -> dict:
+        missing_rate = self.options.missing_rate if rng is not None else 0.0
+        return {item.name: None if missing_rate and rng.random() < missing_rate else f"{item.name}-{digest[:8]}" for item in data_items}
+
+    def _usage(self, image_count: int, data_items: list[DataItem]) -> UsageMetadata:
+        prompt_tokens = image_count * self.options.tokens_per_image + len(build_prompt(data_items)) // 2
+        candidate_tokens = 10 * len(data_items) * image_count
+        return UsageMetadata(prompt_tokens, candidate_tokens, prompt_tokens + candidate_tokens)
+
+    async def extract_fields(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict,
+                             prompt_hint: str = "") -> BackendResponse:
+        rng, digest = self._rng_for(image_parts)
+        await self._simulate_call(rng)
+        text = json.dumps(self._synthetic_fields(digest, data_items, rng), ensure_ascii=False)
+        return BackendResponse(text, self._usage(len(image_parts), data_items))
+
+    async def extract_fields_packed(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict) -> BackendResponse:
+        rng, _ = self._rng_for(image_parts)
+        await self._simulate_call(rng)
+        results = {}
+        for index, part in enumerate(image_parts, start=1):
+            digest = hashlib.sha256(part["data"]).hexdigest()
+            results[str(index)] = self._synthetic_fields(digest, data_items, rng)
+        return BackendResponse(json.dumps(results, ensure_ascii=False), self._usage(len(image_parts), data_items))
+
+    async def extract_fields_stream(self, image_parts: list[dict], data_items: list[DataItem], response_schema: dict,
+                                    on_text, prompt_hint: str = "") -> BackendResponse:
+        rng, digest = self._rng_for(image_parts)
+        first_ratio = min(max(self.options.first_chunk_ratio, 0.0), 1.0)
+        latency = await self._simulate_call(rng, first_ratio)
+        text = json.dumps(self._synthetic_fields(digest, data_items, rng), ensure_ascii=False)
+        size = max(1, self.options.stream_chunk_chars)
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        interval = latency * (1.0 - first_ratio) / max(1, len(chunks) - 1)
+        for index, chunk in enumerate(chunks):
+            if index:
+                await asyncio.sleep(interval)
+            on_text(chunk)
+        return BackendResponse(text, self._usage(len(image_parts), data_items))
+
+
+def create_backend(backend_name: str, api_key: str = "", model_name: str = GEMINI_MODEL_NAME,
+                   fake_options: FakeBackendOptions | None = None) -> OcrBackend:
+    if backend_name == "fake":
+        return FakeBackend(fake_options)
+    if backend_name == "gemini":
+        return GeminiBackend(api_key, model_name)
+    raise ValueError(f"不明なバックエンドです: {backend_name}")
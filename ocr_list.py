@@ -1,5 +1,6 @@
 import flet as ft
-from models import get_db, OcrList
+from models import get_db, OcrList, UploadedFile
+from blob_store import collect_garbage, release_references
 import os
 import shutil
 
@@ -165,7 +166,10 @@ class OcrListScreen:
             db.close()
 
     def _delete_list(self, list_id: int):
-        """リストをDBから削除し、関連する物理フォルダも削除します。"""
+        """
+        リストをDBから削除し、ファイルの実体の参照数を減らします。
+        他のリストから参照されていない実体はGCで削除し、移行前のファイルが残るフォルダ(images/<リストID>)は削除します。
+        """
         list_folder_path = os.path.join(UPLOAD_BASE_DIR, str(list_id))
         db = next(self.db_context())
         try:
@@ -180,8 +184,12 @@ class OcrListScreen:
                         print(f"Error deleting directory {list_folder_path}: {e.strerror}")
                         self._show_snackbar(f"フォルダの削除中にエラー: {e.strerror}", ft.Colors.ERROR)
 
+                blob_sha256s = [row.blob_sha256 for row in db.query(UploadedFile.blob_sha256).filter(UploadedFile.ocr_list_id == list_id)]
+                release_references(db, blob_sha256s)
                 db.delete(list_to_delete)
                 db.commit()
+                gc_result = collect_garbage(db)
+                print(gc_result.summary_text())
                 self._show_snackbar(f"リスト「{list_name}」を削除しました。")
 
             if self.current_editing_list_id == list_id:
@@ -0,0 +1,25 @@
+from typing import Iterator
+import pymupdf
+
+DEFAULT_PDF_DPI = 200 # 帳票の文字を読み取るのに十分で、ページ画像が大きくなりすぎない解像度
+
+
+def count_pdf_pages(file_path: str) -> int:
+    """PDFのページ数を返します。ページ内容はデコードしません。"""
+    with pymupdf.open(file_path) as doc:
+        return doc.page_count
+
+
+def iter_pdf_page_images(file_path: str, dpi: int = DEFAULT_PDF_DPI, first_page: int = 1) -> Iterator[tuple[int, bytes]]:
+    """
+    PDFの各ページを PNG に変換し、(ページ番号(1始まり), PNGバイト列) を1ページずつ返すジェネレーターです。
+    呼び出し側が次のページを要求するまで次のページはラスタライズされないため、
+    同時にメモリ上に存在するページ画像は常に1枚だけです。
+    """
+    with pymupdf.open(file_path) as doc:
+        for page_index in range(first_page - 1, doc.page_count):
+            page = doc.load_page(page_index)
+            pixmap = page.get_pixmap(dpi=dpi)
+            png_bytes = pixmap.tobytes("png")
+            del pixmap, page
+            yield page_index + 1, png_bytes
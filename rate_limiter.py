@@ -0,0 +1,377 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+from google.api_core import exceptions as google_exceptions
+
+DEFAULT_REQUESTS_PER_MIN = 60
+DEFAULT_TOKENS_PER_MIN = 1_000_000
+DEFAULT_MAX_ATTEMPTS = 5
+IMAGE_TOKEN_ESTIMATE = 258 # Geminiが画像1枚に割り当てるおおよそのトークン数
+IMAGE_TILE_SIZE = 768 # 384px を超える画像は 768px 四方のタイルごとに IMAGE_TOKEN_ESTIMATE トークンになる
+
+# 優先度クラス。同時実行数の枠が空くと、待っているクラスの中から重みに応じた公平な順番で割り当てる
+PRIORITY_INTERACTIVE = "interactive" # スキャン画面の「スキャン実行」（1ファイル）
+PRIORITY_NORMAL = "normal" # スキャン画面の一括スキャン
+PRIORITY_BULK = "bulk" # コマンドラインなどの大量の一括スキャン
+PRIORITY_CLASSES = [PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK] # 並び順がジョブキューでの優先順位
+PRIORITY_WEIGHTS = {PRIORITY_INTERACTIVE: 16, PRIORITY_NORMAL: 4, PRIORITY_BULK: 1}
+PRIORITY_LABELS = {PRIORITY_INTERACTIVE: "対話", PRIORITY_NORMAL: "通常", PRIORITY_BULK: "一括"}
+
+# 実行中のスキャンの優先度クラス。トレースのスパンと同様に、呼び出し元のタスクから引き継がれる
+current_priority = contextvars.ContextVar("scan_priority", default=PRIORITY_NORMAL)
+
+
+@contextlib.contextmanager
+def priority_scope(priority: str):
+    """ブロック内のAPI呼び出しを priority のクラスとして扱います。"""
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+# 再試行の対象とするHTTPステータス
+THROTTLE_STATUS_CODES = {429}
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _status_code(exc: Exception) -> int | None:
+    code = getattr(exc, "code", None)
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttling_error(exc: Exception) -> bool:
+    """クォータ超過(429)かどうかを判定します。"""
+    if isinstance(exc, google_exceptions.ResourceExhausted):
+        return True
+    return _status_code(exc) in THROTTLE_STATUS_CODES
+
+
+def is_retryable_error(exc: Exception) -> bool:
+    """一時的なエラー(429・5xx・タイムアウト)かどうかを判定します。APIキー不正などは再試行しません。"""
+    if isinstance(exc, (google_exceptions.ResourceExhausted, google_exceptions.ServerError,
+                        google_exceptions.DeadlineExceeded, asyncio.TimeoutError)):
+        return True
+    return _status_code(exc) in RETRYABLE_STATUS_CODES
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """画像サイズからGeminiの画像トークン数を概算します（両辺384px以下は1枚分、それ以外は768pxタイル単位）。"""
+    if width <= IMAGE_TILE_SIZE // 2 and height <= IMAGE_TILE_SIZE // 2:
+        return IMAGE_TOKEN_ESTIMATE
+    tiles = -(-width // IMAGE_TILE_SIZE) * -(-height // IMAGE_TILE_SIZE)
+    return tiles * IMAGE_TOKEN_ESTIMATE
+
+
+def estimate_request_tokens(image_count: int, prompt: str, expected_output_tokens: int = 0) -> int:
+    """送信前にリクエストのトークン数を概算します。日本語を含むため2文字=1トークン程度で見積もります。"""
+    return image_count * IMAGE_TOKEN_ESTIMATE + len(prompt) // 2 + expected_output_tokens
+
+
+class PriorityLock:
+    """
+    待っているタスクのうち、優先度クラスの高いもの（同じクラスは到着順）から取得できるロックです。
+    レート制限の待ちで、先に同時実行数の枠を得た一括スキャンの後ろに対話的なスキャンが並ばないようにします。
+    """
+
+    def __init__(self):
+        self._locked = False
+        self._waiters = [] # (クラスの順位, 到着順, Future) のヒープ
+        self._arrivals = itertools.count()
+
+    def locked(self) -> bool:
+        return self._locked
+
+    async def acquire(self):
+        if not self._locked and not self._waiters:
+            self._locked = True
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (PRIORITY_CLASSES.index(current_priority.get()), next(self._arrivals), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() # ロックを渡された直後に取り消された
+            else:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+    def release(self):
+        # 待っているタスクがあれば、ロックを解放せずにそのまま渡す
+        while self._waiters:
+            future = heapq.heappop(self._waiters)[2]
+            if not future.cancelled():
+                future.set_result(None)
+                return
+        self._locked = False
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class TokenBucket:
+    """1分あたり rate_per_min 個ずつ補充されるトークンバケットです。"""
+
+    def __init__(self, rate_per_min: float, capacity: float | None = None):
+        self.rate_per_sec = rate_per_min / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_min
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = PriorityLock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_sec)
+        self.updated_at = now
+
+    def set_rate(self, rate_per_min: float):
+        self._refill()
+        self.rate_per_sec = rate_per_min / 60.0
+        self.capacity = rate_per_min
+        self.tokens = min(self.tokens, self.capacity)
+
+    async def acquire(self, amount: float = 1.0) -> float:
+        """amount 個のトークンを取得できるまで待機します。待機した秒数を返します。"""
+        amount = min(amount, self.capacity) # バケット容量を超える要求は容量分だけ待つ
+        waited = 0.0
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                wait_seconds = (amount - self.tokens) / self.rate_per_sec
+                waited += wait_seconds
+                await asyncio.sleep(wait_seconds)
+
+    def try_acquire(self, amount: float = 1.0) -> bool:
+        """待たずに取得できる場合だけ amount 個のトークンを取得します。"""
+        if self._lock.locked(): # 待機中の取得を追い越さない
+            return False
+        self._refill()
+        if self.tokens < min(amount, self.capacity):
+            return False
+        self.tokens -= min(amount, self.capacity)
+        return True
+
+    def adjust(self, delta: float):
+        """見積もりと実績の差分を反映します（負の残量も許容し、以降の取得が待たされます）。"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD方式で同時実行数を調整するリミッターです。
+    成功が続くと上限を少しずつ増やし(加算的増加)、スロットリングを受けると半分に減らします(乗算的減少)。
+    枠が埋まっている間の待ちは優先度クラスごとに並べ、枠が空くと重み付き公平キューイングで次のクラスを選びます。
+    各クラスの仮想時刻を割り当てのたびに 1/重み ずつ進め、最も早く終わるクラスから割り当てるため、
+    重みの大きい対話的なスキャンは一括スキャンの待ち行列を追い越しますが、一括スキャンが止まり続けることはありません。
+    """
+
+    def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 16):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self._waiters = {priority: deque() for priority in PRIORITY_CLASSES}
+        self._virtual_times = {priority: 0.0 for priority in PRIORITY_CLASSES}
+        self._virtual_clock = 0.0
+        self.dispatched = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.wait_seconds = {priority: 0.0 for priority in PRIORITY_CLASSES}
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.minimum, int(self.limit))
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def set_maximum(self, maximum: int):
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(self.limit, self.maximum)
+        self._dispatch()
+
+    def _finish_tag(self, priority: str) -> float:
+        # しばらく待ちのなかったクラスは現在の仮想時刻から数える（過去の空き時間をまとめて使わせない）
+        return max(self._virtual_times[priority], self._virtual_clock) + 1.0 / PRIORITY_WEIGHTS[priority]
+
+    def _grant(self, priority: str, waited: float):
+        start = max(self._virtual_times[priority], self._virtual_clock)
+        self._virtual_times[priority] = start + 1.0 / PRIORITY_WEIGHTS[priority]
+        self._virtual_clock = start
+        self.in_flight += 1
+        self.dispatched[priority] += 1
+        self.wait_seconds[priority] += waited
+
+    def _dispatch(self):
+        while self.in_flight < self.current_limit:
+            candidates = [priority for priority in PRIORITY_CLASSES if self._waiters[priority]]
+            if not candidates:
+                return
+            priority = min(candidates, key=self._finish_tag)
+            future, queued_at = self._waiters[priority].popleft()
+            if future.cancelled():
+                continue
+            self._grant(priority, time.monotonic() - queued_at)
+            future.set_result(None)
+
+    async def acquire(self, priority: str | None = None):
+        priority = priority or current_priority.get()
+        if self.in_flight < self.current_limit and not self.waiting:
+            self._grant(priority, 0.0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, time.monotonic())
+        self._waiters[priority].append(entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release_nowait() # 枠を割り当てた直後に取り消された
+            else:
+                self._waiters[priority].remove(entry)
+            raise
+
+    def release_nowait(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    async def release(self):
+        self.release_nowait()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+    def wait_summary_text(self) -> str:
+        """優先度クラスごとの、同時実行数の枠を待った平均時間です。"""
+        return " / ".join(
+            f"{PRIORITY_LABELS[priority]} {self.wait_seconds[priority] / self.dispatched[priority]:.2f}秒"
+            for priority in PRIORITY_CLASSES if self.dispatched[priority]
+        )
+
+    def on_success(self):
+        # 上限まで埋まっている状態で成功が limit 回続くと +1 になる
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        self._dispatch()
+
+    def on_throttle(self):
+        self.limit = max(self.minimum, self.limit / 2)
+
+
+class RetryPolicy:
+    """指数バックオフ + フルジッターの再試行ポリシーです。"""
+
+    def __init__(self, max_attempts: int = DEFAULT_MAX_ATTEMPTS, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff_delay(self, attempt: int) -> float:
+        """attempt 回目(1始まり)の失敗後に待つ秒数です。"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+
+class GeminiThrottle:
+    """
+    リクエスト数/分・トークン数/分のレート制限、AIMDによる同時実行数制御、再試行をまとめたものです。
+    スキャン画面に表示するための統計も保持します。
+    """
+
+    def __init__(self, requests_per_min: int = DEFAULT_REQUESTS_PER_MIN, tokens_per_min: int = DEFAULT_TOKENS_PER_MIN,
+                 max_concurrency: int = 16, retry_policy: RetryPolicy | None = None):
+        self.request_bucket = TokenBucket(requests_per_min)
+        self.token_bucket = TokenBucket(tokens_per_min)
+        self.concurrency = AdaptiveConcurrencyLimiter(maximum=max_concurrency)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.throttled_count = 0
+        self.retry_count = 0
+        self.rate_wait_seconds = 0.0
+        self.backoff_until = 0.0
+
+    def configure(self, requests_per_min: int, tokens_per_min: int, max_concurrency: int):
+        self.request_bucket.set_rate(requests_per_min)
+        self.token_bucket.set_rate(tokens_per_min)
+        self.concurrency.set_maximum(max_concurrency)
+
+    async def call(self, request_factory, estimated_tokens: int, on_state_change=None):
+        """
+        request_factory() が返すコルーチンを、レート制限・同時実行数制限の下で実行します。
+        一時的なエラーは指数バックオフで再試行し、最終的に失敗した場合は最後の例外を送出します。
+        応答に usage_metadata があれば、見積もりトークン数との差分をバケットに反映します。
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            async with self.concurrency:
+                self.rate_wait_seconds += await self.request_bucket.acquire(1)
+                self.rate_wait_seconds += await self.token_bucket.acquire(estimated_tokens)
+                if on_state_change: on_state_change()
+                try:
+                    response = await request_factory()
+                except Exception as e:
+                    if is_throttling_error(e):
+                        self.throttled_count += 1
+                        self.concurrency.on_throttle()
+                    if attempt >= self.retry_policy.max_attempts or not is_retryable_error(e):
+                        if on_state_change: on_state_change()
+                        raise
+                    delay = self.retry_policy.backoff_delay(attempt)
+                else:
+                    self.concurrency.on_success()
+                    usage = getattr(response, "usage_metadata", None)
+                    actual_tokens = getattr(usage, "total_token_count", None) if usage else None
+                    if actual_tokens:
+                        self.token_bucket.adjust(actual_tokens - estimated_tokens)
+                    if on_state_change: on_state_change()
+                    return response
+
+            # スロットを解放してからバックオフする（待機中に他のリクエストの枠を塞がない）
+            self.retry_count += 1
+            self.backoff_until = max(self.backoff_until, time.monotonic() + delay)
+            print(f"Gemini API 一時エラーのため {delay:.1f} 秒後に再試行します ({attempt}/{self.retry_policy.max_attempts})")
+            if on_state_change: on_state_change()
+            await asyncio.sleep(delay)
+
+    def try_acquire(self, estimated_tokens: int) -> bool:
+        """
+        レート制限の枠が空いていれば、待たずに1リクエスト分を取得します（ヘッジの重複リクエスト用）。
+        重複リクエストは同時実行数の枠を使わず、レート制限の枠だけを消費します。
+        """
+        if time.monotonic() < self.backoff_until or not self.request_bucket.try_acquire(1):
+            return False
+        if not self.token_bucket.try_acquire(estimated_tokens):
+            self.request_bucket.adjust(-1)
+            return False
+        return True
+
+    def summary_text(self) -> str:
+        backoff_remaining = max(0.0, self.backoff_until - time.monotonic())
+        state = f"バックオフ中 ({backoff_remaining:.0f}秒)" if backoff_remaining > 0 else "通常"
+        text = (
+            f"API制御: {state} | 同時実行 {self.concurrency.in_flight}/{self.concurrency.current_limit} (待ち {self.concurrency.waiting})"
+            f" | 429 {self.throttled_count} 回 | 再試行 {self.retry_count} 回 | レート待機 {self.rate_wait_seconds:.1f}秒"
+        )
+        wait_text = self.concurrency.wait_summary_text()
+        return f"{text} | 枠待ち平均 {wait_text}" if wait_text else text
@@ -0,0 +1,44 @@
+from models import DataItem
+
+DEFAULT_PACK_SIZE = 4
+MAX_PACK_SIZE = 16
+
+
+def build_packed_prompt(data_items: list[DataItem], image_count: int) -> str:
+    """複数画像を1リクエストで送るためのプロンプトです。結果は画像の番号(1始まり)をキーにしたJSONで返させます。"""
+    prompt_parts = [f"{image_count} 枚の画像が順番に添付されています。各画像から、次のデータ項目を抽出してください:\n"]
+    for item in data_items:
+        prompt_parts.append(f"{item.name}\n")
+    prompt_parts.append(
+        "\n抽出結果は、画像の番号（1から始まる添付順）を文字列のキー、"
+        "{\"項目名\": \"値\"} のオブジェクトを値とするJSONオブジェクトのみで返してください。"
+        f"キーは \"1\" から \"{image_count}\" まですべて含めてください。"
+        "値が読み取れない項目は null にしてください。"
+    )
+    return "".join(prompt_parts)
+
+
+class PackingStats:
+    """まとめ送信によって削減できたAPI呼び出し回数を集計します。"""
+
+    def __init__(self):
+        self.packed_calls = 0
+        self.packed_files = 0
+        self.fallback_files = 0
+
+    def record_packed_call(self, file_count: int):
+        self.packed_calls += 1
+        self.packed_files += file_count
+
+    def record_fallback(self, file_count: int):
+        self.fallback_files += file_count
+
+    @property
+    def calls_saved(self) -> int:
+        return self.packed_files - self.packed_calls
+
+    def summary_text(self) -> str:
+        return (
+            f"まとめ送信: {self.packed_calls} 回で {self.packed_files} 件 (削減 {self.calls_saved} 回)"
+            f" / 個別送信へ切替 {self.fallback_files} 件"
+        )
@@ -0,0 +1,167 @@
+import json
+from collections import OrderedDict
+from models import DataItem
+from scan_cache import condition_fingerprint
+
+SCHEMA_CACHE_SIZE = 64
+
+
+def build_response_schema(data_items: list[DataItem]) -> dict:
+    """
+    条件のデータ項目から、1枚分の応答のJSONスキーマ（Gemini の response_schema 形式）を生成します。
+    項目名はプロパティ名としてそのまま使うため、コロンなどを含む項目名も壊れません。
+    """
+    return {
+        "type": "object",
+        "properties": {item.name: {"type": "string", "nullable": True} for item in data_items},
+        "required": [item.name for item in data_items],
+    }
+
+
+def build_packed_response_schema(data_items: list[DataItem], image_count: int) -> dict:
+    """まとめ送信用のスキーマです。画像の番号("1"〜"n")をキーに、1枚分のスキーマを並べます。"""
+    item_schema = build_response_schema(data_items)
+    keys = [str(index) for index in range(1, image_count + 1)]
+    return {
+        "type": "object",
+        "properties": {key: item_schema for key in keys},
+        "required": keys,
+    }
+
+
+def _strip_code_fence(text: str) -> str:
+    # response_schema 指定時は素のJSONが返るが、念のためコードブロックで囲まれた応答も受け付ける
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        if text.rstrip().endswith("```"):
+            text = text.rstrip()[:-3]
+    return text.strip()
+
+
+class ResponseParseError(ValueError):
+    """応答がスキーマに合わない場合のエラーです。reason は統計の分類に使います。"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class ResponseValidator:
+    """
+    条件ごとに事前に組み立てておく応答の検証器です。
+    項目名→データ項目の辞書を持つため、応答の各キーの照合は項目数によらず O(1) です。
+    """
+
+    def __init__(self, data_items: list[DataItem]):
+        self.items_by_name = {item.name: item for item in data_items}
+        self.schema = build_response_schema(data_items)
+        self._packed_schemas = {}
+
+    def packed_schema(self, image_count: int) -> dict:
+        schema = self._packed_schemas.get(image_count)
+        if schema is None:
+            schema = build_packed_response_schema(list(self.items_by_name.values()), image_count)
+            self._packed_schemas[image_count] = schema
+        return schema
+
+    def validate_object(self, payload) -> tuple[dict, int]:
+        """
+        1枚分のオブジェクトを {データ項目名: 値} に変換します。
+        戻り値の2番目は欠けていた項目の数です（スキーマ上は必須ですが、欠けても失敗にはしません）。
+        """
+        if not isinstance(payload, dict):
+            raise ResponseParseError("not_object", "応答がJSONオブジェクトではありません。")
+        extracted = {}
+        for key, value in payload.items():
+            if key not in self.items_by_name:
+                print(f"警告: プロンプトにない項目名「{key}」が応答に含まれています。スキップします。")
+                continue
+            if value is None:
+                continue
+            if not isinstance(value, (str, int, float, bool)):
+                raise ResponseParseError("type_mismatch", f"項目「{key}」の値が文字列ではありません: {value!r}")
+            extracted[key] = str(value)
+        return extracted, len(self.items_by_name) - len(extracted)
+
+    def parse(self, text: str) -> tuple[dict, int]:
+        """1枚分の応答テキストを検証して {データ項目名: 値} と欠けた項目数を返します。"""
+        return self.validate_object(self._load(text))
+
+    def parse_packed(self, text: str, image_count: int) -> tuple[dict[int, dict], int]:
+        """まとめ送信の応答テキストを {画像番号: {データ項目名: 値}} と欠けた項目数の合計に変換します。"""
+        payload = self._load(text)
+        if not isinstance(payload, dict):
+            raise ResponseParseError("not_object", "応答がJSONオブジェクトではありません。")
+        results = {}
+        missing_total = 0
+        for index in range(1, image_count + 1):
+            if str(index) not in payload:
+                raise ResponseParseError("missing_image", f"画像 {index} の結果が応答に含まれていません。")
+            results[index], missing = self.validate_object(payload[str(index)])
+            missing_total += missing
+        return results, missing_total
+
+    @staticmethod
+    def _load(text: str):
+        try:
+            return json.loads(_strip_code_fence(text))
+        except ValueError as e:
+            raise ResponseParseError("invalid_json", f"応答をJSONとして解析できません: {e}") from e
+
+
+class ResponseSchemaCache:
+    """
+    ResponseValidator を条件のバージョン（データ項目の構成のフィンガープリント）ごとに保持します。
+    データ項目を追加・削除・並び替えるとフィンガープリントが変わり、次のスキャンで組み立て直されます。
+    """
+
+    def __init__(self, max_entries: int = SCHEMA_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._validators: OrderedDict[str, ResponseValidator] = OrderedDict()
+        self.builds = 0
+
+    def get(self, data_items: list[DataItem]) -> ResponseValidator:
+        version = condition_fingerprint(data_items)
+        validator = self._validators.get(version)
+        if validator is None:
+            validator = ResponseValidator(data_items)
+            self.builds += 1
+            self._validators[version] = validator
+            while len(self._validators) > self.max_entries:
+                self._validators.popitem(last=False)
+        else:
+            self._validators.move_to_end(version)
+        return validator
+
+
+class ParseStats:
+    """構造化出力の解析結果を集計します。"""
+
+    def __init__(self):
+        self.parsed = 0
+        self.failures = {} # reason -> 件数
+        self.missing_fields = 0
+
+    def record_success(self, missing_fields: int = 0):
+        self.parsed += 1
+        self.missing_fields += missing_fields
+
+    def record_failure(self, reason: str):
+        self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    @property
+    def failure_count(self) -> int:
+        return sum(self.failures.values())
+
+    @property
+    def failure_rate(self) -> float:
+        total = self.parsed + self.failure_count
+        return self.failure_count / total if total else 0.0
+
+    def summary_text(self) -> str:
+        detail = ", ".join(f"{reason} {count}" for reason, count in sorted(self.failures.items()))
+        return (
+            f"応答解析: 成功 {self.parsed} / 失敗 {self.failure_count} (失敗率 {self.failure_rate:.1%})"
+            f" | 欠落項目 {self.missing_fields}" + (f" | {detail}" if detail else "")
+        )
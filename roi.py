@@ -0,0 +1,184 @@
+import io
+from dataclasses import dataclass, field
+from PIL import Image, ImageOps
+from models import DataItem
+from image_preprocess import fit_size_to_pixel_budget
+from rate_limiter import estimate_image_tokens
+
+ROI_LAYOUT_COLLAGE = "collage" # 切り抜いた領域を縦に並べた1枚の画像にして送信
+ROI_LAYOUT_TILES = "tiles" # 切り抜いた領域をそれぞれ別の画像として1リクエストで送信
+ROI_LAYOUTS = [ROI_LAYOUT_COLLAGE, ROI_LAYOUT_TILES]
+COLLAGE_GAP = 16 # コラージュ内の領域の間に入れる余白(px)
+
+
+def parse_roi(text: str | None) -> tuple[float, float, float, float] | None:
+    """
+    "x0,y0,x1,y1"（画像の幅・高さに対する 0〜1 の割合、左上が原点）を読み取ります。
+    空文字・None は「領域なし」として None を返し、不正な値は ValueError を送出します。
+    """
+    if text is None or not text.strip():
+        return None
+    parts = [part.strip() for part in text.replace("、", ",").split(",")]
+    if len(parts) != 4:
+        raise ValueError(f"領域は「x0,y0,x1,y1」の4つの数値で指定してください: {text}")
+    try:
+        x0, y0, x1, y1 = (float(part) for part in parts)
+    except ValueError:
+        raise ValueError(f"領域の値が数値ではありません: {text}") from None
+    if not (0.0 <= x0 < x1 <= 1.0 and 0.0 <= y0 < y1 <= 1.0):
+        raise ValueError(f"領域は 0〜1 の範囲で、x0<x1・y0<y1 となるように指定してください: {text}")
+    return (x0, y0, x1, y1)
+
+
+def format_roi(box: tuple[float, float, float, float] | None) -> str:
+    if box is None:
+        return ""
+    return ",".join(f"{value:g}" for value in box)
+
+
+@dataclass
+class RoiPlan:
+    """条件のデータ項目ごとの領域を、重複を除いた切り抜き領域のリストにまとめたものです。"""
+    boxes: list[tuple[float, float, float, float]]
+    item_names_by_box: list[list[str]]
+    layout: str = ROI_LAYOUT_COLLAGE
+
+    @property
+    def signature(self) -> str:
+        """キャッシュキーに含める識別子です。領域や並べ方が変わると別の結果として扱います。"""
+        return f"{self.layout}:" + ";".join(format_roi(box) for box in self.boxes)
+
+    def prompt_hint(self) -> str:
+        regions = [f"{index}: {'、'.join(names)}" for index, names in enumerate(self.item_names_by_box, start=1)]
+        if self.layout == ROI_LAYOUT_TILES:
+            header = "添付画像は帳票から各データ項目の領域を切り抜いたもので、添付順に次の項目を含みます:\n"
+        else:
+            header = "画像は帳票から各データ項目の領域を切り抜き、上から順に並べたもので、次の項目を含みます:\n"
+        return header + "\n".join(regions) + "\n"
+
+
+def plan_regions(data_items: list[DataItem], condition_roi: str | None = None, layout: str | None = None) -> RoiPlan | None:
+    """
+    データ項目の領域（未指定の項目は条件の領域）から切り抜き計画を作ります。
+    領域が決まらない項目が1つでもある場合は、ページ全体を送る必要があるため None を返します。
+    """
+    if not data_items:
+        return None
+    default_box = parse_roi(condition_roi)
+    boxes = []
+    item_names_by_box = []
+    for item in data_items:
+        box = parse_roi(getattr(item, "roi", None)) or default_box
+        if box is None:
+            return None
+        if box in boxes:
+            item_names_by_box[boxes.index(box)].append(item.name)
+        else:
+            boxes.append(box)
+            item_names_by_box.append([item.name])
+    return RoiPlan(boxes, item_names_by_box, layout if layout in ROI_LAYOUTS else ROI_LAYOUT_COLLAGE)
+
+
+@dataclass
+class RoiCropResult:
+    images: list[bytes] # PNG
+    full_pixels: int
+    sent_pixels: int
+    full_tokens: int
+    sent_tokens: int
+
+
+def _pixel_box(box: tuple[float, float, float, float], size: tuple[int, int]) -> tuple[int, int, int, int]:
+    width, height = size
+    x0, y0, x1, y1 = box
+    left, top = int(x0 * width), int(y0 * height)
+    return (left, top, max(left + 1, round(x1 * width)), max(top + 1, round(y1 * height)))
+
+
+def _encode_png(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def crop_regions(image_bytes: bytes, plan: RoiPlan, max_pixels: int = 0) -> RoiCropResult:
+    """
+    計画に従って画像から領域を切り抜き、送信する画像（コラージュ1枚、またはタイルごとの画像）を返します。
+    max_pixels には送信前の縮小の上限を渡し、ページ全体を送った場合との画素数・トークン数の差を見積もります。
+    """
+    with Image.open(io.BytesIO(image_bytes)) as opened:
+        image = ImageOps.exif_transpose(opened)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        full_size = fit_size_to_pixel_budget(image.size, max_pixels)
+        crops = [image.crop(_pixel_box(box, image.size)) for box in plan.boxes]
+
+    if plan.layout == ROI_LAYOUT_TILES:
+        outputs = crops
+    else:
+        width = max(crop.width for crop in crops)
+        height = sum(crop.height for crop in crops) + COLLAGE_GAP * (len(crops) - 1)
+        collage = Image.new(crops[0].mode, (width, height), "white")
+        top = 0
+        for crop in crops:
+            collage.paste(crop, (0, top))
+            top += crop.height + COLLAGE_GAP
+        outputs = [collage]
+
+    sent_sizes = [fit_size_to_pixel_budget(output.size, max_pixels) for output in outputs]
+    return RoiCropResult(
+        images=[_encode_png(output) for output in outputs],
+        full_pixels=full_size[0] * full_size[1],
+        sent_pixels=sum(w * h for w, h in sent_sizes),
+        full_tokens=estimate_image_tokens(*full_size),
+        sent_tokens=sum(estimate_image_tokens(w, h) for w, h in sent_sizes),
+    )
+
+
+@dataclass
+class RoiUsage:
+    """1ファイル分（PDFは全ページ分）の、ページ全体を送った場合と比べた画素数・トークン数です。"""
+    full_pixels: int = 0
+    sent_pixels: int = 0
+    full_tokens: int = 0
+    sent_tokens: int = 0
+
+    def add(self, result: RoiCropResult):
+        self.full_pixels += result.full_pixels
+        self.sent_pixels += result.sent_pixels
+        self.full_tokens += result.full_tokens
+        self.sent_tokens += result.sent_tokens
+
+    @property
+    def pixels_saved(self) -> int:
+        return self.full_pixels - self.sent_pixels
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.full_tokens - self.sent_tokens
+
+    def summary_text(self) -> str:
+        pixel_ratio = self.pixels_saved / self.full_pixels if self.full_pixels else 0.0
+        return (
+            f"画素 {self.full_pixels:,} → {self.sent_pixels:,} (削減 {pixel_ratio:.0%})"
+            f" / 画像トークン {self.full_tokens:,} → {self.sent_tokens:,} (削減 {self.tokens_saved:,})"
+        )
+
+
+@dataclass
+class RoiStats:
+    """領域切り抜きで削減できた画素数・トークン数の累計です。"""
+    files: int = 0
+    total: RoiUsage = field(default_factory=RoiUsage)
+
+    def record(self, usage: RoiUsage):
+        if not usage.full_pixels:
+            return
+        self.files += 1
+        self.total.full_pixels += usage.full_pixels
+        self.total.sent_pixels += usage.sent_pixels
+        self.total.full_tokens += usage.full_tokens
+        self.total.sent_tokens += usage.sent_tokens
+
+    def summary_text(self) -> str:
+        return f"領域切り抜き: {self.files} 件 | " + self.total.summary_text()
@@ -1,14 +1,59 @@
 import flet as ft
-from models import get_db, OcrList, Condition, UploadedFile, ScannedData, DataItem
+from models import get_db, OcrList, Condition, UploadedFile, ScannedData
 from sqlalchemy.orm import joinedload
 import os
+from scan_engine import (
+    ScanEngine, ScanSettings, ScanProgressListener, ScanOutcome, BatchSummary,
+    APP_BASE_DIR, DEFAULT_BATCH_CONCURRENCY, MAX_BATCH_CONCURRENCY,
+)
+from request_packing import DEFAULT_PACK_SIZE, MAX_PACK_SIZE
+from rate_limiter import DEFAULT_REQUESTS_PER_MIN, DEFAULT_TOKENS_PER_MIN, PRIORITY_INTERACTIVE
+from hedging import DEFAULT_MAX_HEDGE_RATE
+from api_keys import ApiKeyConfig, load_api_keys
+from image_preprocess import PreprocessOptions, DEFAULT_MAX_PIXELS, DEFAULT_QUALITY
+from ocr_backends import BACKEND_NAMES
+from near_duplicates import NearDuplicate
+from tracing import DEFAULT_TRACE_HISTORY, TRACE_FORMATS, TRACE_FORMAT_CHROME
+from thumbnails import SIZE_LIST, SIZE_PREVIEW, THUMBNAIL_FILE_TYPES, thumbnail_cache, thumbnail_key
 import datetime
-import google.generativeai as genai # 標準的なエイリアスを使用
-import time # シミュレーション用
-# 非同期処理（シミュレートされたAPI呼び出しなど）に必要
-import asyncio
 
-APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRACE_EXPORT_DIR = "traces" # トレースの書き出し先 (APP_BASE_DIR からの相対パス)
+
+
+class ScanScreenProgress(ScanProgressListener):
+    """ScanEngine の進捗通知をスキャン画面のコントロールに反映します。"""
+
+    def __init__(self, screen: "ScanScreen"):
+        self.screen = screen
+
+    def on_file_started(self, file_id: int):
+        self.screen.live_fields.pop(file_id, None)
+        self.screen._set_file_row_state(file_id, "スキャン中...", scan_enabled=False)
+
+    def on_file_status(self, file_id: int, message: str):
+        self.screen._set_file_row_state(file_id, message)
+
+    def on_field_extracted(self, file_id: int, page_number: int | None, item_name: str, value: str | None):
+        self.screen._show_live_field(file_id, page_number, item_name, value)
+
+    def on_file_finished(self, outcome: ScanOutcome):
+        self.screen.live_fields.pop(outcome.file_id, None)
+        if outcome.succeeded:
+            self.screen._mark_file_scanned(outcome.file_id)
+        else:
+            # エラー時は再試行可能に
+            self.screen._set_file_row_state(outcome.file_id, "抽出失敗", scan_enabled=True)
+
+    def on_batch_progress(self, summary: BatchSummary):
+        self.screen._update_batch_progress(summary)
+
+    def on_stats_changed(self):
+        self.screen._refresh_stats_texts()
+
+    def on_error(self, message: str):
+        self.screen.page.snack_bar = ft.SnackBar(ft.Text(message), open=True, bgcolor=ft.Colors.ERROR)
+        if self.screen.page: self.screen.page.update()
+
 
 class ScanScreen:
     def __init__(self, page: ft.Page):
@@ -17,14 +62,28 @@ class ScanScreen:
         self.selected_ocr_list_id = None
         self.selected_condition_id = None
 
+        # スキャン処理本体（UI非依存）。キャッシュ・前処理・まとめ送信・API制御の統計もここで保持する
+        self.scan_engine = ScanEngine(listener=ScanScreenProgress(self), db_context=self.db_context)
+
+        # 環境変数 GEMINI_API_KEYS・api_keys.json のキー。入力欄のキーと合わせて、複数あればキーごとのクォータで振り分ける
+        self.api_key_configs = load_api_keys()
+
         # --- UIコントロール ---
         self.api_key_field = ft.TextField(
             label="API Key",
-            hint_text="Gemini APIキーを入力してください",
+            hint_text=f"設定済みのキー {len(self.api_key_configs)} 件に加えて使うキー（省略可）" if self.api_key_configs
+            else "Gemini APIキーを入力してください",
             password=True,
             can_reveal_password=True,
             expand=True,
         )
+        # "fake" はAPIを呼ばずに合成値を返す計測・動作確認用のバックエンド
+        self.backend_dropdown = ft.Dropdown(
+            label="バックエンド",
+            options=[ft.dropdown.Option(name) for name in BACKEND_NAMES],
+            value="gemini",
+            width=140,
+        )
         self.ocr_list_dropdown = ft.Dropdown(
             hint_text="OCRリストを選択",
             options=[],
@@ -41,6 +100,156 @@ class ScanScreen:
 
         self.files_list_view = ft.ListView(expand=True, spacing=5, auto_scroll=True)
         self.file_scan_status_texts = {} # スキャンボタンのテキスト更新または進捗表示用
+        self.file_scan_buttons = {} # file_id -> スキャンボタン
+        self.live_fields = {} # file_id -> ストリーミング受信中の [(ページ番号, 項目名, 値)]
+        self.preview_file_id = None # プレビューダイアログに表示中のファイル
+        self.live_fields_column = ft.Column([], spacing=5)
+        self.live_fields_section = ft.Column([
+            ft.Text("受信中の値（保存前）", weight=ft.FontWeight.BOLD, size=14),
+            self.live_fields_column,
+            ft.Divider(height=5),
+        ], visible=False)
+
+        # --- 一括スキャン用コントロール ---
+        self.batch_running = False
+        self.concurrency_field = ft.TextField(
+            label="最大同時実行数",
+            value=str(DEFAULT_BATCH_CONCURRENCY),
+            width=120,
+            keyboard_type=ft.KeyboardType.NUMBER,
+        )
+        self.batch_scan_button = ft.ElevatedButton(
+            "未スキャンを一括スキャン",
+            icon=ft.Icons.PLAYLIST_PLAY,
+            on_click=self._on_batch_scan_click,
+        )
+        self.batch_cancel_button = ft.OutlinedButton(
+            "停止",
+            icon=ft.Icons.STOP,
+            on_click=self._on_batch_cancel_click,
+            disabled=True,
+        )
+        # スキャン済みファイルは、条件に後から追加したデータ項目だけを抽出して追記する
+        self.incremental_checkbox = ft.Checkbox(label="追加された項目のみ抽出", value=False,
+                                                tooltip="スキャン済みファイルの未保存の項目だけをAPIに要求し、既存の値は変更しません")
+        self.incremental_stats_text = ft.Text(self.scan_engine.incremental_stats.summary_text(), size=12, color=ft.Colors.BLACK54)
+        # データ設定で読み取り領域を指定した条件の、ページ全体を送った場合と比べた削減量
+        self.roi_stats_text = ft.Text(self.scan_engine.roi_stats.summary_text(), size=12, color=ft.Colors.BLACK54)
+        # 撮り直し・再スキャンなど見た目がほぼ同じスキャン済み画像があれば、APIを呼ばずにその抽出結果を使う
+        self.reuse_near_duplicates_checkbox = ft.Checkbox(label="類似画像の抽出結果を再利用", value=False,
+                                                          tooltip="単体スキャンでは確認してから、一括スキャンでは自動で再利用します")
+        self.near_duplicate_stats_text = ft.Text(self.scan_engine.near_duplicate_stats.summary_text(), size=12, color=ft.Colors.BLACK54)
+        # 前回の起動時に中断した一括スキャン(scan_jobs の未完了ジョブ)の再開
+        self.resume_jobs_button = ft.OutlinedButton(
+            "中断したスキャンを再開",
+            icon=ft.Icons.RESTORE,
+            on_click=self._on_resume_jobs_click,
+            visible=False,
+        )
+        self.batch_progress_bar = ft.ProgressBar(value=0, visible=False)
+        self.batch_progress_text = ft.Text("")
+
+        # 同一画像の再スキャンでAPIを呼ばないための抽出結果キャッシュ
+        self.cache_stats_text = ft.Text(self.scan_engine.result_cache.summary_text(), size=12, color=ft.Colors.BLACK54)
+
+        # --- 送信前の画像処理（縮小・EXIF除去・グレースケール・再エンコード） ---
+        self.preprocess_enabled_checkbox = ft.Checkbox(label="送信前に画像を縮小・再エンコード", value=True)
+        self.max_megapixels_field = ft.TextField(
+            label="最大画素数(MP)",
+            value=str(DEFAULT_MAX_PIXELS / 1_000_000),
+            width=140,
+            keyboard_type=ft.KeyboardType.NUMBER,
+        )
+        self.grayscale_checkbox = ft.Checkbox(label="グレースケール", value=False)
+        self.output_format_dropdown = ft.Dropdown(
+            label="形式",
+            options=[ft.dropdown.Option("JPEG"), ft.dropdown.Option("WEBP")],
+            value="JPEG",
+            width=120,
+        )
+        self.quality_field = ft.TextField(
+            label="品質",
+            value=str(DEFAULT_QUALITY),
+            width=90,
+            keyboard_type=ft.KeyboardType.NUMBER,
+        )
+        self.preprocess_stats_text = ft.Text(self.scan_engine.preprocess_stats.summary_text(), size=12, color=ft.Colors.BLACK54)
+
+        # --- まとめ送信（同じ条件の画像をK枚ずつ1リクエストで送信、一括スキャン時のみ） ---
+        self.packing_checkbox = ft.Checkbox(label="複数画像をまとめて送信", value=False)
+        # ストリーミング（値が確定した項目から順にファイル行・プレビューへ表示）
+        self.streaming_checkbox = ft.Checkbox(label="ストリーミングで受信した項目から表示", value=False)
+        self.streaming_stats_text = ft.Text(self.scan_engine.streaming_stats.summary_text(), size=12, color=ft.Colors.BLACK54)
+        self.pack_size_field = ft.TextField(
+            label="1回あたりの枚数",
+            value=str(DEFAULT_PACK_SIZE),
+            width=140,
+            keyboard_type=ft.KeyboardType.NUMBER,
+        )
+        self.packing_stats_text = ft.Text(self.scan_engine.packing_stats.summary_text(), size=12, color=ft.Colors.BLACK54)
+
+        # 構造化出力(JSONスキーマ)の解析成功・失敗の件数
+        self.parse_stats_text = ft.Text(self.scan_engine.parse_stats.summary_text(), size=12, color=ft.Colors.BLACK54)
+
+        # --- レート制限・再試行・同時実行数の自動調整（単体スキャン・一括スキャン共通） ---
+        self.requests_per_min_field = ft.TextField(
+            label="リクエスト/分",
+            value=str(DEFAULT_REQUESTS_PER_MIN),
+            width=130,
+            keyboard_type=ft.KeyboardType.NUMBER,
+        )
+        self.tokens_per_min_field = ft.TextField(
+            label="トークン/分",
+            value=str(DEFAULT_TOKENS_PER_MIN),
+            width=150,
+            keyboard_type=ft.KeyboardType.NUMBER,
+        )
+        self.throttle_status_text = ft.Text(self.scan_engine.throttle.summary_text(), size=12, color=ft.Colors.BLACK54)
+        # 遅い呼び出しに同じリクエストをもう1つ送り、先に届いた応答を使う（API使用量は上限の割合まで増える）
+        self.hedge_checkbox = ft.Checkbox(label="遅い呼び出しに重複リクエストを送る", value=False)
+        self.max_hedge_rate_field = ft.TextField(
+            label="重複の上限(%)",
+            value=f"{DEFAULT_MAX_HEDGE_RATE * 100:g}",
+            width=120,
+            keyboard_type=ft.KeyboardType.NUMBER,
+        )
+        self.hedge_stats_text = ft.Text(self.scan_engine.hedging.stats.summary_text(), size=12, color=ft.Colors.BLACK54)
+        # 安価なモデルで先に抽出し、確認に失敗した項目だけを上位のモデル（既定のモデル）で抽出し直す
+        self.cascade_models_field = ft.TextField(
+            label="先に試す安価なモデル（カンマ区切り）",
+            hint_text="例: gemini-1.5-flash-8b",
+            width=320,
+        )
+        self.cascade_stats_text = ft.Text(self.scan_engine.cascade_stats.summary_text(), size=12, color=ft.Colors.BLACK54)
+        # 複数のAPIキーを使っている場合の、キーごとの呼び出し数・エラー数
+        self.key_pool_stats_text = ft.Text("", size=12, color=ft.Colors.BLACK54)
+
+        # --- トレース（段階ごとの所要時間） ---
+        self.trace_history_field = ft.TextField(
+            label="集計するスキャン数",
+            value=str(DEFAULT_TRACE_HISTORY),
+            width=150,
+            keyboard_type=ft.KeyboardType.NUMBER,
+            on_blur=lambda e: self._refresh_trace_table(),
+        )
+        self.trace_format_dropdown = ft.Dropdown(
+            label="形式",
+            options=[ft.dropdown.Option(name) for name in TRACE_FORMATS],
+            value=TRACE_FORMAT_CHROME,
+            width=120,
+        )
+        self.trace_export_button = ft.OutlinedButton("トレースを書き出し", icon=ft.Icons.TIMELINE, on_click=self._on_trace_export_click)
+        self.trace_table = ft.DataTable(
+            columns=[
+                ft.DataColumn(ft.Text("段階")),
+                ft.DataColumn(ft.Text("回数"), numeric=True),
+                ft.DataColumn(ft.Text("合計(秒)"), numeric=True),
+                ft.DataColumn(ft.Text("p50(秒)"), numeric=True),
+                ft.DataColumn(ft.Text("p95(秒)"), numeric=True),
+                ft.DataColumn(ft.Text("最大(秒)"), numeric=True),
+            ],
+            rows=[],
+        )
 
         self.extracted_data_dialog = ft.AlertDialog(
             modal=True,
@@ -58,6 +267,7 @@ class ScanScreen:
         """画面が表示されたときにデータを再読み込みします。"""
         self._load_ocr_lists()
         self._load_conditions()
+        self._update_resume_button()
         if self.selected_ocr_list_id:
             self._load_files_for_list()
         else:
@@ -112,6 +322,7 @@ class ScanScreen:
     def _load_files_for_list(self):
         self.files_list_view.controls.clear()
         self.file_scan_status_texts.clear()
+        self.file_scan_buttons.clear()
         if not self.selected_ocr_list_id:
             if self.files_list_view.page: self.files_list_view.update()
             return
@@ -141,9 +352,12 @@ class ScanScreen:
                         disabled=scan_button_disabled,
                         data=f_obj.id # ボタンデータに file_id を格納
                     )
+                    self.file_scan_buttons[f_obj.id] = scan_button
 
+                    display_name = f"{f_obj.filename} ({f_obj.page_count}ページ)" if f_obj.page_count else f_obj.filename
                     file_row_content = ft.Row([
-                        ft.Text(f_obj.filename, expand=True, tooltip=f_obj.filename),
+                        self._file_thumbnail(f_obj),
+                        ft.Text(display_name, expand=True, tooltip=f_obj.filename),
                         status_text, # 進捗/ステータス用プレースホルダ
                         scan_button
                     ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN, vertical_alignment=ft.CrossAxisAlignment.CENTER)
@@ -162,232 +376,393 @@ class ScanScreen:
         
         if self.files_list_view.page: self.files_list_view.update()
 
+    def _file_thumbnail(self, f_obj: UploadedFile) -> ft.Container:
+        """一覧の行のサムネイルです。キャッシュに無ければバックグラウンドで作成し、できたら差し替えます。"""
+        container = ft.Container(
+            content=ft.Icon(ft.Icons.PICTURE_AS_PDF_OUTLINED if f_obj.filetype == "pdf" else ft.Icons.IMAGE_OUTLINED, color=ft.Colors.BLACK26),
+            width=40, height=40, alignment=ft.alignment.center, border_radius=4, clip_behavior=ft.ClipBehavior.HARD_EDGE,
+        )
+
+        def show(path: str | None):
+            if path:
+                container.content = ft.Image(src=path, width=40, height=40, fit=ft.ImageFit.COVER)
+                if container.page: container.update()
+
+        show(thumbnail_cache.get(thumbnail_key(f_obj), os.path.join(APP_BASE_DIR, f_obj.filepath), f_obj.filetype, SIZE_LIST, on_ready=show))
+        return container
+
     async def _initiate_scan_file(self, file_id: int):
+        """「スキャン実行」ボタンから1ファイルをスキャンします。"""
         if not self.selected_condition_id:
             self.page.snack_bar = ft.SnackBar(ft.Text("スキャンを実行する前に条件を選択してください。"), open=True, bgcolor=ft.Colors.AMBER)
             if self.page: self.page.update()
             return
 
-        # UIを更新して「スキャン中...」を表示
-        scan_button_to_update = None
-        # files_list_view.controls内のコンテナを正しく特定する
-        for ctrl_container in self.files_list_view.controls:
-            if isinstance(ctrl_container, ft.Container) and \
-               hasattr(ctrl_container.content, 'controls') and \
-               len(ctrl_container.content.controls) > 2 and \
-               isinstance(ctrl_container.content.controls[2], ft.ElevatedButton) and \
-               ctrl_container.content.controls[2].data == file_id:
-                scan_button_to_update = ctrl_container.content.controls[2]
-                break
-        
+        settings = self._build_scan_settings()
+        # 一括スキャンの実行中は、エンジンを共有しているため設定（同時実行数・レート制限・モデルなど）を変更しない
+        if not self.batch_running:
+            self.scan_engine.apply_settings(settings)
+        if settings.reuse_near_duplicates:
+            duplicate = await self.scan_engine.find_near_duplicate(file_id, self.selected_condition_id)
+            self._refresh_stats_texts()
+            if duplicate is not None:
+                self._confirm_near_duplicate_reuse(file_id, self.selected_condition_id, duplicate)
+                return
+        await self._scan_single_file(file_id, self.selected_condition_id)
+
+    def _confirm_near_duplicate_reuse(self, file_id: int, condition_id: int, duplicate: NearDuplicate):
+        """類似ファイルの抽出結果を再利用するか、APIでスキャンするかを確認するダイアログを表示します。"""
+        async def on_reuse(e):
+            self.page.close(dialog)
+            outcome = await self.scan_engine.reuse_extraction(file_id, duplicate.file_id, condition_id)
+            self._show_scan_outcome(outcome)
+
+        async def on_scan(e):
+            self.page.close(dialog)
+            await self._scan_single_file(file_id, condition_id)
+
+        dialog = ft.AlertDialog(
+            modal=True,
+            title=ft.Text("類似ファイルがあります"),
+            content=ft.Text(
+                f"スキャン済みの「{duplicate.filename}」と見た目がほぼ同じです（違い {duplicate.distance}/64）。\n"
+                "このファイルの抽出結果を再利用すると、APIを呼び出しません。"
+            ),
+            actions=[
+                ft.TextButton("抽出結果を再利用", on_click=on_reuse),
+                ft.TextButton("APIでスキャン", on_click=on_scan),
+                ft.TextButton("キャンセル", on_click=lambda e: self.page.close(dialog)),
+            ],
+            actions_alignment=ft.MainAxisAlignment.END,
+        )
+        self.page.open(dialog)
+
+    async def _scan_single_file(self, file_id: int, condition_id: int):
+        # 一括スキャンの実行中でも、待っている一括スキャンの呼び出しより先にAPIの枠を割り当てる
+        # 単体スキャンでは類似ファイルを自動で再利用しない（見つかった場合は _initiate_scan_file で利用者に確認済み）
+        outcome = await self.scan_engine.scan_file(file_id, condition_id, priority=PRIORITY_INTERACTIVE, reuse_near_duplicates=False)
+        await self.scan_engine.flush_call_records() # 利用状況画面にすぐ反映されるように
+        self._refresh_trace_table()
+        self._show_scan_outcome(outcome)
+
+    def _show_scan_outcome(self, outcome: ScanOutcome):
+        if outcome.succeeded and outcome.reused_from:
+            self.page.snack_bar = ft.SnackBar(ft.Text(f"「{outcome.filename}」に「{outcome.reused_from}」の抽出結果を保存しました。"), open=True)
+        elif outcome.succeeded:
+            message = f"「{outcome.filename}」のスキャンが完了しました。"
+            if outcome.roi_usage:
+                message += f" 領域切り抜き: {outcome.roi_usage.summary_text()}"
+            self.page.snack_bar = ft.SnackBar(ft.Text(message), open=True)
+        elif outcome.filename:
+            self.page.snack_bar = ft.SnackBar(ft.Text(f"「{outcome.filename}」からのデータ抽出に失敗しました。{outcome.error or ''}"), open=True, bgcolor=ft.Colors.ERROR)
+        else:
+            self.page.snack_bar = ft.SnackBar(ft.Text(outcome.error or "スキャンに失敗しました。"), open=True, bgcolor=ft.Colors.ERROR)
+        if self.page: self.page.update()
+
+    def _set_file_row_state(self, file_id: int, status: str, scan_enabled: bool | None = None):
+        """ファイル行のステータス表示とスキャンボタンの有効/無効を更新します。"""
         status_label = self.file_scan_status_texts.get(file_id)
         if status_label:
-            status_label.value = "スキャン中..."
-            if scan_button_to_update:
-                scan_button_to_update.disabled = True
-            if self.page: 
-                status_label.update()
-                if scan_button_to_update: scan_button_to_update.update()
-        
-        db = next(self.db_context())
+            status_label.value = status
+            if status_label.page: status_label.update()
+        scan_button = self.file_scan_buttons.get(file_id)
+        if scan_button and scan_enabled is not None:
+            scan_button.disabled = not scan_enabled
+            if scan_button.page: scan_button.update()
+
+    @staticmethod
+    def _live_field_control(page_number: int | None, item_name: str, value: str | None) -> ft.TextField:
+        label = f"{item_name} (p.{page_number})" if page_number else item_name
+        return ft.TextField(label=label, value=value or "", read_only=True, border=ft.InputBorder.UNDERLINE)
+
+    def _show_live_field(self, file_id: int, page_number: int | None, item_name: str, value: str | None):
+        """ストリーミングで確定した項目を、ファイル行の状態とプレビューダイアログ（表示中の場合）に反映します。"""
+        fields = self.live_fields.setdefault(file_id, [])
+        fields.append((page_number, item_name, value))
+        page_text = f"p.{page_number} " if page_number else ""
+        self._set_file_row_state(file_id, f"{page_text}{len(fields)} 項目受信: {item_name}")
+        if self.preview_file_id == file_id:
+            self.live_fields_column.controls.append(self._live_field_control(page_number, item_name, value))
+            self.live_fields_section.visible = True
+            if self.live_fields_section.page: self.live_fields_section.update()
+
+    def _mark_file_scanned(self, file_id: int):
+        scan_button = self.file_scan_buttons.get(file_id)
+        if scan_button:
+            scan_button.text = "スキャン済み"
+        self._set_file_row_state(file_id, "", scan_enabled=False) # 「スキャン中...」をクリア
+
+    def _refresh_stats_texts(self):
+        self.cache_stats_text.value = self.scan_engine.result_cache.summary_text()
+        self.preprocess_stats_text.value = self.scan_engine.preprocess_stats.summary_text()
+        self.packing_stats_text.value = self.scan_engine.packing_stats.summary_text()
+        self.parse_stats_text.value = self.scan_engine.parse_stats.summary_text()
+        self.streaming_stats_text.value = self.scan_engine.streaming_stats.summary_text()
+        self.incremental_stats_text.value = self.scan_engine.incremental_stats.summary_text()
+        self.roi_stats_text.value = self.scan_engine.roi_stats.summary_text()
+        self.near_duplicate_stats_text.value = self.scan_engine.near_duplicate_stats.summary_text()
+        self.throttle_status_text.value = self.scan_engine.throttle.summary_text()
+        self.hedge_stats_text.value = self.scan_engine.hedging.stats.summary_text()
+        self.cascade_stats_text.value = self.scan_engine.cascade_stats.summary_text()
+        key_pool = self.scan_engine.key_pool
+        self.key_pool_stats_text.value = "\n".join(key_pool.summary_lines()) if key_pool else ""
+        for text_control in (self.cache_stats_text, self.preprocess_stats_text, self.packing_stats_text,
+                             self.parse_stats_text, self.streaming_stats_text, self.incremental_stats_text,
+                             self.roi_stats_text, self.near_duplicate_stats_text, self.throttle_status_text,
+                             self.hedge_stats_text, self.cascade_stats_text, self.key_pool_stats_text):
+            if text_control.page: text_control.update()
+
+    def _build_scan_settings(self) -> ScanSettings:
+        """画面の入力値からスキャン設定を組み立てます。不正な値は初期値に戻します。"""
         try:
-            file_to_scan = db.query(UploadedFile).filter(UploadedFile.id == file_id).first()
-            condition_used = db.query(Condition).options(joinedload(Condition.data_items)).filter(Condition.id == self.selected_condition_id).first()
-
-            if not file_to_scan or not condition_used:
-                if status_label: status_label.value = "エラー"
-                self.page.snack_bar = ft.SnackBar(ft.Text("ファイルまたは条件が見つかりません。"), open=True, bgcolor=ft.Colors.ERROR)
-                if self.page: 
-                    if status_label: status_label.update()
-                    self.page.update()
-                return
+            requests_per_min = max(1, int(self.requests_per_min_field.value))
+        except (TypeError, ValueError):
+            requests_per_min = DEFAULT_REQUESTS_PER_MIN
+        try:
+            tokens_per_min = max(1, int(self.tokens_per_min_field.value))
+        except (TypeError, ValueError):
+            tokens_per_min = DEFAULT_TOKENS_PER_MIN
+        try:
+            max_hedge_rate = min(max(0.0, float(self.max_hedge_rate_field.value) / 100), 1.0)
+        except (TypeError, ValueError):
+            max_hedge_rate = DEFAULT_MAX_HEDGE_RATE
+        api_key = self.api_key_field.value or ""
+        api_keys = list(self.api_key_configs)
+        if api_keys and api_key and all(config.key != api_key for config in api_keys):
+            api_keys.append(ApiKeyConfig("入力したキー", api_key, requests_per_min, tokens_per_min))
+        return ScanSettings(
+            api_key=api_key,
+            api_keys=api_keys,
+            backend_name=self.backend_dropdown.value or "gemini",
+            preprocess=self._build_preprocess_options(),
+            max_concurrency=self._parse_concurrency(),
+            pack_size=self._parse_pack_size(),
+            streaming=bool(self.streaming_checkbox.value),
+            incremental=bool(self.incremental_checkbox.value),
+            reuse_near_duplicates=bool(self.reuse_near_duplicates_checkbox.value),
+            requests_per_min=requests_per_min,
+            tokens_per_min=tokens_per_min,
+            hedge_requests=bool(self.hedge_checkbox.value),
+            max_hedge_rate=max_hedge_rate,
+            cascade_models=[name.strip() for name in (self.cascade_models_field.value or "").split(",") if name.strip()],
+        )
 
-            # 実際のファイルパスを構築 (UploadedFile.filepath は images/ocr_list_id/unique_filename のような相対パスを想定)
-            physical_file_path = os.path.join(APP_BASE_DIR, file_to_scan.filepath)
-            print(f"スキャン対象ファイル: {physical_file_path}")
-
-            # --- GEMINI API 連携箇所 ---
-            extracted_data_dict = await self.call_gemini_api(physical_file_path, condition_used.data_items, file_to_scan.filetype)
-            # # シミュレーション用 (実際のAPI使用時はコメントアウトまたは削除):
-            # await asyncio.sleep(2) # ネットワーク遅延をシミュレート
-            # extracted_data_dict = {item.name: f"抽出値サンプル for {item.name}" for item in condition_used.data_items}
-            # --- GEMINI API 連携終了 ---
-
-            if extracted_data_dict is None:
-                # API呼び出し失敗またはデータ抽出なし
-                if status_label: status_label.value = "抽出失敗"
-                self.page.snack_bar = ft.SnackBar(ft.Text(f"「{file_to_scan.filename}」からのデータ抽出に失敗しました。"), open=True, bgcolor=ft.Colors.ERROR)
-                if scan_button_to_update: scan_button_to_update.disabled = False # エラー時は再試行可能に
-                if self.page:
-                    if status_label: status_label.update()
-                    if scan_button_to_update: scan_button_to_update.update()
-                    self.page.update()
-                return
+    def _build_preprocess_options(self) -> PreprocessOptions:
+        """画面の入力値から画像前処理の設定を組み立てます。不正な値は初期値に戻します。"""
+        try:
+            max_pixels = int(float(self.max_megapixels_field.value) * 1_000_000)
+        except (TypeError, ValueError):
+            max_pixels = DEFAULT_MAX_PIXELS
+        try:
+            quality = max(1, min(int(self.quality_field.value), 100))
+        except (TypeError, ValueError):
+            quality = DEFAULT_QUALITY
+        return PreprocessOptions(
+            enabled=bool(self.preprocess_enabled_checkbox.value),
+            max_pixels=max_pixels,
+            grayscale=bool(self.grayscale_checkbox.value),
+            output_format=self.output_format_dropdown.value or "JPEG",
+            quality=quality,
+        )
 
-            # このファイルと条件に対する古いスキャンデータを削除（再スキャン時の重複を避けるため）
-            db.query(ScannedData).filter(ScannedData.uploaded_file_id == file_id, ScannedData.condition_id == self.selected_condition_id).delete()
+    def _parse_pack_size(self) -> int:
+        """まとめ送信の枚数を返します。まとめ送信が無効な場合は1です。"""
+        if not self.packing_checkbox.value:
+            return 1
+        try:
+            value = int(self.pack_size_field.value)
+        except (TypeError, ValueError):
+            value = DEFAULT_PACK_SIZE
+        return max(1, min(value, MAX_PACK_SIZE))
 
-            for item_name, extracted_value in extracted_data_dict.items():
-                new_scan_data = ScannedData(
-                    uploaded_file_id=file_id,
-                    condition_id=self.selected_condition_id,
-                    data_item_name=item_name,
-                    extracted_value=extracted_value
-                )
-                db.add(new_scan_data)
-            
-            file_to_scan.is_scanned = True
-            file_to_scan.scanned_at = datetime.datetime.utcnow()
-            db.commit()
-
-            if status_label: status_label.value = "" # 「スキャン中...」をクリア
-            if scan_button_to_update:
-                scan_button_to_update.text = "スキャン済み"
-                scan_button_to_update.disabled = True
-            
-            self.page.snack_bar = ft.SnackBar(ft.Text(f"「{file_to_scan.filename}」のスキャンが完了しました。"), open=True)
-
-        except Exception as e:
-            db.rollback()
-            print(f"スキャンまたはDB操作中にエラー発生: {e}")
-            if status_label: status_label.value = "エラー"
-            if scan_button_to_update: scan_button_to_update.disabled = False # エラー時は再試行可能に
-            self.page.snack_bar = ft.SnackBar(ft.Text(f"スキャン中にエラー発生: {e}"), open=True, bgcolor=ft.Colors.ERROR)
-        finally:
-            db.close()
-            if self.page: 
-                if status_label: status_label.update()
-                if scan_button_to_update: scan_button_to_update.update()
-                self.page.update()
+    def _parse_concurrency(self) -> int:
+        """同時実行数の入力値を 1〜MAX_BATCH_CONCURRENCY の範囲に丸めて返します。"""
+        try:
+            value = int(self.concurrency_field.value)
+        except (TypeError, ValueError):
+            value = DEFAULT_BATCH_CONCURRENCY
+        return max(1, min(value, MAX_BATCH_CONCURRENCY))
 
-    async def call_gemini_api(self, file_path: str, data_items: list[DataItem], file_type: str) -> dict | None:
-        """
-        指定されたファイルからデータを抽出するためにGemini APIを呼び出します。
-        """
-        api_key = self.api_key_field.value
-        if not api_key:
-            print("エラー: Gemini APIキーが入力されていません。")
-            self.page.snack_bar = ft.SnackBar(ft.Text("スキャンを実行する前にAPIキーを入力してください。"), open=True, bgcolor=ft.Colors.ERROR)
-            if self.page: self.page.update()
-            return None
+    async def _on_batch_scan_click(self, e: ft.ControlEvent):
+        if self.batch_running:
+            return
+        if not self.selected_ocr_list_id:
+            self.page.snack_bar = ft.SnackBar(ft.Text("先にOCRリストを選択してください。"), open=True, bgcolor=ft.Colors.AMBER)
+            self.page.update()
+            return
+        if not self.selected_condition_id:
+            self.page.snack_bar = ft.SnackBar(ft.Text("スキャンを実行する前に条件を選択してください。"), open=True, bgcolor=ft.Colors.AMBER)
+            self.page.update()
+            return
 
-        try:
-            # APIキーを都度設定
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-
-            if not os.path.exists(file_path):
-                print(f"エラー: ファイルが見つかりません {file_path}")
-                self.page.snack_bar = ft.SnackBar(ft.Text(f"エラー: スキャン対象ファイルが見つかりません。"), open=True, bgcolor=ft.Colors.ERROR)
-                if self.page: self.page.update()
-                return None
-
-            # MIMEタイプの決定（簡易版）
-            # file_type は 'png', 'jpg', 'pdf' などの拡張子（ドットなし）を想定
-            if file_type.lower() in ["png", "jpg", "jpeg"]:
-                mime_type = f"image/{file_type.lower()}"
-            elif file_type.lower() == "pdf":
-                # Gemini Pro Vision はPDFを直接処理するのに最適ではないかもしれません。
-                # PDFページをまず画像に変換する必要がある場合があります。
-                # ここでは、PDFを画像に変換する処理を挟むことを推奨します。
-                # (例: pdf2imageライブラリを使用)
-                # 今回は簡略化のため、PDFの場合はエラーメッセージを表示してNoneを返します。
-                print(f"警告: PDFファイル ({file_path}) の直接処理はサポートされていません。画像に変換してください。")
-                self.page.snack_bar = ft.SnackBar(ft.Text(f"警告: PDFファイルは画像に変換してからスキャンしてください。"), open=True, bgcolor=ft.Colors.AMBER)
-                if self.page: self.page.update()
-                return None # PDF直接処理は一旦スキップ
-            else:
-                print(f"Gemini Visionでサポートされていないファイルタイプです: {file_type}")
-                self.page.snack_bar = ft.SnackBar(ft.Text(f"サポートされていないファイル形式です: {file_type}"), open=True, bgcolor=ft.Colors.ERROR)
-                if self.page: self.page.update()
-                return None
-
-            with open(file_path, "rb") as f:
-                image_bytes = f.read()
-            
-            image_part = {"mime_type": mime_type, "data": image_bytes}
-            
-            prompt_parts = ["以下の画像から、次のデータ項目を抽出してください:\n"]
-            for item in data_items:
-                prompt_parts.append(f"{item.name}\n")
-            prompt_parts.append("\n抽出結果は「項目名: 値」の形式で、各項目を改行で区切って返してください。項目名と値のペアのみを応答してください。")
-            # 例:
-            # 請求書番号: INV12345
-            # 発行日: 2023-10-26
-            # 合計金額: 10000
-
-            full_prompt = "".join(prompt_parts)
-            print(f"Geminiへのプロンプト: {full_prompt}") # デバッグ用にプロンプトをログ出力
-
-            response = await model.generate_content_async([image_part, full_prompt])
-            
-            extracted_data = {}
-            if response and hasattr(response, 'text') and response.text:
-                print(f"Geminiからの応答テキスト: {response.text}") # 生の応答をログ出力
-                for line in response.text.splitlines():
-                    if ":" in line:
-                        parts = line.split(":", 1)
-                        if len(parts) == 2:
-                            key = parts[0].strip()
-                            val = parts[1].strip()
-                            # data_items に含まれる項目名のみを抽出対象とする（より厳密に）
-                            if any(d_item.name == key for d_item in data_items):
-                                extracted_data[key] = val
-                            else:
-                                print(f"警告: プロンプトにない項目名「{key}」が応答に含まれています。スキップします。")
-                        else:
-                            print(f"警告: 不正な形式の行です: {line}")
-            else:
-                print("Geminiからの応答が空またはテキストがありません。")
-                if response and response.prompt_feedback:
-                    print(f"プロンプトフィードバック: {response.prompt_feedback}")
+        pending_ids = self.scan_engine.pending_file_ids(self.selected_ocr_list_id)
+        if self.incremental_checkbox.value:
+            pending_ids += self.scan_engine.files_missing_items(self.selected_ocr_list_id, self.selected_condition_id)
+        if not pending_ids:
+            self.page.snack_bar = ft.SnackBar(ft.Text("未スキャンのファイルはありません。"), open=True)
+            self.page.update()
+            return
 
+        await self._run_batch_scan(pending_ids, self.selected_condition_id)
 
-            # 抽出されたデータがdata_itemsのすべてをカバーしているか確認（任意）
-            if len(extracted_data) < len(data_items):
-                print(f"警告: すべての要求されたデータ項目が抽出されませんでした。抽出された項目: {len(extracted_data)}/{len(data_items)}")
+    async def _on_resume_jobs_click(self, e: ft.ControlEvent):
+        if self.batch_running:
+            return
+        file_ids = self.scan_engine.job_queue.unfinished_file_ids()
+        if not file_ids:
+            self._update_resume_button()
+            self.page.update()
+            return
+        await self._run_batch_scan(file_ids)
 
+    def _update_resume_button(self):
+        pending_jobs = self.scan_engine.job_queue.unfinished_count()
+        self.resume_jobs_button.visible = pending_jobs > 0 and not self.batch_running
+        self.resume_jobs_button.text = f"中断したスキャンを再開 ({pending_jobs} 件)"
 
-            return extracted_data
+    def _on_batch_cancel_click(self, e: ft.ControlEvent):
+        # 実行中のスキャンは完了まで待ち、キューに残っているファイルのみ取り消す
+        self.scan_engine.cancel()
+        self.batch_cancel_button.disabled = True
+        self.batch_progress_text.value += " (停止中...)"
+        self.page.update()
 
-        except Exception as e:
-            # 包括的なエラーハンドリング
-            error_message = f"Gemini APIエラー: {e}"
-            # APIキー関連のエラーか、他のエラーかを少し判別
-            if "API_KEY_INVALID" in str(e):
-                error_message = "APIキーが無効です。確認してください。"
-            print(f"Gemini API呼び出し中にエラー発生: {e}")
-            self.page.snack_bar = ft.SnackBar(ft.Text(error_message), open=True, bgcolor=ft.Colors.ERROR)
-            if self.page: self.page.update()
-            return None
+    async def _run_batch_scan(self, file_ids: list[int], condition_id: int | None = None):
+        """
+        未スキャンのファイルを ScanEngine の一括スキャンに渡し、進捗を画面に表示します。
+        condition_id が None の場合は、中断した一括スキャンの未完了ジョブを再開します。
+        """
+        self.batch_running = True
+        self.batch_scan_button.disabled = True
+        self.resume_jobs_button.visible = False
+        self.batch_cancel_button.disabled = False
+        self.batch_progress_bar.value = 0
+        self.batch_progress_bar.visible = True
+        for file_id in file_ids:
+            self._set_file_row_state(file_id, "待機中", scan_enabled=False)
+        self.page.update()
+
+        self.scan_engine.apply_settings(self._build_scan_settings())
+        summary = None
+        try:
+            if condition_id is None:
+                summary = await self.scan_engine.run_jobs()
+            else:
+                summary = await self.scan_engine.run_batch(file_ids, condition_id)
+        finally:
+            self.batch_running = False
+            self._update_resume_button()
+            self.batch_scan_button.disabled = False
+            self.batch_cancel_button.disabled = True
+            # 停止によりスキャンされなかったファイルは再度実行できるようにする
+            finished_ids = {o.file_id for o in summary.outcomes} if summary else set()
+            for file_id in file_ids:
+                if file_id not in finished_ids:
+                    self._set_file_row_state(file_id, "", scan_enabled=True)
+            self._refresh_trace_table()
+            if summary:
+                if summary.cancelled:
+                    self.batch_progress_text.value += " - 停止しました"
+                self.page.snack_bar = ft.SnackBar(
+                    ft.Text(f"一括スキャン完了: {summary.succeeded_count} 件成功 / {len(summary.failed)} 件失敗"),
+                    open=True,
+                )
+            self.page.update()
+
+    def _refresh_trace_table(self):
+        """直近N件のスキャンの段階ごとの所要時間（p50/p95）を表に表示します。"""
+        try:
+            self.scan_engine.tracer.set_history(max(1, int(self.trace_history_field.value)))
+        except (TypeError, ValueError):
+            self.trace_history_field.value = str(self.scan_engine.tracer.traces.maxlen)
+        self.trace_table.rows = [
+            ft.DataRow(cells=[
+                ft.DataCell(ft.Text(timing.stage)),
+                ft.DataCell(ft.Text(f"{timing.count:,}")),
+                ft.DataCell(ft.Text(f"{timing.total_seconds:.3f}")),
+                ft.DataCell(ft.Text(f"{timing.p50_seconds:.3f}")),
+                ft.DataCell(ft.Text(f"{timing.p95_seconds:.3f}")),
+                ft.DataCell(ft.Text(f"{timing.max_seconds:.3f}")),
+            ])
+            for timing in self.scan_engine.tracer.stage_timings()
+        ]
+        if self.trace_table.page: self.trace_table.update()
+
+    def _on_trace_export_click(self, e: ft.ControlEvent):
+        """保持しているトレースを traces/ に書き出します（chrome は chrome://tracing や Perfetto で開けます）。"""
+        trace_format = self.trace_format_dropdown.value or TRACE_FORMAT_CHROME
+        filename = f"scan_trace_{datetime.datetime.now():%Y%m%d_%H%M%S}_{trace_format}.json"
+        path = os.path.join(APP_BASE_DIR, TRACE_EXPORT_DIR, filename)
+        try:
+            span_count = self.scan_engine.tracer.export(path, trace_format)
+        except OSError as ex:
+            self.page.snack_bar = ft.SnackBar(ft.Text(f"トレースの書き出しに失敗しました: {ex}"), open=True, bgcolor=ft.Colors.ERROR)
+        else:
+            self.page.snack_bar = ft.SnackBar(ft.Text(f"{span_count} 件のスパンを書き出しました: {path}"), open=True)
+        self.page.update()
+
+    def _update_batch_progress(self, summary: BatchSummary):
+        """一括スキャンの進捗バーとスループット(ファイル/分)を更新します。"""
+        self.batch_progress_bar.value = summary.done / summary.total if summary.total else 0
+        self.batch_progress_text.value = summary.progress_text()
+        if self.batch_progress_bar.page:
+            self.batch_progress_bar.update()
+            self.batch_progress_text.update()
 
     def _show_preview_and_data_dialog(self, file_obj: UploadedFile):
         """画像プレビューと抽出済みデータをダイアログに表示します。"""
         self.extracted_data_dialog.content.controls.clear()
         self.extracted_data_dialog.title.value = f"{file_obj.filename}"
+        self.preview_file_id = file_obj.id
 
-        # --- 画像プレビュー部分 ---
+        # --- 画像プレビュー部分（元画像ではなく SIZE_PREVIEW のサムネイルを表示し、無ければ作成を待つ） ---
         physical_file_path = os.path.join(APP_BASE_DIR, file_obj.filepath)
-        if file_obj.filetype.lower() in ["png", "jpg", "jpeg"] and os.path.exists(physical_file_path):
-            image_control = ft.Image(
-                src=physical_file_path,
-                width=380,
-                fit=ft.ImageFit.CONTAIN,
-                border_radius=ft.border_radius.all(5)
+        file_type = file_obj.filetype.lower()
+        if file_type in THUMBNAIL_FILE_TYPES and os.path.exists(physical_file_path):
+            preview_container = ft.Container(
+                content=ft.ProgressRing(width=32, height=32), alignment=ft.alignment.center, height=200,
             )
-            self.extracted_data_dialog.content.controls.append(image_control)
+
+            def show_preview(path: str | None, file_id=file_obj.id):
+                if self.preview_file_id != file_id:
+                    return # 作成を待つ間に別のファイルのプレビューを開いた
+                if path:
+                    preview_container.content = ft.Image(
+                        src=path,
+                        width=380,
+                        fit=ft.ImageFit.CONTAIN,
+                        border_radius=ft.border_radius.all(5)
+                    )
+                    preview_container.height = None
+                else:
+                    preview_container.content = ft.Text("プレビューを作成できませんでした。", text_align=ft.TextAlign.CENTER)
+                    preview_container.height = 100
+                if preview_container.page: preview_container.update()
+
+            cached_path = thumbnail_cache.get(thumbnail_key(file_obj), physical_file_path, file_type, SIZE_PREVIEW, on_ready=show_preview)
+            if cached_path:
+                show_preview(cached_path)
+            self.extracted_data_dialog.content.controls.append(preview_container)
         else:
             message = ft.Text(f"{file_obj.filetype.upper()} のプレビューはサポートされていません。", text_align=ft.TextAlign.CENTER)
             self.extracted_data_dialog.content.controls.append(ft.Container(content=message, alignment=ft.alignment.center, height=100))
         
         self.extracted_data_dialog.content.controls.append(ft.Divider(height=15, thickness=1))
         
+        # --- ストリーミング受信中のデータ（スキャン中のみ） ---
+        self.live_fields_column.controls = [
+            self._live_field_control(page_number, item_name, value)
+            for page_number, item_name, value in self.live_fields.get(file_obj.id, [])
+        ]
+        self.live_fields_section.visible = file_obj.id in self.live_fields
+        self.extracted_data_dialog.content.controls.append(self.live_fields_section)
+
         # --- 抽出済みデータ表示部分 ---
         db = next(self.db_context())
         try:
             data_entries = db.query(ScannedData).options(joinedload(ScannedData.condition))\
                              .filter(ScannedData.uploaded_file_id == file_obj.id)\
-                             .order_by(ScannedData.condition_id, ScannedData.data_item_name).all()
+                             .order_by(ScannedData.condition_id, ScannedData.page_number, ScannedData.data_item_name).all()
 
             if not file_obj.is_scanned or not data_entries:
                 self.extracted_data_dialog.content.controls.append(ft.Text("このファイルはまだスキャンされていません。", text_align=ft.TextAlign.CENTER))
@@ -403,8 +778,9 @@ class ScanScreen:
                         )
                         current_condition_name = condition_display_name
                     
+                    field_label = f"{entry.data_item_name} (p.{entry.page_number})" if entry.page_number else entry.data_item_name
                     self.extracted_data_dialog.content.controls.append(
-                        ft.TextField(label=entry.data_item_name, value=entry.extracted_value, read_only=True, border=ft.InputBorder.UNDERLINE)
+                        ft.TextField(label=field_label, value=entry.extracted_value, read_only=True, border=ft.InputBorder.UNDERLINE)
                     )
         finally:
             db.close()
@@ -412,6 +788,7 @@ class ScanScreen:
         self.page.open(self.extracted_data_dialog)
 
     def _close_dialog(self, e: ft.ControlEvent):
+        self.preview_file_id = None
         self.page.close(self.extracted_data_dialog)
 
     def build_content(self) -> ft.Column:
@@ -422,7 +799,8 @@ class ScanScreen:
                 ft.Text("スキャン実行とデータ確認", size=24, weight=ft.FontWeight.BOLD),
                 ft.Row([
                     ft.Text("API Key:", width=100, size=16, weight=ft.FontWeight.BOLD), 
-                    self.api_key_field
+                    self.api_key_field,
+                    self.backend_dropdown,
                 ], vertical_alignment=ft.CrossAxisAlignment.CENTER),
                 ft.Row([
                     ft.Text("OCRリスト:", width=100, size=16, weight=ft.FontWeight.BOLD), 
@@ -432,8 +810,60 @@ class ScanScreen:
                     ft.Text("条件選択:", width=100, size=16, weight=ft.FontWeight.BOLD), 
                     self.condition_dropdown
                 ], vertical_alignment=ft.CrossAxisAlignment.CENTER),
+                ft.Row([
+                    self.concurrency_field,
+                    self.batch_scan_button,
+                    self.batch_cancel_button,
+                    self.incremental_checkbox,
+                    self.reuse_near_duplicates_checkbox,
+                    self.resume_jobs_button,
+                ], spacing=10, vertical_alignment=ft.CrossAxisAlignment.CENTER),
+                self.batch_progress_bar,
+                self.batch_progress_text,
+                self.cache_stats_text,
+                self.incremental_stats_text,
+                self.roi_stats_text,
+                self.near_duplicate_stats_text,
+                ft.Row([
+                    self.preprocess_enabled_checkbox,
+                    self.max_megapixels_field,
+                    self.grayscale_checkbox,
+                    self.output_format_dropdown,
+                    self.quality_field,
+                ], spacing=10, wrap=True, vertical_alignment=ft.CrossAxisAlignment.CENTER),
+                self.preprocess_stats_text,
+                ft.Row([self.packing_checkbox, self.pack_size_field, self.streaming_checkbox], spacing=10, vertical_alignment=ft.CrossAxisAlignment.CENTER),
+                self.packing_stats_text,
+                self.parse_stats_text,
+                self.streaming_stats_text,
+                ft.Row([self.requests_per_min_field, self.tokens_per_min_field], spacing=10, vertical_alignment=ft.CrossAxisAlignment.CENTER),
+                self.throttle_status_text,
+                self.key_pool_stats_text,
+                ft.Row([self.hedge_checkbox, self.max_hedge_rate_field], spacing=10, vertical_alignment=ft.CrossAxisAlignment.CENTER),
+                self.hedge_stats_text,
+                self.cascade_models_field,
+                self.cascade_stats_text,
+                # 表が長くなるため、開いたときだけ表示する
+                ft.ExpansionTile(
+                    title=ft.Text("段階ごとの所要時間（トレース）", size=14, weight=ft.FontWeight.W_600),
+                    controls=[
+                        ft.Row([
+                            self.trace_history_field,
+                            self.trace_format_dropdown,
+                            self.trace_export_button,
+                        ], spacing=10, vertical_alignment=ft.CrossAxisAlignment.CENTER),
+                        self.trace_table,
+                    ],
+                ),
                 ft.Divider(height=10),
                 ft.Text("ファイルリスト", size=18, weight=ft.FontWeight.W_600),
                 self.files_list_view,
             ]
         )
+
+
+if __name__ == "__main__":
+    # python -m scan --list NAME --condition NAME ... でGUIなしの一括スキャンを実行する
+    import sys
+    from scan_cli import main
+    sys.exit(main())
@@ -0,0 +1,112 @@
+import datetime
+import hashlib
+import json
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from models import DataItem, ScanResultCache
+
+# キャッシュ容量の初期値（件数・result_jsonの合計バイト数のどちらかを超えたらLRUで追い出す）
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def compute_file_sha256(file_path: str) -> str:
+    """ファイル内容のSHA-256を16進文字列で返します。大きな画像でもメモリに全体を載せずに計算します。"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def condition_fingerprint(data_items: list[DataItem]) -> str:
+    """条件のデータ項目名を順序込みでハッシュ化します。項目の追加・削除・並び替えで値が変わります。"""
+    names = [item.name for item in data_items]
+    return hashlib.sha256(json.dumps(names, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def make_cache_key(image_sha256: str, data_items: list[DataItem], model_name: str, input_signature: str = "") -> str:
+    """
+    抽出結果のキャッシュキーです。input_signature には送信する画像を変える設定（前処理・切り抜き領域）の識別子を渡します。
+    元画像が同じでも、これが異なれば別の入力から抽出した結果として扱います。
+    """
+    raw = f"{image_sha256}:{condition_fingerprint(data_items)}:{model_name}:{input_signature}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ScanResultCacheStore:
+    """
+    scan_result_cache テーブルを使った抽出結果キャッシュです。
+    ヒット/ミス数を保持し、件数またはサイズの上限を超えると最終利用日時の古いものから削除します。
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, db: Session, cache_key: str) -> dict | None:
+        """キャッシュを参照します。ヒットした場合は最終利用日時を更新し、抽出結果の辞書を返します。"""
+        entry = db.query(ScanResultCache).filter(ScanResultCache.cache_key == cache_key).first()
+        if entry is None:
+            self.misses += 1
+            return None
+        try:
+            result = json.loads(entry.result_json)
+        except ValueError:
+            # 壊れたエントリはミス扱いにして削除する
+            db.delete(entry)
+            db.commit()
+            self.misses += 1
+            return None
+        entry.hit_count += 1
+        entry.last_used_at = datetime.datetime.utcnow()
+        db.commit()
+        self.hits += 1
+        return result
+
+    def put(self, db: Session, cache_key: str, image_sha256: str, model_name: str, result: dict):
+        """抽出結果を保存し、必要に応じて古いエントリを追い出します。"""
+        result_json = json.dumps(result, ensure_ascii=False)
+        now = datetime.datetime.utcnow()
+        entry = db.query(ScanResultCache).filter(ScanResultCache.cache_key == cache_key).first()
+        if entry is None:
+            entry = ScanResultCache(cache_key=cache_key, image_sha256=image_sha256, model_name=model_name, hit_count=0, created_at=now)
+            db.add(entry)
+        entry.result_json = result_json
+        entry.size_bytes = len(result_json.encode("utf-8"))
+        entry.last_used_at = now
+        db.commit()
+        self.evict(db)
+
+    def evict(self, db: Session) -> int:
+        """件数・合計サイズの上限を超えている分を、最終利用日時の古い順に削除します。削除件数を返します。"""
+        count, total_bytes = db.query(func.count(ScanResultCache.id), func.coalesce(func.sum(ScanResultCache.size_bytes), 0)).one()
+        if count <= self.max_entries and total_bytes <= self.max_bytes:
+            return 0
+
+        ids_to_evict = []
+        for entry_id, size_bytes in db.query(ScanResultCache.id, ScanResultCache.size_bytes).order_by(ScanResultCache.last_used_at):
+            if count <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            ids_to_evict.append(entry_id)
+            count -= 1
+            total_bytes -= size_bytes
+        for start in range(0, len(ids_to_evict), 500):
+            chunk = ids_to_evict[start:start + 500]
+            db.query(ScanResultCache).filter(ScanResultCache.id.in_(chunk)).delete(synchronize_session=False)
+        db.commit()
+        self.evictions += len(ids_to_evict)
+        return len(ids_to_evict)
+
+    def summary_text(self) -> str:
+        return f"キャッシュ: ヒット {self.hits} / ミス {self.misses} (ヒット率 {self.hit_rate:.0%})"
@@ -0,0 +1,284 @@
+import datetime
+import math
+import threading
+import time
+from dataclasses import dataclass
+from sqlalchemy import func, case
+from models import get_db, ScanCall, OcrList, Condition
+from ocr_backends import GEMINI_MODEL_NAME, FAKE_MODEL_NAME
+
+CALL_OK = "ok"
+CALL_PARSE_ERROR = "parse_error" # 応答は届いたがスキーマに合わなかった（トークンは消費済み）
+CALL_API_ERROR = "api_error" # 再試行しても失敗した
+
+ROLLUP_BY_LIST = "list"
+ROLLUP_BY_CONDITION = "condition"
+ROLLUP_BY_DAY = "day"
+ROLLUP_GROUPS = [ROLLUP_BY_LIST, ROLLUP_BY_CONDITION, ROLLUP_BY_DAY]
+
+# 100万トークンあたりの料金(USD) (入力, 出力)。表にないモデルは費用0として扱います。
+MODEL_PRICES_PER_MILLION = {
+    GEMINI_MODEL_NAME: (0.075, 0.30),
+    "gemini-1.5-flash-8b": (0.0375, 0.15),
+    "gemini-1.5-pro": (1.25, 5.00),
+    "gemini-2.0-flash": (0.10, 0.40),
+    FAKE_MODEL_NAME: (0.0, 0.0),
+}
+
+FLUSH_SIZE = 20 # まとめて書き込む件数
+FLUSH_INTERVAL_SECONDS = 2.0 # 前回の書き込みからこの秒数が経っていれば件数に関わらず書き込む
+
+
+def call_cost_usd(model_name: str, prompt_tokens: int, candidates_tokens: int) -> float:
+    input_price, output_price = MODEL_PRICES_PER_MILLION.get(model_name, (0.0, 0.0))
+    return (prompt_tokens * input_price + candidates_tokens * output_price) / 1_000_000
+
+
+def percentile(sorted_values: list[float], ratio: float) -> float:
+    """昇順に並んだ値の百分位数（最近傍順位法）です。"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(ratio * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+@dataclass
+class CallContext:
+    """API呼び出しを記録する際の、対象のリスト・条件・ファイルです。"""
+    ocr_list_id: int | None = None
+    condition_id: int | None = None
+    uploaded_file_id: int | None = None
+    page_number: int | None = None
+    file_count: int = 1 # この呼び出しで数えるファイル数（まとめ送信は画像の枚数、PDFの2ページ目以降は0）
+
+
+class CallTimer:
+    """
+    throttle.call に渡す request_factory を包み、試行回数と最後の試行の所要時間を計測します。
+    レート制限やバックオフの待ち時間は含めません。
+    """
+
+    def __init__(self, request_factory):
+        self.request_factory = request_factory
+        self.attempts = 0
+        self.latency_seconds = 0.0
+
+    async def __call__(self):
+        self.attempts += 1
+        started_at = time.monotonic()
+        try:
+            return await self.request_factory()
+        finally:
+            self.latency_seconds = time.monotonic() - started_at
+
+    @property
+    def retries(self) -> int:
+        return max(0, self.attempts - 1)
+
+
+@dataclass
+class CallRollup:
+    """集計1行分（リスト・条件・日付ごと、または全体）です。"""
+    key: object
+    label: str
+    calls: int = 0
+    files: int = 0
+    failures: int = 0
+    retries: int = 0
+    prompt_tokens: int = 0
+    candidates_tokens: int = 0
+    bytes_sent: int = 0
+    cost_usd: float = 0.0
+    p50_latency_seconds: float = 0.0
+    p95_latency_seconds: float = 0.0
+
+    @property
+    def cost_per_1000_files(self) -> float:
+        return self.cost_usd / self.files * 1000 if self.files else 0.0
+
+    def summary_text(self) -> str:
+        return (
+            f"API呼び出し {self.calls:,} 回 (失敗 {self.failures:,} / 再試行 {self.retries:,}) | ファイル {self.files:,} 件"
+            f" | トークン 入力 {self.prompt_tokens:,} / 出力 {self.candidates_tokens:,} | 送信 {self.bytes_sent / 1024 / 1024:.1f}MB"
+            f" | 所要時間 p50 {self.p50_latency_seconds:.2f}秒 / p95 {self.p95_latency_seconds:.2f}秒"
+            f" | 費用 ${self.cost_usd:.4f} (1,000ファイルあたり ${self.cost_per_1000_files:.4f})"
+        )
+
+
+class ScanCallRecorder:
+    """
+    API呼び出しを scan_calls テーブルに記録し、リスト・条件・日付ごとに集計します。
+    一括スキャン中に呼び出しごとにコミットしないよう、記録は FLUSH_SIZE 件または FLUSH_INTERVAL_SECONDS 秒ごとにまとめて書き込みます。
+    executor を渡すと、書き込みはそのスレッドプールで行います（イベントループを止めないため）。
+    """
+
+    def __init__(self, db_context=get_db, executor=None):
+        self.db_context = db_context
+        self.executor = executor
+        self.pending = []
+        self.last_flush_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, context: CallContext | None, model_name: str, timer: CallTimer, bytes_sent: int,
+               response=None, outcome: str = CALL_OK):
+        context = context or CallContext()
+        usage = getattr(response, "usage_metadata", None) if response is not None else None
+        now = datetime.datetime.now()
+        row = {
+            "call_date": now.date(),
+            "created_at": datetime.datetime.utcnow(),
+            "ocr_list_id": context.ocr_list_id,
+            "condition_id": context.condition_id,
+            "uploaded_file_id": context.uploaded_file_id,
+            "page_number": context.page_number,
+            "file_count": context.file_count,
+            "model_name": model_name,
+            "prompt_tokens": (getattr(usage, "prompt_token_count", 0) or 0) if usage else 0,
+            "candidates_tokens": (getattr(usage, "candidates_token_count", 0) or 0) if usage else 0,
+            "bytes_sent": bytes_sent,
+            "latency_seconds": timer.latency_seconds,
+            "retries": timer.retries,
+            "outcome": outcome,
+        }
+        with self._lock:
+            self.pending.append(row)
+            due = len(self.pending) >= FLUSH_SIZE or time.monotonic() - self.last_flush_at >= FLUSH_INTERVAL_SECONDS
+        if due:
+            if self.executor is not None:
+                self.executor.submit(self.flush)
+            else:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            self.last_flush_at = time.monotonic()
+            rows, self.pending = self.pending, []
+        if not rows:
+            return
+        db = next(self.db_context())
+        try:
+            db.bulk_insert_mappings(ScanCall, rows)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"API呼び出しの記録に失敗しました: {e}")
+        finally:
+            db.close()
+
+    # --- 集計 ---
+
+    def rollup(self, group_by: str, days: int = 30) -> list[CallRollup]:
+        """直近 days 日の記録を group_by（list / condition / day）ごとに集計します。"""
+        self.flush()
+        group_column = {
+            ROLLUP_BY_LIST: ScanCall.ocr_list_id,
+            ROLLUP_BY_CONDITION: ScanCall.condition_id,
+            ROLLUP_BY_DAY: ScanCall.call_date,
+        }[group_by]
+        db = next(self.db_context())
+        try:
+            rollups = {}
+            for row in self._aggregate(db, group_column, days):
+                rollups[row.key] = self._rollup_from_row(row.key, row)
+            self._apply_costs_and_latencies(db, group_column, days, rollups)
+            labels = self._labels(db, group_by, list(rollups))
+            for key, rollup in rollups.items():
+                rollup.label = labels.get(key, rollup.label)
+            if group_by == ROLLUP_BY_DAY:
+                return sorted(rollups.values(), key=lambda r: r.key, reverse=True)
+            return sorted(rollups.values(), key=lambda r: r.cost_usd, reverse=True)
+        finally:
+            db.close()
+
+    def totals(self, days: int = 30) -> CallRollup:
+        """直近 days 日の全体の集計です。"""
+        self.flush()
+        db = next(self.db_context())
+        try:
+            rows = self._aggregate(db, None, days)
+            total = self._rollup_from_row(None, rows[0]) if rows and rows[0].calls else CallRollup(None, "全体")
+            total.label = "全体"
+            rollups = {None: total}
+            self._apply_costs_and_latencies(db, None, days, rollups)
+            return total
+        finally:
+            db.close()
+
+    @staticmethod
+    def _since(days: int) -> datetime.date:
+        return datetime.date.today() - datetime.timedelta(days=max(1, days) - 1)
+
+    def _aggregate(self, db, group_column, days: int):
+        succeeded = ScanCall.outcome == CALL_OK
+        # ファイル数は成功した呼び出しの file_count の合計（まとめ送信は複数件、PDFは最初のページのみ1件）
+        files = func.coalesce(func.sum(case((succeeded, ScanCall.file_count), else_=0)), 0)
+        columns = [
+            func.count(ScanCall.id).label("calls"),
+            files.label("files"),
+            func.coalesce(func.sum(case((succeeded, 0), else_=1)), 0).label("failures"),
+            func.coalesce(func.sum(ScanCall.retries), 0).label("retries"),
+            func.coalesce(func.sum(ScanCall.prompt_tokens), 0).label("prompt_tokens"),
+            func.coalesce(func.sum(ScanCall.candidates_tokens), 0).label("candidates_tokens"),
+            func.coalesce(func.sum(ScanCall.bytes_sent), 0).label("bytes_sent"),
+        ]
+        if group_column is None:
+            return db.query(*columns).filter(ScanCall.call_date >= self._since(days)).all()
+        return (
+            db.query(group_column.label("key"), *columns)
+            .filter(ScanCall.call_date >= self._since(days))
+            .group_by(group_column)
+            .all()
+        )
+
+    @staticmethod
+    def _rollup_from_row(key, row) -> CallRollup:
+        return CallRollup(
+            key=key, label=str(key), calls=row.calls, files=row.files, failures=row.failures, retries=row.retries,
+            prompt_tokens=row.prompt_tokens, candidates_tokens=row.candidates_tokens, bytes_sent=row.bytes_sent,
+        )
+
+    def _apply_costs_and_latencies(self, db, group_column, days: int, rollups: dict):
+        since = self._since(days)
+        key_column = group_column if group_column is not None else ScanCall.model_name # 全体集計ではダミーのキー
+        # 料金はモデルごとに異なるため、グループ×モデルで集計してから合算する
+        cost_rows = (
+            db.query(key_column.label("key"), ScanCall.model_name,
+                     func.sum(ScanCall.prompt_tokens).label("prompt_tokens"),
+                     func.sum(ScanCall.candidates_tokens).label("candidates_tokens"))
+            .filter(ScanCall.call_date >= since)
+            .group_by(key_column, ScanCall.model_name)
+            .all()
+        )
+        for row in cost_rows:
+            rollup = rollups.get(row.key if group_column is not None else None)
+            if rollup is not None:
+                rollup.cost_usd += call_cost_usd(row.model_name, row.prompt_tokens or 0, row.candidates_tokens or 0)
+
+        # SQLiteには百分位数の集計関数がないため、グループ順・所要時間順に読み出して計算する
+        latency_rows = (
+            db.query(key_column.label("key"), ScanCall.latency_seconds)
+            .filter(ScanCall.call_date >= since, ScanCall.outcome != CALL_API_ERROR)
+            .order_by(key_column, ScanCall.latency_seconds)
+            .all()
+        )
+        latencies = {}
+        for row in latency_rows:
+            latencies.setdefault(row.key if group_column is not None else None, []).append(row.latency_seconds)
+        if group_column is None:
+            latencies = {None: sorted(latencies.get(None, []))}
+        for key, values in latencies.items():
+            rollup = rollups.get(key)
+            if rollup is not None:
+                rollup.p50_latency_seconds = percentile(values, 0.50)
+                rollup.p95_latency_seconds = percentile(values, 0.95)
+
+    @staticmethod
+    def _labels(db, group_by: str, keys: list) -> dict:
+        if group_by == ROLLUP_BY_DAY:
+            return {key: key.isoformat() for key in keys if key is not None}
+        model = OcrList if group_by == ROLLUP_BY_LIST else Condition
+        ids = [key for key in keys if key is not None]
+        names = {row.id: row.name for row in db.query(model.id, model.name).filter(model.id.in_(ids)).all()} if ids else {}
+        labels = {key: names.get(key, f"(削除済み #{key})") for key in ids}
+        labels[None] = "(不明)"
+        return labels
@@ -0,0 +1,356 @@
+"""
+GUIを使わずに一括スキャンを実行するコマンドラインツールです。
+
+例:
+    python -m scan --list 請求書2024 --condition 請求書 --concurrency 16
+    python scan_cli.py --list 請求書2024 --condition 請求書 --summary-json summary.json
+
+一括スキャンは永続ジョブキュー(scan_jobs)を通して実行されるため、中断・クラッシュしても
+    python -m scan --resume
+で残りのジョブから再開できます。
+
+APIキーは --api-key または環境変数 GEMINI_API_KEY で指定します。
+複数のキーを環境変数 GEMINI_API_KEYS（カンマ区切り）や api_keys.json に書いておくと、キーごとのクォータで振り分けます。
+--backend fake を指定するとAPIを呼ばずに合成値を返すため、APIキーなしでスループットを計測できます:
+    python -m scan --list 請求書2024 --condition 請求書 --backend fake --fake-latency 0.8 --fake-failure-rate 0.05
+
+--cascade-models に安価なモデルを指定すると、それらで先に抽出し、値の欠落や型・形式の確認に失敗した項目だけを --model で抽出し直します:
+    python -m scan --list 請求書2024 --condition 請求書 --model gemini-1.5-pro --cascade-models gemini-1.5-flash-8b
+
+API呼び出しはトークン数・所要時間とともに scan_calls に記録され、リスト・条件・日付ごとに集計できます:
+    python -m scan --usage-report condition --usage-days 7
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from models import create_db_and_tables, get_db, OcrList, Condition
+from scan_engine import ScanEngine, ScanSettings, ScanProgressListener, ScanOutcome, BatchSummary, DEFAULT_BATCH_CONCURRENCY
+from image_preprocess import PreprocessOptions, DEFAULT_MAX_PIXELS, DEFAULT_QUALITY
+from rate_limiter import DEFAULT_REQUESTS_PER_MIN, DEFAULT_TOKENS_PER_MIN, PRIORITY_CLASSES, PRIORITY_BULK
+from hedging import DEFAULT_MAX_HEDGE_RATE
+from api_keys import API_KEYS_FILE, ApiKeyConfig, load_api_keys
+from ocr_backends import BACKEND_NAMES, FakeBackendOptions, GEMINI_MODEL_NAME
+from scan_pipeline import DEFAULT_CPU_WORKERS
+from scan_calls import ScanCallRecorder, ROLLUP_GROUPS
+from near_duplicates import DEFAULT_MAX_DISTANCE
+from tracing import TRACE_FORMATS, TRACE_FORMAT_CHROME, LoopLagMonitor
+
+PROGRESS_INTERVAL_SECONDS = 5.0
+
+
+class ConsoleProgress(ScanProgressListener):
+    """進捗を標準出力に、エラーを標準エラー出力に書き出します。"""
+
+    def __init__(self):
+        self.last_progress_at = 0.0
+        self.reported_errors = set()
+
+    def on_file_finished(self, outcome: ScanOutcome):
+        if not outcome.succeeded:
+            print(f"失敗: {outcome.filename or outcome.file_id}: {outcome.error}", file=sys.stderr)
+
+    def on_batch_progress(self, summary: BatchSummary):
+        now = time.monotonic()
+        if summary.done == summary.total or now - self.last_progress_at >= PROGRESS_INTERVAL_SECONDS:
+            self.last_progress_at = now
+            print(summary.progress_text(), flush=True)
+
+    def on_error(self, message: str):
+        # 同じエラー(APIキー不正など)が全ファイルで繰り返し出力されないようにする
+        if message not in self.reported_errors:
+            self.reported_errors.add(message)
+            print(f"エラー: {message}", file=sys.stderr)
+
+
+def _find_by_name(model, name: str):
+    db = next(get_db())
+    try:
+        return db.query(model).filter(model.name == name).first()
+    finally:
+        db.close()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m scan", description="OCRリストのファイルを一括スキャンします。")
+    parser.add_argument("--list", dest="list_name", help="OCRリスト名")
+    parser.add_argument("--condition", dest="condition_name", help="条件名")
+    parser.add_argument("--resume", action="store_true", help="中断した一括スキャンの未完了ジョブを再開する (--list/--condition は不要)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_BATCH_CONCURRENCY, help="最大同時実行数")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY", ""), help="Gemini APIキー (既定: 環境変数 GEMINI_API_KEY)")
+    parser.add_argument("--api-keys-file", default=API_KEYS_FILE, help="複数のAPIキーを書いたJSONファイル (環境変数 GEMINI_API_KEYS と合わせて使う)")
+    parser.add_argument("--backend", choices=BACKEND_NAMES, default="gemini", help="OCRバックエンド (fake はAPIを呼ばない計測用)")
+    parser.add_argument("--model", default=GEMINI_MODEL_NAME, help="抽出に使うGeminiのモデル (カスケード時は最後に使う上位のモデル)")
+    parser.add_argument("--fake-latency", type=float, default=1.0, help="fake: レイテンシの中央値(秒)")
+    parser.add_argument("--fake-latency-sigma", type=float, default=0.5, help="fake: レイテンシのばらつき(対数正規分布のσ)")
+    parser.add_argument("--fake-failure-rate", type=float, default=0.0, help="fake: 一時エラー(503)の発生率")
+    parser.add_argument("--fake-throttle-rate", type=float, default=0.0, help="fake: クォータ超過(429)の発生率")
+    parser.add_argument("--fake-missing-rate", type=float, default=0.0, help="fake: 各項目の値を null にする確率（読み取れない項目の再現）")
+    parser.add_argument("--fake-seed", type=int, default=0, help="fake: 乱数シード")
+    parser.add_argument("--rescan", action="store_true", help="スキャン済みのファイルも再スキャンする")
+    parser.add_argument("--incremental", action="store_true", help="スキャン済みのファイルは、条件に追加されたデータ項目だけを抽出して追記する")
+    parser.add_argument("--reuse-near-duplicates", action="store_true", help="見た目がほぼ同じスキャン済み画像があれば、APIを呼ばずにその抽出結果を使う")
+    parser.add_argument("--near-duplicate-distance", type=int, default=DEFAULT_MAX_DISTANCE, help="類似とみなす pHash のハミング距離の上限 (0-64)")
+    parser.add_argument("--stream", action="store_true", help="応答をストリーミングで受信する（最初・最後の項目までの時間を計測）")
+    parser.add_argument("--hedge", action="store_true", help="直近の p95 を超えて応答のない呼び出しに、同じリクエストをもう1つ送る")
+    parser.add_argument("--max-hedge-rate", type=float, default=DEFAULT_MAX_HEDGE_RATE, help="重複リクエストを送る呼び出しの割合の上限 (0-1)")
+    parser.add_argument("--cascade-models", default="",
+                        help="--model の前に順に試す安価なモデル (カンマ区切り)。確認に失敗した項目だけを次のモデルに聞き直す")
+    parser.add_argument("--pack-size", type=int, default=1, help="1リクエストにまとめる画像の枚数 (1でまとめない)")
+    parser.add_argument("--priority", choices=PRIORITY_CLASSES, default=PRIORITY_BULK,
+                        help="ジョブの優先度クラス (同じプロセス・同じキューの他のスキャンとの割り当ての順番)")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_REQUESTS_PER_MIN, help="リクエスト数/分の上限")
+    parser.add_argument("--tpm", type=int, default=DEFAULT_TOKENS_PER_MIN, help="トークン数/分の上限")
+    parser.add_argument("--max-megapixels", type=float, default=DEFAULT_MAX_PIXELS / 1_000_000, help="送信画像の最大画素数(MP)")
+    parser.add_argument("--grayscale", action="store_true", help="送信画像をグレースケールにする")
+    parser.add_argument("--format", choices=["JPEG", "WEBP"], default="JPEG", help="送信画像の形式")
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY, help="送信画像の品質 (1-100)")
+    parser.add_argument("--no-preprocess", action="store_true", help="送信前の画像処理を行わない")
+    parser.add_argument("--summary-json", help="実行結果のサマリーをJSONで書き出すパス")
+    parser.add_argument("--trace-out", help="各段階の所要時間のトレースを書き出すパス")
+    parser.add_argument("--trace-format", choices=TRACE_FORMATS, default=TRACE_FORMAT_CHROME,
+                        help="トレースの形式 (chrome: chrome://tracing・Perfetto / otlp: OTLP/JSON)")
+    parser.add_argument("--cpu-workers", type=int, default=DEFAULT_CPU_WORKERS, help="画像の前処理に使うプロセス数 (0でプロセスを使わない)")
+    parser.add_argument("--measure-loop-lag", action="store_true", help="スキャン中のイベントループの遅延(p50/p95/最大)を計測する")
+    parser.add_argument("--no-offload", action="store_true", help="ファイル・DBの処理をスレッドプールに移さずイベントループ上で実行する（計測の比較用）")
+    parser.add_argument("--usage-report", choices=ROLLUP_GROUPS, help="スキャンせずに、記録したAPI呼び出しを list / condition / day ごとに集計して表示する")
+    parser.add_argument("--usage-days", type=int, default=30, help="--usage-report の集計期間(日)")
+    return parser
+
+
+def summary_to_dict(summary: BatchSummary, engine: ScanEngine) -> dict:
+    return {
+        "total": summary.total,
+        "done": summary.done,
+        "succeeded": summary.succeeded_count,
+        "failed": len(summary.failed),
+        "cancelled": summary.cancelled,
+        "elapsed_seconds": round(summary.elapsed_seconds, 3),
+        "files_per_min": round(summary.files_per_min, 2),
+        "cache_hits": engine.result_cache.hits,
+        "cache_misses": engine.result_cache.misses,
+        "bytes_before_preprocess": engine.preprocess_stats.original_bytes,
+        "bytes_after_preprocess": engine.preprocess_stats.processed_bytes,
+        "packed_calls_saved": engine.packing_stats.calls_saved,
+        "parse_succeeded": engine.parse_stats.parsed,
+        "parse_failures": dict(engine.parse_stats.failures),
+        "missing_fields": engine.parse_stats.missing_fields,
+        "incremental_items_requested": engine.incremental_stats.items_requested,
+        "incremental_items_skipped": engine.incremental_stats.items_skipped,
+        "median_first_field_seconds": round(engine.streaming_stats.median_first_field_seconds, 3),
+        "median_last_field_seconds": round(engine.streaming_stats.median_last_field_seconds, 3),
+        "near_duplicates_found": engine.near_duplicate_stats.found,
+        "near_duplicates_reused": engine.near_duplicate_stats.reused,
+        "near_duplicate_reuses": [
+            {"file_id": o.file_id, "filename": o.filename, "reused_from": o.reused_from}
+            for o in summary.outcomes if o.reused_from
+        ],
+        "cpu_workers": engine.pipeline_stats.cpu_workers,
+        "pipeline_queue_size": engine.pipeline_stats.queue_size,
+        "pipeline_max_queue_depth": engine.pipeline_stats.max_queue_depth,
+        "pipeline_mean_queue_wait_seconds": round(engine.pipeline_stats.mean_queue_wait_seconds, 3),
+        "pipeline_put_wait_seconds": round(engine.pipeline_stats.put_wait_seconds, 3),
+        "roi_files": engine.roi_stats.files,
+        "roi_pixels_saved": engine.roi_stats.total.pixels_saved,
+        "roi_tokens_saved": engine.roi_stats.total.tokens_saved,
+        "roi_per_file": [
+            {
+                "file_id": o.file_id, "filename": o.filename,
+                "full_pixels": o.roi_usage.full_pixels, "sent_pixels": o.roi_usage.sent_pixels,
+                "full_tokens": o.roi_usage.full_tokens, "sent_tokens": o.roi_usage.sent_tokens,
+            }
+            for o in summary.outcomes if o.roi_usage
+        ],
+        "backend": engine.backend.model_name,
+        "throttled": engine.throttle.throttled_count,
+        "retries": engine.throttle.retry_count,
+        "api_keys": [
+            {
+                "name": key.config.name, "calls": key.calls, "errors": key.errors, "throttled": key.throttled,
+                "calls_per_min": round(key.calls_per_min, 2), "health": round(key.health, 3),
+                "disabled": key.disabled_reason is not None,
+            }
+            for key in (engine.key_pool.keys if engine.key_pool else [])
+        ],
+        "hedge_calls": engine.hedging.stats.calls,
+        "hedged": engine.hedging.stats.hedged,
+        "hedge_rate": round(engine.hedging.stats.hedge_rate, 4),
+        "hedge_wins": engine.hedging.stats.hedge_wins,
+        "hedge_capped": engine.hedging.stats.capped,
+        "call_latency_p50_seconds": round(engine.hedging.stats.latency_percentile(0.5), 3),
+        "call_latency_p95_seconds": round(engine.hedging.stats.latency_percentile(0.95), 3),
+        "call_latency_p99_seconds": round(engine.hedging.stats.latency_percentile(0.99), 3),
+        "cascade_files": engine.cascade_stats.files,
+        "cascade_escalated_files": engine.cascade_stats.escalated_files,
+        "cascade_escalation_rate": round(engine.cascade_stats.escalation_rate, 4),
+        "cascade_escalated_fields": engine.cascade_stats.escalated_fields,
+        "cascade_unresolved_fields": engine.cascade_stats.unresolved_fields,
+        "cascade_calls_by_model": engine.cascade_stats.calls_by_model,
+        "cascade_cost_usd": round(engine.cascade_stats.cost_usd, 6),
+        "cascade_baseline_cost_usd": round(engine.cascade_stats.baseline_cost_usd, 6),
+        "cascade_latency_seconds": round(engine.cascade_stats.latency_seconds, 3),
+        "cascade_baseline_latency_seconds": (
+            round(engine.cascade_stats.baseline_latency_seconds, 3) if engine.cascade_stats.baseline_latency_seconds is not None else None
+        ),
+        "failures": [
+            {"file_id": o.file_id, "filename": o.filename, "error": o.error}
+            for o in summary.failed
+        ],
+    }
+
+
+def print_usage_report(group_by: str, days: int):
+    recorder = ScanCallRecorder()
+    print(f"直近 {days} 日: " + recorder.totals(days).summary_text())
+    for rollup in recorder.rollup(group_by, days):
+        print(f"  {rollup.label}: " + rollup.summary_text())
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    create_db_and_tables()
+    if args.usage_report:
+        print_usage_report(args.usage_report, args.usage_days)
+        return 0
+
+    if not args.resume:
+        if not args.list_name or not args.condition_name:
+            print("エラー: --list と --condition を指定してください（再開する場合は --resume）。", file=sys.stderr)
+            return 2
+        ocr_list = _find_by_name(OcrList, args.list_name)
+        if ocr_list is None:
+            print(f"エラー: OCRリスト「{args.list_name}」が見つかりません。", file=sys.stderr)
+            return 2
+        condition = _find_by_name(Condition, args.condition_name)
+        if condition is None:
+            print(f"エラー: 条件「{args.condition_name}」が見つかりません。", file=sys.stderr)
+            return 2
+    api_keys = load_api_keys(args.api_keys_file)
+    if api_keys and args.api_key and all(config.key != args.api_key for config in api_keys):
+        api_keys.append(ApiKeyConfig("--api-key", args.api_key, max(1, args.rpm), max(1, args.tpm)))
+    if args.backend == "gemini" and not args.api_key and not api_keys:
+        print("エラー: --api-key・環境変数 GEMINI_API_KEY・GEMINI_API_KEYS・api_keys.json のいずれかでAPIキーを指定してください。", file=sys.stderr)
+        return 2
+
+    settings = ScanSettings(
+        api_key=args.api_key,
+        api_keys=api_keys,
+        backend_name=args.backend,
+        model_name=args.model,
+        fake=FakeBackendOptions(
+            latency_median=max(0.0, args.fake_latency),
+            latency_sigma=max(0.0, args.fake_latency_sigma),
+            failure_rate=max(0.0, min(args.fake_failure_rate, 1.0)),
+            throttle_rate=max(0.0, min(args.fake_throttle_rate, 1.0)),
+            missing_rate=max(0.0, min(args.fake_missing_rate, 1.0)),
+            seed=args.fake_seed,
+        ),
+        preprocess=PreprocessOptions(
+            enabled=not args.no_preprocess,
+            max_pixels=int(args.max_megapixels * 1_000_000),
+            grayscale=args.grayscale,
+            output_format=args.format,
+            quality=max(1, min(args.quality, 100)),
+        ),
+        max_concurrency=max(1, args.concurrency),
+        pack_size=max(1, args.pack_size),
+        streaming=args.stream,
+        incremental=args.incremental,
+        requests_per_min=max(1, args.rpm),
+        tokens_per_min=max(1, args.tpm),
+        offload_blocking_io=not args.no_offload,
+        cpu_workers=max(0, args.cpu_workers),
+        reuse_near_duplicates=args.reuse_near_duplicates,
+        near_duplicate_max_distance=max(0, min(args.near_duplicate_distance, 64)),
+        hedge_requests=args.hedge,
+        max_hedge_rate=max(0.0, min(args.max_hedge_rate, 1.0)),
+        cascade_models=[name.strip() for name in args.cascade_models.split(",") if name.strip()],
+    )
+    engine = ScanEngine(settings=settings, listener=ConsoleProgress())
+    if args.resume:
+        pending_jobs = engine.job_queue.unfinished_count()
+        if not pending_jobs:
+            print("再開する未完了のジョブはありません。")
+            return 0
+        print(f"未完了のジョブ {pending_jobs} 件を再開します (同時実行数 {settings.max_concurrency})")
+        engine.tracer.set_history(pending_jobs * 2) # CLIでは今回のすべてのスキャンのトレースを残す（前処理段階とAPI段階で2件ずつ）
+        batch = engine.run_jobs()
+    else:
+        file_ids = engine.pending_file_ids(ocr_list.id, include_scanned=args.rescan)
+        if args.incremental and not args.rescan:
+            file_ids += engine.files_missing_items(ocr_list.id, condition.id)
+        if not file_ids:
+            print("スキャン対象のファイルはありません。")
+            return 0
+        print(f"{len(file_ids)} 件のファイルをスキャンします (同時実行数 {settings.max_concurrency})")
+        engine.tracer.set_history(len(file_ids) * 2) # CLIでは今回のすべてのスキャンのトレースを残す（前処理段階とAPI段階で2件ずつ）
+        batch = engine.run_batch(file_ids, condition.id, args.priority)
+    loop_lag = None
+
+    async def run_measured():
+        nonlocal loop_lag
+        monitor = LoopLagMonitor()
+        monitor.start()
+        try:
+            return await batch
+        finally:
+            loop_lag = await monitor.stop()
+
+    try:
+        summary = asyncio.run(run_measured() if args.measure_loop_lag else batch)
+    except KeyboardInterrupt:
+        print("中断されました。--resume で再開できます。", file=sys.stderr)
+        return 130
+    finally:
+        engine.shutdown()
+
+    result = summary_to_dict(summary, engine)
+    if loop_lag is not None:
+        result["loop_lag_p50_ms"] = round(loop_lag.p50_seconds * 1000, 2)
+        result["loop_lag_p95_ms"] = round(loop_lag.p95_seconds * 1000, 2)
+        result["loop_lag_max_ms"] = round(loop_lag.max_seconds * 1000, 2)
+    print(
+        f"完了: {result['succeeded']} 件成功 / {result['failed']} 件失敗 | "
+        f"{result['elapsed_seconds']:.1f} 秒 | {result['files_per_min']:.1f} ファイル/分"
+    )
+    print(engine.result_cache.summary_text())
+    print(engine.preprocess_stats.summary_text())
+    print(engine.parse_stats.summary_text())
+    if settings.incremental:
+        print(engine.incremental_stats.summary_text())
+    if settings.reuse_near_duplicates:
+        print(engine.near_duplicate_stats.summary_text())
+    if engine.roi_stats.files:
+        print(engine.roi_stats.summary_text())
+    if settings.streaming:
+        print(engine.streaming_stats.summary_text())
+    print(engine.pipeline_stats.summary_text())
+    print(engine.throttle.summary_text())
+    if engine.key_pool:
+        for line in engine.key_pool.summary_lines():
+            print(f"  {line}")
+    print(engine.hedging.stats.summary_text())
+    if settings.cascade_models:
+        print(engine.cascade_stats.summary_text())
+    if loop_lag is not None:
+        print(loop_lag.summary_text())
+    print("段階ごとの所要時間 (段階: 回数 / 合計 / p50 / p95 / 最大):")
+    for timing in engine.tracer.stage_timings():
+        print(
+            f"  {timing.stage}: {timing.count} / {timing.total_seconds:.3f}秒 / {timing.p50_seconds:.3f}秒"
+            f" / {timing.p95_seconds:.3f}秒 / {timing.max_seconds:.3f}秒"
+        )
+    if args.trace_out:
+        span_count = engine.tracer.export(args.trace_out, args.trace_format)
+        print(f"トレースを書き出しました ({span_count} スパン): {args.trace_out}")
+    if args.summary_json:
+        with open(args.summary_json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"サマリーを書き出しました: {args.summary_json}")
+    return 1 if summary.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1163 @@
+import asyncio
+import contextvars
+import datetime
+import functools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from sqlalchemy.orm import joinedload
+from models import get_db, Condition, UploadedFile, ScannedData, DataItem
+from scan_cache import ScanResultCacheStore, compute_file_sha256, make_cache_key
+from pdf_pages import count_pdf_pages, iter_pdf_page_images
+from request_packing import PackingStats
+from rate_limiter import GeminiThrottle, DEFAULT_REQUESTS_PER_MIN, DEFAULT_TOKENS_PER_MIN, PRIORITY_NORMAL, current_priority, priority_scope
+from hedging import HedgingPolicy, DEFAULT_MAX_HEDGE_RATE
+from cascade import CascadeStats, FAIL_MISSING, check_value, failing_items
+from image_preprocess import PreprocessOptions, PreprocessStats
+from scan_jobs import ScanJobQueue, ClaimedJob, new_worker_id
+from response_schema import ResponseSchemaCache, ResponseParseError, ParseStats
+from streaming import IncrementalFieldParser, StreamingStats
+from scan_calls import CALL_API_ERROR, CALL_OK, CALL_PARSE_ERROR, CallContext, CallTimer, ScanCallRecorder
+from tracing import Tracer
+from roi import RoiPlan, RoiStats, RoiUsage, plan_regions
+from scan_pipeline import PreparedImage, PipelineStats, prepare_image, DEFAULT_CPU_WORKERS, PREPARED_QUEUE_PER_API_WORKER
+from near_duplicates import NearDuplicate, NearDuplicateIndex, NearDuplicateStats, DEFAULT_MAX_DISTANCE
+from api_keys import ApiKeyConfig, ApiKeyPool, PooledBackend
+from ocr_backends import OcrBackend, BackendConfigError, FakeBackendOptions, create_backend, GEMINI_MODEL_NAME
+
+APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BATCH_CONCURRENCY = 4 # 一括スキャン時の同時実行数の初期値
+MAX_BATCH_CONCURRENCY = 64
+IMAGE_FILE_TYPES = ["png", "jpg", "jpeg"]
+IO_THREAD_COUNT = 4 # ファイル読み込み・ハッシュ計算・DB操作を実行するスレッド数
+
+
+@dataclass
+class ScanSettings:
+    """スキャン1回分の設定です。画面の入力値やCLI引数から組み立てます。"""
+    api_key: str = ""
+    api_keys: list[ApiKeyConfig] = field(default_factory=list) # 2件以上あればキーごとのクォータで振り分ける（api_key より優先）
+    backend_name: str = "gemini" # "gemini" または "fake"（APIを呼ばない計測・テスト用）
+    model_name: str = GEMINI_MODEL_NAME
+    fake: FakeBackendOptions = field(default_factory=FakeBackendOptions)
+    preprocess: PreprocessOptions = field(default_factory=PreprocessOptions)
+    max_concurrency: int = DEFAULT_BATCH_CONCURRENCY
+    pack_size: int = 1 # 2以上で一括スキャン時にまとめ送信
+    streaming: bool = False # 応答をストリーミングで受信し、確定した項目から順に通知する（まとめ送信時は無効）
+    incremental: bool = False # スキャン済みファイルは、まだ保存されていないデータ項目だけを抽出して追記する
+    requests_per_min: int = DEFAULT_REQUESTS_PER_MIN
+    tokens_per_min: int = DEFAULT_TOKENS_PER_MIN
+    offload_blocking_io: bool = True # ファイル・DBの同期処理をスレッドプールで実行する（False はイベントループ上で実行、計測の比較用）
+    cpu_workers: int = DEFAULT_CPU_WORKERS # 画像の前処理を実行するプロセス数（0 はプロセスを使わずスレッドで実行）
+    reuse_near_duplicates: bool = False # 見た目がほぼ同じスキャン済み画像があれば、APIを呼ばずにその抽出結果を使う
+    near_duplicate_max_distance: int = DEFAULT_MAX_DISTANCE # pHash のハミング距離の上限
+    hedge_requests: bool = False # 直近の p95 を超えて応答のない呼び出しに、同じリクエストをもう1つ送る
+    max_hedge_rate: float = DEFAULT_MAX_HEDGE_RATE # 重複リクエストを送る呼び出しの割合の上限
+    # model_name の前に順に試す安価なモデル。値の欠落や型・形式の確認に失敗した項目だけを次のモデルに聞き直す（まとめ送信は行わない）
+    cascade_models: list[str] = field(default_factory=list)
+
+
+@dataclass
+class ScanOutcome:
+    file_id: int
+    succeeded: bool
+    error: str | None = None
+    filename: str | None = None
+    from_cache: bool = False
+    roi_usage: RoiUsage | None = None # 領域切り抜きを使った場合の、ページ全体と比べた画素数・トークン数
+    reused_from: str | None = None # 類似ファイルの抽出結果を再利用した場合、そのファイル名
+
+
+@dataclass
+class PreparedScan:
+    """前処理段階(_prepare_scan)の結果です。API段階(_complete_scan)に渡します。"""
+    outcome: ScanOutcome # error が設定されていれば準備の段階で失敗している
+    condition_id: int
+    file_obj: UploadedFile | None = None
+    condition: Condition | None = None
+    physical_file_path: str = ""
+    image_sha256: str = ""
+    stored_names: dict = field(default_factory=dict) # 差分スキャン時の保存済みのデータ項目名
+    call_context: CallContext | None = None
+    roi_usage: RoiUsage = field(default_factory=RoiUsage)
+    items_to_extract: list[DataItem] = field(default_factory=list)
+    cache_key: str | None = None
+    image: PreparedImage | None = None # 送信待ちの前処理済み画像
+    page_results: dict | None = None # APIを呼ばずに確定した結果（キャッシュヒット・類似ファイルの再利用・抽出する項目なし）
+    prepared_at: float = 0.0
+
+
+@dataclass
+class BatchSummary:
+    total: int
+    outcomes: list[ScanOutcome] = field(default_factory=list)
+    elapsed_seconds: float = 0.0
+    cancelled: bool = False
+
+    @property
+    def done(self) -> int:
+        return len(self.outcomes)
+
+    @property
+    def failed(self) -> list[ScanOutcome]:
+        return [o for o in self.outcomes if not o.succeeded]
+
+    @property
+    def succeeded_count(self) -> int:
+        return self.done - len(self.failed)
+
+    @property
+    def files_per_min(self) -> float:
+        return self.done / self.elapsed_seconds * 60 if self.elapsed_seconds > 0 else 0.0
+
+    def progress_text(self) -> str:
+        return f"{self.done}/{self.total} 完了 (失敗 {len(self.failed)}) | {self.files_per_min:.1f} ファイル/分"
+
+
+class IncrementalScanStats:
+    """差分スキャンで要求を省略できたデータ項目数を集計します。"""
+
+    def __init__(self):
+        self.files = 0
+        self.items_requested = 0
+        self.items_skipped = 0
+
+    def record(self, requested: int, skipped: int):
+        self.files += 1
+        self.items_requested += requested
+        self.items_skipped += skipped
+
+    @property
+    def skip_ratio(self) -> float:
+        total = self.items_requested + self.items_skipped
+        return self.items_skipped / total if total else 0.0
+
+    def summary_text(self) -> str:
+        return (
+            f"差分スキャン: {self.files} 件 | 要求した項目 {self.items_requested} / 省略した項目 {self.items_skipped}"
+            f" (省略率 {self.skip_ratio:.0%})"
+        )
+
+
+class ScanProgressListener:
+    """
+    ScanEngine からの進捗通知を受け取るインターフェースです。
+    画面(ScanScreen)やCLIは必要なメソッドだけをオーバーライドします。
+    """
+
+    def on_file_started(self, file_id: int):
+        pass
+
+    def on_file_status(self, file_id: int, message: str):
+        """ファイル単位の途中経過（PDFのページ進捗など）です。"""
+        pass
+
+    def on_file_finished(self, outcome: ScanOutcome):
+        pass
+
+    def on_batch_progress(self, summary: BatchSummary):
+        pass
+
+    def on_stats_changed(self):
+        """キャッシュ・前処理・まとめ送信・応答解析・API制御の統計が更新されたときに呼ばれます。"""
+        pass
+
+    def on_field_extracted(self, file_id: int, page_number: int | None, item_name: str, value: str | None):
+        """ストリーミング受信中に、項目の値が確定するたびに呼ばれます（保存前の暫定値です）。"""
+        pass
+
+    def on_error(self, message: str):
+        """利用者に知らせるべきエラー（APIキー未入力など）です。"""
+        pass
+
+
+class ScanError(Exception):
+    """利用者向けのメッセージを持つスキャン失敗です。"""
+
+
+def with_unread_items(data_items: list[DataItem], extracted: dict) -> dict:
+    """
+    要求したデータ項目のうち値が読み取れなかったものを None として補います。
+    None の行も保存しておくことで、差分スキャンで同じ項目を再度要求しないようにします。
+    """
+    return {item.name: extracted.get(item.name) for item in data_items}
+
+
+class ScanEngine:
+    """
+    UIに依存しないスキャン処理本体です（ファイル読み込み・プロンプト生成・API呼び出し・解析・DB書き込み）。
+    ScanScreen とコマンドライン(scan_cli.py)の両方から利用します。
+    """
+
+    def __init__(self, settings: ScanSettings | None = None, listener: ScanProgressListener | None = None, db_context=get_db):
+        self.settings = settings or ScanSettings()
+        self.listener = listener or ScanProgressListener()
+        self.db_context = db_context
+        self.result_cache = ScanResultCacheStore()
+        self.preprocess_stats = PreprocessStats()
+        self.packing_stats = PackingStats()
+        self.response_schemas = ResponseSchemaCache()
+        self.parse_stats = ParseStats()
+        self.streaming_stats = StreamingStats()
+        self.incremental_stats = IncrementalScanStats()
+        self.roi_stats = RoiStats()
+        self.near_duplicates = NearDuplicateIndex(self.settings.near_duplicate_max_distance)
+        self.near_duplicate_stats = NearDuplicateStats()
+        self.throttle = GeminiThrottle(max_concurrency=self.settings.max_concurrency)
+        self.hedging = HedgingPolicy(self.settings.hedge_requests, self.settings.max_hedge_rate)
+        self.backend: OcrBackend = self._create_backend(self.settings)
+        self.cascade_backends = {} # モデル名 -> カスケードの前段で使うバックエンド
+        self.cascade_stats = CascadeStats()
+        self._configure_throttle(self.settings)
+        self.job_queue = ScanJobQueue(db_context=db_context)
+        # ファイル・DBの同期処理の実行先。イベントループを止めず、UIの更新や他のスキャンのAPI呼び出しと重ねて実行する
+        self.io_executor = ThreadPoolExecutor(max_workers=IO_THREAD_COUNT, thread_name_prefix="scan-io")
+        # 画像のデコード・縮小・再エンコードはCPU負荷が高くGILで直列化されるため、別プロセスで実行する（初回の利用時に作成）
+        self.cpu_executor = None
+        self.cpu_executor_workers = 0
+        self.pipeline_stats = PipelineStats()
+        self.call_recorder = ScanCallRecorder(db_context=db_context, executor=self.io_executor)
+        self.tracer = Tracer()
+        self.cancel_requested = False
+
+    def apply_settings(self, settings: ScanSettings):
+        # バックエンドは状態（フェイクの試行回数、キーごとの健全性・休止・統計など）を持つため、
+        # バックエンドの設定が変わったときだけ作り直す。キーの一覧だけが変わった場合は、設定が同じキーの状態を引き継ぐ
+        if self._backend_signature(settings) != self._backend_signature(self.settings):
+            self.backend = self._create_backend(settings, self.key_pool if self._same_backend_except_keys(settings) else None)
+            self.cascade_backends = {}
+        self.settings = settings
+        self.near_duplicates.max_distance = settings.near_duplicate_max_distance
+        self._configure_throttle(settings)
+        self.hedging.configure(settings.hedge_requests, settings.max_hedge_rate)
+
+    def _configure_throttle(self, settings: ScanSettings):
+        if self.key_pool is not None:
+            # キーごとの上限はプールで守り、全体の上限はキーの上限の合計にする
+            self.throttle.configure(self.key_pool.requests_per_min, self.key_pool.tokens_per_min, settings.max_concurrency)
+        else:
+            self.throttle.configure(settings.requests_per_min, settings.tokens_per_min, settings.max_concurrency)
+
+    @staticmethod
+    def _backend_signature(settings: ScanSettings) -> tuple:
+        """
+        バックエンドの作成に使う設定です。これが変わらない限り同じバックエンドを使い続けます。
+        複数のキーを使う場合、単独のキーの入力欄(api_key)は使わないため含めません。
+        """
+        api_key = None if len(settings.api_keys) > 1 else settings.api_key
+        return (settings.backend_name, api_key, settings.api_keys, settings.model_name, settings.fake)
+
+    def _same_backend_except_keys(self, settings: ScanSettings) -> bool:
+        return (settings.backend_name, settings.model_name, settings.fake) == \
+            (self.settings.backend_name, self.settings.model_name, self.settings.fake)
+
+    @staticmethod
+    def _create_backend(settings: ScanSettings, previous_pool: ApiKeyPool | None = None) -> OcrBackend:
+        """previous_pool を渡すと、設定が同じキーの状態（クライアント・レート制限・健全性・統計）をそのまま使います。"""
+        if len(settings.api_keys) > 1:
+            pool = ApiKeyPool(settings.api_keys, lambda config: create_backend(settings.backend_name, config.key, settings.model_name, settings.fake),
+                              previous_pool)
+            return PooledBackend(pool, pool.keys[0].backend.model_name)
+        api_key = settings.api_keys[0].key if settings.api_keys else settings.api_key
+        return create_backend(settings.backend_name, api_key, settings.model_name, settings.fake)
+
+    def _backend_for(self, model_name: str) -> OcrBackend:
+        """カスケードの各段で使うバックエンドです。フェイクバックエンドはモデルを区別しないため共有します。"""
+        if model_name == self.settings.model_name or self.settings.backend_name == "fake":
+            return self.backend
+        if model_name not in self.cascade_backends:
+            self.cascade_backends[model_name] = self._create_backend(replace(self.settings, model_name=model_name))
+        return self.cascade_backends[model_name]
+
+    @property
+    def key_pool(self) -> ApiKeyPool | None:
+        """複数のAPIキーを使っている場合のキーのプールです。"""
+        return self.backend.pool if isinstance(self.backend, PooledBackend) else None
+
+    async def _blocking(self, func, *args):
+        """
+        ファイル・DBの同期処理を io_executor のスレッドで実行して結果を返します。
+        トレースのスパンが親子関係を保つよう、呼び出し元の contextvars を引き継ぎます。
+        1つのセッションは await で順番に使うため、同時に複数のスレッドから操作されることはありません。
+        """
+        if not self.settings.offload_blocking_io:
+            return func(*args)
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, functools.partial(context.run, func, *args))
+
+    def _cpu_pool(self) -> ProcessPoolExecutor:
+        workers = max(1, self.settings.cpu_workers)
+        if self.cpu_executor is None or self.cpu_executor_workers != workers:
+            if self.cpu_executor is not None:
+                self.cpu_executor.shutdown(wait=False)
+            self.cpu_executor = ProcessPoolExecutor(max_workers=workers)
+            self.cpu_executor_workers = workers
+        return self.cpu_executor
+
+    async def _cpu(self, func, *args):
+        """CPU負荷の高い処理を前処理用のプロセスで実行します。cpu_workers が0の場合は io_executor のスレッドで実行します。"""
+        if self.settings.cpu_workers <= 0:
+            return await self._blocking(func, *args)
+        return await asyncio.get_running_loop().run_in_executor(self._cpu_pool(), func, *args)
+
+    def shutdown(self):
+        """スレッドプールと前処理用のプロセスを終了します。"""
+        self.io_executor.shutdown(wait=True)
+        if self.cpu_executor is not None:
+            self.cpu_executor.shutdown(wait=True)
+            self.cpu_executor = None
+
+    async def flush_call_records(self):
+        """バッファ中のAPI呼び出しの記録(scan_calls)を書き込みます。"""
+        await self._blocking(self.call_recorder.flush)
+
+    def cancel(self):
+        """実行中の一括スキャンを停止します。処理中のファイルは完了まで待ち、待機中のジョブは取り消します。"""
+        self.cancel_requested = True
+
+    # --- 対象ファイルの取得 ---
+
+    def pending_file_ids(self, ocr_list_id: int, include_scanned: bool = False) -> list[int]:
+        db = next(self.db_context())
+        try:
+            query = db.query(UploadedFile.id).filter(UploadedFile.ocr_list_id == ocr_list_id)
+            if not include_scanned:
+                query = query.filter(UploadedFile.is_scanned == False)
+            return [row.id for row in query.order_by(UploadedFile.filename).all()]
+        finally:
+            db.close()
+
+    def files_missing_items(self, ocr_list_id: int, condition_id: int) -> list[int]:
+        """スキャン済みのファイルのうち、条件の現在のデータ項目の一部がまだ保存されていないものを返します。"""
+        db = next(self.db_context())
+        try:
+            condition = db.query(Condition).options(joinedload(Condition.data_items)).filter(Condition.id == condition_id).first()
+            if condition is None:
+                return []
+            current_names = {item.name for item in condition.data_items}
+            scanned_files = db.query(UploadedFile.id).filter(
+                UploadedFile.ocr_list_id == ocr_list_id, UploadedFile.is_scanned == True
+            ).order_by(UploadedFile.filename).all()
+            stored = self._stored_item_names(db, [row.id for row in scanned_files], condition_id)
+            return [
+                row.id for row in scanned_files
+                if row.id not in stored or any(current_names - names for names in stored[row.id].values())
+            ]
+        finally:
+            db.close()
+
+    @staticmethod
+    def _stored_item_names(db, file_ids: list[int], condition_id: int) -> dict[int, dict]:
+        """{ファイルID: {ページ番号: 保存済みのデータ項目名の集合}} を返します。"""
+        stored = {}
+        if not file_ids:
+            return stored
+        rows = db.query(ScannedData.uploaded_file_id, ScannedData.page_number, ScannedData.data_item_name).filter(
+            ScannedData.condition_id == condition_id,
+            ScannedData.uploaded_file_id.in_(file_ids),
+        ).distinct().all()
+        for row in rows:
+            stored.setdefault(row.uploaded_file_id, {}).setdefault(row.page_number, set()).add(row.data_item_name)
+        return stored
+
+    # --- 類似ファイルの抽出結果の再利用 ---
+
+    async def find_near_duplicate(self, file_id: int, condition_id: int) -> NearDuplicate | None:
+        """file_id の画像と見た目がほぼ同じで、条件のデータ項目がすべて抽出済みのファイルを探します（単体スキャン前の確認用）。"""
+        db = self._open_session()
+        try:
+            file_obj, condition = await self._blocking(self._load_scan_target, db, file_id, condition_id)
+            if file_obj is None or condition is None:
+                return None
+            return await self._blocking(self._find_near_duplicate, db, file_obj, condition)
+        finally:
+            await self._blocking(db.close)
+
+    async def reuse_extraction(self, file_id: int, source_file_id: int, condition_id: int) -> ScanOutcome:
+        """source_file_id の抽出結果を file_id の結果として保存します（APIは呼びません）。"""
+        self.listener.on_file_started(file_id)
+        outcome = ScanOutcome(file_id=file_id, succeeded=False)
+        db = self._open_session()
+        try:
+            file_obj, condition = await self._blocking(self._load_scan_target, db, file_id, condition_id)
+            source = await self._blocking(db.get, UploadedFile, source_file_id)
+            if file_obj is None or condition is None or source is None:
+                outcome.error = "ファイルまたは条件が見つかりません。"
+                return outcome
+            outcome.filename = file_obj.filename
+            extracted = await self._blocking(self.near_duplicates.load_extraction, db, source_file_id, condition_id,
+                                             {item.name for item in condition.data_items})
+            await self._blocking(self.save_scan_results, db, file_obj, condition_id, {None: with_unread_items(condition.data_items, extracted)})
+            self.near_duplicate_stats.reused += 1
+            outcome.reused_from = source.filename
+            outcome.succeeded = True
+        except Exception as e:
+            await self._blocking(db.rollback)
+            print(f"抽出結果の再利用中にエラー発生: {e}")
+            outcome.error = f"抽出結果の再利用中にエラー発生: {e}"
+        finally:
+            await self._blocking(db.close)
+            self.listener.on_stats_changed()
+            self.listener.on_file_finished(outcome)
+        return outcome
+
+    def _find_near_duplicate(self, db, file_obj: UploadedFile, condition: Condition) -> NearDuplicate | None:
+        if file_obj.filetype.lower() not in IMAGE_FILE_TYPES:
+            return None
+        with self.tracer.span("near_duplicate_lookup", file_id=file_obj.id):
+            self.near_duplicate_stats.checked += 1
+            if not self.near_duplicates.ensure_hashes(db, file_obj):
+                return None
+            duplicate = self.near_duplicates.find(db, file_obj, condition.id, {item.name for item in condition.data_items})
+            if duplicate is not None:
+                self.near_duplicate_stats.found += 1
+            return duplicate
+
+    def _reuse_near_duplicate(self, db, file_obj: UploadedFile, condition: Condition) -> tuple[NearDuplicate, dict] | None:
+        """一括スキャン用: 類似ファイルがあれば (類似ファイル, 抽出結果) を返します。"""
+        duplicate = self._find_near_duplicate(db, file_obj, condition)
+        if duplicate is None:
+            return None
+        self.near_duplicate_stats.reused += 1
+        print(f"類似ファイルの抽出結果を再利用: {file_obj.filename} ← {duplicate.filename} (距離 {duplicate.distance})")
+        return duplicate, self.near_duplicates.load_extraction(db, duplicate.file_id, condition.id, {item.name for item in condition.data_items})
+
+    # --- 単一ファイル ---
+
+    async def scan_file(self, file_id: int, condition_id: int, priority: str | None = None,
+                        reuse_near_duplicates: bool | None = None) -> ScanOutcome:
+        """
+        1ファイルをスキャンし、結果をScannedDataに保存します。各段階の所要時間は tracer にスパンとして記録します。
+        priority を指定すると、API呼び出しの同時実行数の枠をその優先度クラスで待ちます（省略時は呼び出し元のクラス）。
+        reuse_near_duplicates を指定すると、この呼び出しに限って settings の同名の設定の代わりに使います
+        （実行中の一括スキャンと共有する settings は変更しません）。
+        """
+        with priority_scope(priority or current_priority.get()):
+            with self.tracer.span("scan_file", file_id=file_id, condition_id=condition_id) as span:
+                outcome = await self._complete_scan(await self._prepare_scan(file_id, condition_id, reuse_near_duplicates))
+                if span is not None:
+                    span.attributes.update(succeeded=outcome.succeeded, from_cache=outcome.from_cache)
+                return outcome
+
+    async def _prepare_scan(self, file_id: int, condition_id: int, reuse_near_duplicates: bool | None = None) -> PreparedScan:
+        """
+        API呼び出しの前までを行います（読み込み・キャッシュ/類似ファイルの確認・画像の前処理）。
+        キャッシュヒットなどAPIを呼ぶ必要がない場合は、結果を page_results に入れて返します。
+        PDFはページごとに画像化しながら送信するため、ページの処理は _complete_scan で行います。
+        """
+        if reuse_near_duplicates is None:
+            reuse_near_duplicates = self.settings.reuse_near_duplicates
+        self.listener.on_file_started(file_id)
+        prepared = PreparedScan(ScanOutcome(file_id=file_id, succeeded=False), condition_id)
+        outcome = prepared.outcome
+        db = self._open_session()
+        try:
+            with self.tracer.span("db_load"):
+                file_to_scan, condition_used = await self._blocking(self._load_scan_target, db, file_id, condition_id)
+            if not file_to_scan or not condition_used:
+                outcome.error = "ファイルまたは条件が見つかりません。"
+                return prepared
+            outcome.filename = file_to_scan.filename
+            prepared.file_obj, prepared.condition = file_to_scan, condition_used
+
+            # 実際のファイルパスを構築 (UploadedFile.filepath は images/blobs/ab/cd/<sha256>.<ext> のような相対パス)
+            physical_file_path = os.path.join(APP_BASE_DIR, file_to_scan.filepath)
+            prepared.physical_file_path = physical_file_path
+            print(f"スキャン対象ファイル: {physical_file_path}")
+            if not await self._blocking(os.path.exists, physical_file_path):
+                outcome.error = "スキャン対象ファイルが見つかりません。"
+                return prepared
+
+            # 差分スキャン: 保存済みの {ページ番号: データ項目名の集合}。空なら全項目を抽出して置き換える
+            if self.settings.incremental and file_to_scan.is_scanned:
+                prepared.stored_names = (await self._blocking(self._stored_item_names, db, [file_id], condition_id)).get(file_id, {})
+
+            # キャッシュキーは 画像のSHA-256 + 条件のデータ項目 + モデル名（+ 切り抜き領域）
+            # 実体に保存したファイルはSHA-256が分かっているため、読み直して計算するのは移行前のファイルだけ
+            with self.tracer.span("sha256"):
+                prepared.image_sha256 = file_to_scan.blob_sha256 or await self._blocking(compute_file_sha256, physical_file_path)
+            prepared.call_context = CallContext(file_to_scan.ocr_list_id, condition_id, file_id)
+
+            if file_to_scan.filetype.lower() == "pdf":
+                return prepared # ページの画像化と送信は _complete_scan で1ページずつ行う
+            elif file_to_scan.filetype.lower() in IMAGE_FILE_TYPES:
+                items_to_extract = self._items_to_extract(condition_used.data_items, prepared.stored_names, None)
+                prepared.items_to_extract = items_to_extract
+                if not items_to_extract:
+                    prepared.page_results = {}
+                    return prepared
+                roi_plan = plan_regions(items_to_extract, condition_used.roi, condition_used.roi_layout)
+                cache_key = make_cache_key(prepared.image_sha256, items_to_extract, self._cache_model_name(), self._input_signature(roi_plan))
+                with self.tracer.span("cache_lookup"):
+                    extracted_data_dict = await self._blocking(self.result_cache.get, db, cache_key)
+                if extracted_data_dict is None and reuse_near_duplicates and not prepared.stored_names:
+                    reused = await self._blocking(self._reuse_near_duplicate, db, file_to_scan, condition_used)
+                    if reused is not None:
+                        outcome.reused_from = reused[0].filename
+                        extracted_data_dict = reused[1]
+                if extracted_data_dict is None:
+                    with self.tracer.span("read_file"):
+                        image_bytes = await self._blocking(self._read_file, physical_file_path)
+                    prepared.cache_key = cache_key
+                    prepared.image = await self.prepare_image(image_bytes, f"image/{file_to_scan.filetype.lower()}", roi_plan, prepared.roi_usage)
+                else:
+                    if not outcome.reused_from:
+                        print(f"キャッシュヒット: {file_to_scan.filename}")
+                        outcome.from_cache = True
+                    prepared.page_results = {None: with_unread_items(items_to_extract, extracted_data_dict)}
+            else:
+                raise ScanError(f"サポートされていないファイル形式です: {file_to_scan.filetype}")
+        except ScanError as e:
+            await self._blocking(db.rollback)
+            outcome.error = str(e)
+        except Exception as e:
+            await self._blocking(db.rollback)
+            print(f"スキャンの準備中にエラー発生: {e}")
+            outcome.error = f"スキャン中にエラー発生: {e}"
+        finally:
+            await self._blocking(db.close)
+            prepared.prepared_at = time.monotonic()
+        return prepared
+
+    async def _complete_scan(self, prepared: PreparedScan) -> ScanOutcome:
+        """_prepare_scan の結果を受け取り、API呼び出し・応答の解析・DBへの保存を行います。"""
+        outcome = prepared.outcome
+        if outcome.error is not None:
+            self.listener.on_stats_changed()
+            self.listener.on_file_finished(outcome)
+            return outcome
+        file_to_scan, condition_used, file_id = prepared.file_obj, prepared.condition, outcome.file_id
+        db = self._open_session()
+        try:
+            db.add(file_to_scan) # 準備段階のセッションは閉じているため、このセッションで更新できるようにする
+            # page_results は {ページ番号: {データ項目名: 値}}。画像ファイルはページ番号 None の1件のみ
+            if file_to_scan.filetype.lower() == "pdf":
+                page_results = await self._scan_pdf_pages(file_to_scan, prepared.physical_file_path, condition_used, prepared.image_sha256, db,
+                                                          prepared.stored_names, prepared.roi_usage, prepared.call_context)
+            elif prepared.image is not None:
+                extracted_data_dict = await self.extract_cascaded(
+                    prepared.image, prepared.items_to_extract,
+                    on_field=lambda name, value: self.listener.on_field_extracted(file_id, None, name, value),
+                    call_context=prepared.call_context,
+                )
+                prepared.image = None # 送信済みの画像をすぐに解放する
+                if extracted_data_dict:
+                    with self.tracer.span("cache_store"):
+                        await self._blocking(self.result_cache.put, db, prepared.cache_key, prepared.image_sha256, self.backend.model_name, extracted_data_dict)
+                page_results = {None: with_unread_items(prepared.items_to_extract, extracted_data_dict)}
+            else:
+                page_results = prepared.page_results
+
+            if prepared.stored_names:
+                requested = sum(len(values) for values in page_results.values())
+                page_count = file_to_scan.page_count or 1 if file_to_scan.filetype.lower() == "pdf" else 1
+                self.incremental_stats.record(requested, len(condition_used.data_items) * page_count - requested)
+            await self._blocking(self.save_scan_results, db, file_to_scan, prepared.condition_id, page_results, bool(prepared.stored_names))
+            roi_usage = prepared.roi_usage
+            if roi_usage.full_pixels:
+                self.roi_stats.record(roi_usage)
+                outcome.roi_usage = roi_usage
+                print(f"領域切り抜き ({file_to_scan.filename}): {roi_usage.summary_text()}")
+            outcome.succeeded = True
+        except ScanError as e:
+            await self._blocking(db.rollback)
+            outcome.error = str(e)
+        except Exception as e:
+            await self._blocking(db.rollback)
+            print(f"スキャンまたはDB操作中にエラー発生: {e}")
+            outcome.error = f"スキャン中にエラー発生: {e}"
+        finally:
+            await self._blocking(db.close)
+            self.listener.on_stats_changed()
+            self.listener.on_file_finished(outcome)
+        return outcome
+
+    async def _scan_pdf_pages(self, file_obj: UploadedFile, file_path: str, condition: Condition, file_sha256: str, db,
+                              stored_names: dict | None = None, roi_usage: RoiUsage | None = None,
+                              call_context: CallContext | None = None) -> dict:
+        """
+        PDFを1ページずつ画像化してスキャンします。
+        ページ画像はジェネレーターで逐次生成されるため、ページ数が多くても一度にメモリへ展開されません。
+        いずれかのページで抽出に失敗した場合は ScanError を送出します（成功したページはキャッシュに残るため再実行は安価です）。
+        stored_names が渡された場合（差分スキャン）、各ページで未保存のデータ項目だけを抽出します。
+        """
+        data_items = condition.data_items
+        stored_names = stored_names or {}
+        total_pages = await self._blocking(count_pdf_pages, file_path)
+        file_obj.page_count = total_pages
+        page_results = {}
+        file_counted = False
+        pages = iter_pdf_page_images(file_path)
+        while True:
+            # ページの画像化はスレッドで1ページずつ進める（ジェネレーターを同時に複数のスレッドで進めることはない）
+            with self.tracer.span("pdf_render"):
+                page = await self._blocking(next, pages, None)
+            if page is None:
+                break
+            page_number, page_png = page
+            items_to_extract = self._items_to_extract(data_items, stored_names, page_number)
+            if not items_to_extract:
+                continue
+            self.listener.on_file_status(file_obj.id, f"ページ {page_number}/{total_pages}")
+
+            # キャッシュはページ単位 (PDF全体のSHA-256 + ページ番号)
+            page_sha256 = f"{file_sha256}:p{page_number}"
+            roi_plan = plan_regions(items_to_extract, condition.roi, condition.roi_layout)
+            cache_key = make_cache_key(page_sha256, items_to_extract, self._cache_model_name(), self._input_signature(roi_plan))
+            with self.tracer.span("cache_lookup", page_number=page_number):
+                extracted = await self._blocking(self.result_cache.get, db, cache_key)
+            if extracted is None:
+                try:
+                    extracted = await self.extract_from_image(
+                        page_png, "image/png", items_to_extract,
+                        on_field=lambda name, value: self.listener.on_field_extracted(file_obj.id, page_number, name, value),
+                        roi_plan=roi_plan, roi_usage=roi_usage,
+                        # ファイル数の集計が重複しないよう、ファイルとして数えるのは最初に送信したページだけにする
+                        call_context=replace(call_context, page_number=page_number, file_count=0 if file_counted else 1) if call_context else None,
+                    )
+                    file_counted = True
+                except ScanError as e:
+                    raise ScanError(f"{page_number} ページ目の抽出に失敗しました: {e}") from e
+                if extracted:
+                    with self.tracer.span("cache_store", page_number=page_number):
+                        await self._blocking(self.result_cache.put, db, cache_key, page_sha256, self.backend.model_name, extracted)
+            page_results[page_number] = with_unread_items(items_to_extract, extracted)
+        return page_results
+
+    def _open_session(self):
+        # 読み込んだファイル・条件をコミット後も参照するため、コミット時に属性を失効させない
+        # （失効させるとイベントループ上で再読み込みのクエリが走る）
+        db = next(self.db_context())
+        db.expire_on_commit = False
+        return db
+
+    @staticmethod
+    def _load_scan_target(db, file_id: int, condition_id: int) -> tuple[UploadedFile | None, Condition | None]:
+        file_to_scan = db.query(UploadedFile).filter(UploadedFile.id == file_id).first()
+        condition_used = db.query(Condition).options(joinedload(Condition.data_items)).filter(Condition.id == condition_id).first()
+        return file_to_scan, condition_used
+
+    @staticmethod
+    def _load_packed_targets(db, file_ids: list[int], condition_id: int) -> tuple[Condition | None, list[UploadedFile]]:
+        condition_used = db.query(Condition).options(joinedload(Condition.data_items)).filter(Condition.id == condition_id).first()
+        files = db.query(UploadedFile).filter(UploadedFile.id.in_(file_ids)).all()
+        return condition_used, files
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _cache_model_name(self) -> str:
+        """キャッシュキーに使うモデル名です。"""
+        model_name = self.backend.model_name
+        if self.settings.cascade_models:
+            # 前段のモデルの値を含む結果を、最上位のモデルだけで抽出した結果と区別する
+            model_name = f"{model_name}|cascade:{','.join(self.settings.cascade_models)}"
+        return model_name
+
+    def _input_signature(self, roi_plan: RoiPlan | None) -> str:
+        """
+        キャッシュキーに使う、送信する画像の識別子です。前処理の設定（縮小・形式・画質・グレースケール）や
+        切り抜き領域が変わると、別の入力から抽出した結果として扱います。
+        """
+        signature = f"preprocess:{self.settings.preprocess.signature}"
+        if roi_plan is None:
+            return signature
+        return f"{signature}|roi:{roi_plan.signature}"
+
+    @staticmethod
+    def _items_to_extract(data_items: list[DataItem], stored_names: dict, page_number: int | None) -> list[DataItem]:
+        """差分スキャン時に、そのページでまだ保存されていないデータ項目を返します（差分スキャンでなければ全項目）。"""
+        if not stored_names:
+            return list(data_items)
+        stored = stored_names.get(page_number, set())
+        return [item for item in data_items if item.name not in stored]
+
+    def save_scan_results(self, db, file_obj: UploadedFile, condition_id: int, page_results: dict, merge: bool = False):
+        """
+        抽出結果 {ページ番号: {データ項目名: 値}} をScannedDataに保存し、ファイルをスキャン済みにします。
+        merge が True の場合（差分スキャン）は既存の行を残したまま、新しい項目の行だけを追加します。
+        """
+        with self.tracer.span("db_commit", file_id=file_obj.id):
+            if not merge:
+                # このファイルと条件に対する古いスキャンデータを削除（再スキャン時の重複を避けるため）
+                db.query(ScannedData).filter(ScannedData.uploaded_file_id == file_obj.id, ScannedData.condition_id == condition_id).delete()
+
+            for page_number, extracted_data_dict in page_results.items():
+                for item_name, extracted_value in extracted_data_dict.items():
+                    new_scan_data = ScannedData(
+                        uploaded_file_id=file_obj.id,
+                        condition_id=condition_id,
+                        page_number=page_number,
+                        data_item_name=item_name,
+                        extracted_value=extracted_value
+                    )
+                    db.add(new_scan_data)
+
+            file_obj.is_scanned = True
+            file_obj.scanned_at = datetime.datetime.utcnow()
+            db.commit()
+        self.near_duplicates.add(condition_id, file_obj)
+
+    # --- まとめ送信 ---
+
+    async def scan_packed_group(self, file_ids: list[int], condition_id: int) -> list[ScanOutcome]:
+        """
+        複数の画像ファイルを1回のAPI呼び出しでスキャンします。
+        キャッシュヒットしたファイルはその場で保存し、残りをまとめて送信します。
+        PDF・見つからないファイル・応答の解析に失敗したファイルは、1件ずつの通常スキャンに切り替えます。
+        """
+        with self.tracer.span("scan_packed_group", file_count=len(file_ids), condition_id=condition_id):
+            return await self._scan_packed_group(file_ids, condition_id)
+
+    async def _scan_packed_group(self, file_ids: list[int], condition_id: int) -> list[ScanOutcome]:
+        outcomes = {}
+        single_scan_ids = []
+        db = self._open_session()
+        try:
+            with self.tracer.span("db_load"):
+                condition_used, files = await self._blocking(self._load_packed_targets, db, file_ids, condition_id)
+            found_ids = {f.id for f in files}
+            single_scan_ids.extend(fid for fid in file_ids if fid not in found_ids)
+
+            to_pack = [] # (file_obj, image_sha256, cache_key)
+            for file_obj in files:
+                physical_file_path = os.path.join(APP_BASE_DIR, file_obj.filepath)
+                # 差分スキャンの対象（スキャン済み）ファイルは、項目がファイルごとに異なるため個別に送信する
+                # 領域切り抜きを設定した条件も、切り抜いた画像を送るため個別に送信する
+                if (condition_used is None or file_obj.filetype.lower() not in IMAGE_FILE_TYPES
+                        or not await self._blocking(os.path.exists, physical_file_path)
+                        or (self.settings.incremental and file_obj.is_scanned)
+                        or plan_regions(condition_used.data_items, condition_used.roi, condition_used.roi_layout) is not None):
+                    single_scan_ids.append(file_obj.id)
+                    continue
+                with self.tracer.span("sha256", file_id=file_obj.id):
+                    image_sha256 = file_obj.blob_sha256 or await self._blocking(compute_file_sha256, physical_file_path)
+                cache_key = make_cache_key(image_sha256, condition_used.data_items, self._cache_model_name(), self._input_signature(None))
+                with self.tracer.span("cache_lookup", file_id=file_obj.id):
+                    cached = await self._blocking(self.result_cache.get, db, cache_key)
+                if cached is not None:
+                    print(f"キャッシュヒット: {file_obj.filename}")
+                    await self._blocking(self.save_scan_results, db, file_obj, condition_id,
+                                         {None: with_unread_items(condition_used.data_items, cached)})
+                    outcomes[file_obj.id] = ScanOutcome(file_obj.id, True, filename=file_obj.filename, from_cache=True)
+                    continue
+                reused = None
+                if self.settings.reuse_near_duplicates:
+                    reused = await self._blocking(self._reuse_near_duplicate, db, file_obj, condition_used)
+                if reused is not None:
+                    await self._blocking(self.save_scan_results, db, file_obj, condition_id,
+                                         {None: with_unread_items(condition_used.data_items, reused[1])})
+                    outcomes[file_obj.id] = ScanOutcome(file_obj.id, True, filename=file_obj.filename, reused_from=reused[0].filename)
+                else:
+                    to_pack.append((file_obj, image_sha256, cache_key))
+
+            if len(to_pack) == 1:
+                single_scan_ids.append(to_pack[0][0].id)
+            elif to_pack:
+                for file_obj, _, _ in to_pack:
+                    self.listener.on_file_started(file_obj.id)
+
+                images = []
+                for file_obj, _, _ in to_pack:
+                    with self.tracer.span("read_file", file_id=file_obj.id):
+                        image_bytes = await self._blocking(self._read_file, os.path.join(APP_BASE_DIR, file_obj.filepath))
+                    images.append((image_bytes, f"image/{file_obj.filetype.lower()}"))
+                list_ids = {file_obj.ocr_list_id for file_obj, _, _ in to_pack}
+                call_context = CallContext(list_ids.pop() if len(list_ids) == 1 else None, condition_id, file_count=len(to_pack))
+                packed_results = await self.extract_packed(images, condition_used.data_items, call_context)
+
+                if packed_results is None:
+                    print(f"まとめ送信の応答を解析できませんでした。{len(to_pack)} 件を個別に送信します。")
+                    self.packing_stats.record_fallback(len(to_pack))
+                    single_scan_ids.extend(file_obj.id for file_obj, _, _ in to_pack)
+                else:
+                    self.packing_stats.record_packed_call(len(to_pack))
+                    for index, (file_obj, image_sha256, cache_key) in enumerate(to_pack, start=1):
+                        extracted_data_dict = packed_results[index]
+                        if extracted_data_dict:
+                            with self.tracer.span("cache_store", file_id=file_obj.id):
+                                await self._blocking(self.result_cache.put, db, cache_key, image_sha256, self.backend.model_name, extracted_data_dict)
+                        await self._blocking(self.save_scan_results, db, file_obj, condition_id,
+                                             {None: with_unread_items(condition_used.data_items, extracted_data_dict)})
+                        outcomes[file_obj.id] = ScanOutcome(file_obj.id, True, filename=file_obj.filename)
+        except Exception as e:
+            await self._blocking(db.rollback)
+            print(f"まとめ送信中にエラー発生: {e}")
+            single_scan_ids.extend(fid for fid in file_ids if fid not in outcomes and fid not in single_scan_ids)
+        finally:
+            await self._blocking(db.close)
+            self.listener.on_stats_changed()
+
+        for outcome in outcomes.values():
+            self.listener.on_file_finished(outcome)
+        for file_id in single_scan_ids:
+            outcomes[file_id] = await self.scan_file(file_id, condition_id)
+        return list(outcomes.values())
+
+    # --- 一括スキャン ---
+
+    async def run_batch(self, file_ids: list[int], condition_id: int, priority: str = PRIORITY_NORMAL) -> BatchSummary:
+        """file_ids を優先度クラス priority で永続ジョブキュー(scan_jobs)に積み、run_jobs で一括スキャンします。"""
+        batch_id = self.job_queue.enqueue(file_ids, condition_id, priority)
+        return await self.run_jobs(batch_id)
+
+    async def run_jobs(self, batch_id: str | None = None) -> BatchSummary:
+        """
+        scan_jobs から待機中のジョブを取得し、2段のパイプラインで並行スキャンします。
+        前処理段階（cpu_workers 個）はジョブを取得して読み込み・キャッシュ確認・画像の前処理までを行い、有限長のキューに入れます。
+        API段階（max_concurrency 個）はキューから取り出して送信・解析・保存を行います。
+        キューが満杯の間は前処理段階が待たされるため（背圧）、前処理済みの画像がメモリに溜まり続けることはありません。
+        停止時は、取得したまま送信していないジョブを job_queue.release で待機状態に戻してから取り消します。
+        pack_size が2以上の場合、最大 pack_size 件ずつ取得してまとめて送信します（カスケード時は1件ずつ送信します）。
+        batch_id が None の場合は、前回の起動時に中断したものを含むすべての未完了ジョブを再開します。
+        """
+        self.cancel_requested = False
+        self.apply_settings(self.settings)
+        concurrency = max(1, min(self.settings.max_concurrency, MAX_BATCH_CONCURRENCY))
+        # まとめ送信の応答は項目ごとに上位のモデルへ聞き直せないため、カスケード時は1件ずつ送る
+        pack_size = 1 if self.settings.cascade_models else max(1, self.settings.pack_size)
+        worker_id = new_worker_id()
+        held_job_ids = set()
+
+        summary = BatchSummary(total=await self._blocking(self.job_queue.unfinished_count, batch_id))
+        started_at = time.monotonic()
+        self.listener.on_batch_progress(summary)
+
+        api_worker_count = max(1, min(concurrency, summary.total))
+        prepare_worker_count = max(1, min(self.settings.cpu_workers, summary.total))
+        prepared_queue = asyncio.Queue(maxsize=api_worker_count * PREPARED_QUEUE_PER_API_WORKER)
+        self.pipeline_stats.cpu_workers = prepare_worker_count
+        self.pipeline_stats.queue_size = prepared_queue.maxsize
+
+        async def renew_leases():
+            # 長いPDFのスキャン中にリースが切れて他のワーカーに取られないよう、定期的に延長する
+            while True:
+                await asyncio.sleep(self.job_queue.lease_seconds / 3)
+                await self._blocking(self.job_queue.renew, worker_id, list(held_job_ids))
+
+        async def prepare_worker():
+            while not self.cancel_requested:
+                jobs = await self._blocking(self.job_queue.claim, worker_id, pack_size, batch_id)
+                if not jobs:
+                    # 前回の起動時（クラッシュ・強制終了）に実行中だったジョブは、リースが切れるのを待って引き継ぐ
+                    expires_at = await self._blocking(self.job_queue.next_foreign_lease_expiry, worker_id, batch_id)
+                    if expires_at is None:
+                        return
+                    remaining = (expires_at - datetime.datetime.utcnow()).total_seconds()
+                    await asyncio.sleep(min(max(remaining, 0.5), 5.0))
+                    continue
+                held_job_ids.update(job.id for job in jobs)
+                with priority_scope(jobs[0].priority): # 優先度の高い順に取得するため先頭のジョブのクラスを使う
+                    units = await self._prepare_claimed_jobs(jobs, pack_size)
+                put_started_at = time.monotonic()
+                await prepared_queue.put((jobs, units))
+                self.pipeline_stats.record_put(prepared_queue.qsize(), time.monotonic() - put_started_at)
+
+        async def api_worker():
+            while True:
+                item = await prepared_queue.get()
+                if item is None:
+                    return
+                jobs, units = item
+                if self.cancel_requested:
+                    # 停止が要求されたら、前処理済みでまだ送信していないジョブはリースの期限を待たずに待機状態へ戻す
+                    held_job_ids.difference_update(job.id for job in jobs)
+                    await self._blocking(self.job_queue.release, worker_id, [job.id for job in jobs])
+                    continue
+                with priority_scope(jobs[0].priority):
+                    outcomes = await self._complete_claimed_jobs(units)
+                outcomes_by_file = {o.file_id: o for o in outcomes}
+                for job in jobs:
+                    outcome = outcomes_by_file.get(job.uploaded_file_id)
+                    if outcome is not None and outcome.succeeded:
+                        await self._blocking(self.job_queue.finish, worker_id, job.id)
+                    else:
+                        await self._blocking(self.job_queue.finish, worker_id, job.id, (outcome and outcome.error) or "スキャンに失敗しました。")
+                # 終えるまでは held_job_ids に残し、途中で取り消された場合は最後に待機状態へ戻す
+                held_job_ids.difference_update(job.id for job in jobs)
+                summary.outcomes.extend(outcomes)
+                summary.elapsed_seconds = time.monotonic() - started_at
+                self.listener.on_batch_progress(summary)
+
+        async def prepare_stage():
+            try:
+                await asyncio.gather(*(prepare_worker() for _ in range(prepare_worker_count)))
+            finally:
+                # 前処理済みの作業をすべて送信し終えたらAPIワーカーを終了させる
+                for _ in range(api_worker_count):
+                    await prepared_queue.put(None)
+
+        renew_task = asyncio.create_task(renew_leases())
+        try:
+            await asyncio.gather(prepare_stage(), *(api_worker() for _ in range(api_worker_count)))
+        finally:
+            renew_task.cancel()
+            if held_job_ids:
+                # タスクごと取り消された場合に、取得したまま終えなかったジョブを待機状態へ戻す
+                await self._blocking(self.job_queue.release, worker_id, list(held_job_ids))
+            await self.flush_call_records()
+        if self.cancel_requested:
+            # 停止時は待機中のジョブを取り消す（次回の起動時に勝手に再開されないように）
+            summary.cancelled = await self._blocking(self.job_queue.cancel_queued, batch_id) > 0 or summary.done < summary.total
+        summary.elapsed_seconds = time.monotonic() - started_at
+        self.listener.on_batch_progress(summary)
+        return summary
+
+    async def _prepare_claimed_jobs(self, jobs: list[ClaimedJob], pack_size: int) -> list:
+        """
+        取得したジョブを条件ごとにまとめ、前処理段階の作業を行います。
+        1件ずつのスキャンは PreparedScan、まとめ送信は (ファイルIDのリスト, 条件ID) を返します。
+        """
+        jobs_by_condition = {}
+        for job in jobs:
+            jobs_by_condition.setdefault(job.condition_id, []).append(job.uploaded_file_id)
+        units = []
+        for condition_id, file_ids in jobs_by_condition.items():
+            if pack_size > 1 and len(file_ids) > 1:
+                # まとめ送信は画像の前処理を送信直前に並行して行う（キャッシュヒットしたファイルを除いてからまとめるため）
+                units.append((file_ids, condition_id))
+            else:
+                for file_id in file_ids:
+                    with self.tracer.span("scan_prepare", file_id=file_id, condition_id=condition_id):
+                        units.append(await self._prepare_scan(file_id, condition_id))
+        return units
+
+    async def _complete_claimed_jobs(self, units: list) -> list[ScanOutcome]:
+        """_prepare_claimed_jobs の結果を受け取り、API段階の作業を行います。"""
+        outcomes = []
+        for unit in units:
+            if isinstance(unit, PreparedScan):
+                queue_wait = time.monotonic() - unit.prepared_at
+                self.pipeline_stats.record_get(queue_wait)
+                with self.tracer.span("scan_api", file_id=unit.outcome.file_id, condition_id=unit.condition_id,
+                                      queue_wait_seconds=round(queue_wait, 3)):
+                    outcomes.append(await self._complete_scan(unit))
+            else:
+                file_ids, condition_id = unit
+                outcomes.extend(await self.scan_packed_group(file_ids, condition_id))
+        return outcomes
+
+    # --- OCRバックエンド呼び出し ---
+
+    async def prepare_image(self, image_bytes: bytes, mime_type: str, roi_plan: RoiPlan | None = None,
+                            roi_usage: RoiUsage | None = None) -> PreparedImage:
+        """
+        画像を領域の切り抜き（roi_plan がある場合）・前処理（有効な場合）して、バックエンドに渡す画像パートを返します。
+        処理は前処理用のプロセスで行い、切り抜きによる削減量は roi_usage に加算します。
+        """
+        with self.tracer.span("preprocess", original_bytes=len(image_bytes), roi=roi_plan is not None):
+            prepared = await self._cpu(prepare_image, image_bytes, mime_type, self.settings.preprocess, roi_plan)
+        if prepared.roi_crop is not None and roi_usage is not None:
+            roi_usage.add(prepared.roi_crop)
+        for result in prepared.preprocessed:
+            self.preprocess_stats.record(result)
+            print(f"画像前処理: {result.original_size} {result.original_bytes}B -> {result.processed_size} {result.processed_bytes}B")
+        return prepared
+
+    def _report_api_error(self, e: Exception) -> str:
+        # APIキー関連のエラーか、他のエラーかを少し判別
+        error_message = f"Gemini APIエラー: {e}"
+        if isinstance(e, BackendConfigError):
+            error_message = str(e)
+        elif "API_KEY_INVALID" in str(e):
+            error_message = "APIキーが無効です。確認してください。"
+        print(f"Gemini API呼び出し中にエラー発生: {e}")
+        self.listener.on_error(error_message)
+        return error_message
+
+    async def extract_from_image(self, image_bytes: bytes, mime_type: str, data_items: list[DataItem], on_field=None,
+                                 roi_plan: RoiPlan | None = None, roi_usage: RoiUsage | None = None,
+                                 call_context: CallContext | None = None) -> dict:
+        """
+        画像のバイト列を前処理してバックエンドに送信し、{データ項目名: 値} を返します。
+        roi_plan が渡された場合はページ全体の代わりに領域を切り抜いた画像を送り、削減量を roi_usage に加算します。
+        """
+        prepared = await self.prepare_image(image_bytes, mime_type, roi_plan, roi_usage)
+        return await self.extract_cascaded(prepared, data_items, on_field, call_context)
+
+    async def extract_cascaded(self, prepared: PreparedImage, data_items: list[DataItem], on_field=None,
+                               call_context: CallContext | None = None) -> dict:
+        """
+        settings.cascade_models のモデルから順に抽出し、値の欠落や型・正規表現の確認に失敗した項目だけを次のモデルに聞き直します。
+        最後の段は settings.model_name です。前段の呼び出しが失敗した場合は、残りの全項目を次の段に回します。
+        聞き直した項目の値は常に後段の値（null を含む）で、確認に失敗した前段の値は保存も on_field への通知もしません。
+        カスケードを設定していなければ extract_prepared と同じです。
+        """
+        if not self.settings.cascade_models:
+            return await self.extract_prepared(prepared, data_items, on_field, call_context)
+        stages = [*self.settings.cascade_models, self.settings.model_name]
+        extracted = {}
+        escalations = None
+        calls = []
+        pending = list(data_items)
+        items_by_name = {item.name: item for item in data_items}
+
+        def on_checked_field(name, value):
+            # 前段の値は確認に通ったものだけ表示する（聞き直す項目に、却下した値を一時的に表示しないように）
+            item = items_by_name.get(name)
+            if item is None or check_value(item, value) is None:
+                on_field(name, value)
+
+        try:
+            for index, model_name in enumerate(stages):
+                final = index == len(stages) - 1
+
+                def on_response(timer, response, model_name=model_name):
+                    calls.append((model_name, timer.latency_seconds, response.usage_metadata))
+
+                stage_on_field = on_field if final or on_field is None else on_checked_field
+                try:
+                    result = await self.extract_prepared(prepared, pending, stage_on_field, call_context, self._backend_for(model_name), on_response)
+                except ScanError:
+                    if final:
+                        raise
+                    print(f"カスケード: {model_name} での抽出に失敗したため、次のモデルで抽出します")
+                    failures = [(item, FAIL_MISSING) for item in pending]
+                else:
+                    # 聞き直した項目は後段の値で置き換える。後段も読み取れなかった項目は、確認に失敗した前段の値を残さず null にする
+                    extracted.update({item.name: result.get(item.name) for item in pending})
+                    if final:
+                        break
+                    failures = failing_items(pending, extracted)
+                if escalations is None:
+                    escalations = failures
+                if not failures:
+                    break
+                pending = [item for item, _ in failures]
+        finally:
+            # 最後の段が失敗した場合も集計する（聞き直した項目はすべて解決できなかったものとして数える）
+            unresolved = failing_items(pending, extracted) if escalations else []
+            self.cascade_stats.record(len(data_items), escalations or [], calls, self.settings.model_name, unresolved)
+        return {item.name: extracted.get(item.name) for item in data_items}
+
+    async def extract_prepared(self, prepared: PreparedImage, data_items: list[DataItem], on_field=None,
+                               call_context: CallContext | None = None, backend: OcrBackend | None = None,
+                               on_response=None) -> dict:
+        """
+        前処理済みの画像をバックエンドに送信し、{データ項目名: 値} を返します。
+        応答は条件から生成したJSONスキーマに沿って返させ、検証器で解析します。失敗時は ScanError を送出します。
+        settings.streaming が有効で on_field が渡された場合、項目の値が確定するたびに on_field(項目名, 値) を呼びます。
+        API呼び出しは call_context のリスト・条件・ファイルとともに scan_calls に記録します。
+        backend を省略した場合は settings.model_name のバックエンドを使います。on_response(timer, 応答) は解析に成功した後に呼びます。
+        """
+        backend = backend or self.backend
+        validator = self.response_schemas.get(data_items)
+        streaming = self.settings.streaming and on_field is not None
+        image_parts, prompt_hint = prepared.parts, prepared.prompt_hint
+        estimated_tokens = backend.estimate_tokens(len(image_parts), data_items)
+        if streaming:
+            # ストリーミングは受信途中の項目を通知するため、重複リクエストは送らない
+            request_factory = self.tracer.traced(
+                "api_attempt", lambda: self._extract_streaming(backend, image_parts, data_items, validator, on_field, prompt_hint)
+            )
+        else:
+            request_factory = self._hedged(self.tracer.traced(
+                "api_attempt", lambda: backend.extract_fields(image_parts, data_items, validator.schema, prompt_hint)
+            ), estimated_tokens)
+        timer = CallTimer(request_factory)
+        try:
+            # "api" はレート制限・バックオフの待ち時間を含み、"api_attempt" は各試行のリクエストのみ
+            with self.tracer.span("api", model=backend.model_name, images=len(image_parts)):
+                response = await self.throttle.call(timer, estimated_tokens, self.listener.on_stats_changed)
+        except Exception as e:
+            if timer.attempts:
+                self.call_recorder.record(call_context, backend.model_name, timer, prepared.size, outcome=CALL_API_ERROR)
+            raise ScanError(self._report_api_error(e)) from e
+
+        try:
+            with self.tracer.span("parse"):
+                extracted_data, missing = validator.parse(response.text)
+        except ResponseParseError as e:
+            self.call_recorder.record(call_context, backend.model_name, timer, prepared.size, response, CALL_PARSE_ERROR)
+            self.parse_stats.record_failure(e.reason)
+            print(f"応答の解析に失敗しました ({e.reason}): {e}")
+            raise ScanError(f"応答を解析できませんでした: {e}") from e
+        self.call_recorder.record(call_context, backend.model_name, timer, prepared.size, response, CALL_OK)
+        self.parse_stats.record_success(missing)
+        if on_response is not None:
+            on_response(timer, response)
+        # 抽出されたデータがdata_itemsのすべてをカバーしているか確認（任意）
+        if missing:
+            print(f"警告: すべての要求されたデータ項目が抽出されませんでした。抽出された項目: {len(extracted_data)}/{len(data_items)}")
+        return extracted_data
+
+    async def _extract_streaming(self, backend: OcrBackend, image_parts: list[dict], data_items: list[DataItem], validator, on_field,
+                                 prompt_hint: str = ""):
+        """
+        ストリーミングで1回分のリクエストを実行します（再試行時は throttle から再度呼ばれます）。
+        受信した断片を逐次解析し、値が確定した項目を on_field に渡します。
+        最初・最後の項目が確定するまでの時間を StreamingStats に記録します。
+        """
+        parser = IncrementalFieldParser()
+        started_at = time.monotonic()
+        first_field_at = None
+        last_field_at = None
+
+        def on_text(chunk: str):
+            nonlocal first_field_at, last_field_at
+            for name, value in parser.feed(chunk):
+                if name not in validator.items_by_name:
+                    continue
+                now = time.monotonic() - started_at
+                if first_field_at is None:
+                    first_field_at = now
+                last_field_at = now
+                on_field(name, None if value is None else str(value))
+
+        response = await backend.extract_fields_stream(image_parts, data_items, validator.schema, on_text, prompt_hint)
+        self.streaming_stats.record(first_field_at, last_field_at)
+        return response
+
+    def _hedged(self, request_factory, estimated_tokens: int):
+        """
+        遅い呼び出しに重複リクエストを送る request_factory に包みます。
+        ヘッジが無効でも所要時間は集計し、有効にした場合との比較に使えるようにします。
+        """
+        return lambda: self.hedging.run(request_factory, lambda: self.throttle.try_acquire(estimated_tokens))
+
+    @staticmethod
+    def _parts_size(image_parts: list[dict]) -> int:
+        return sum(len(part["data"]) for part in image_parts)
+
+    async def extract_packed(self, images: list[tuple[bytes, str]], data_items: list[DataItem],
+                             call_context: CallContext | None = None) -> dict[int, dict] | None:
+        """
+        複数の画像を1リクエストで送信し、{画像番号(1始まり): {データ項目名: 値}} を返します。
+        応答がスキーマに合わない場合やAPIエラーの場合は None を返します。
+        """
+        backend = self.backend
+        validator = self.response_schemas.get(data_items)
+        image_parts = []
+        estimated_tokens = backend.estimate_tokens(len(images), data_items)
+        timer = CallTimer(self._hedged(self.tracer.traced(
+            "api_attempt", lambda: backend.extract_fields_packed(image_parts, data_items, validator.packed_schema(len(images)))
+        ), estimated_tokens))
+        try:
+            # 各画像の前処理は前処理用のプロセスで並行して行う
+            prepared_images = await asyncio.gather(*(self.prepare_image(image_bytes, mime_type) for image_bytes, mime_type in images))
+            image_parts = [part for prepared in prepared_images for part in prepared.parts]
+            with self.tracer.span("api", model=backend.model_name, images=len(image_parts)):
+                response = await self.throttle.call(timer, estimated_tokens, self.listener.on_stats_changed)
+        except BackendConfigError as e:
+            self._report_api_error(e)
+            return None
+        except Exception as e:
+            if timer.attempts:
+                self.call_recorder.record(call_context, backend.model_name, timer, self._parts_size(image_parts), outcome=CALL_API_ERROR)
+            print(f"まとめ送信のGemini API呼び出し中にエラー発生: {e}")
+            return None
+
+        try:
+            with self.tracer.span("parse"):
+                results, missing = validator.parse_packed(response.text, len(images))
+        except ResponseParseError as e:
+            self.call_recorder.record(call_context, backend.model_name, timer, self._parts_size(image_parts), response, CALL_PARSE_ERROR)
+            self.parse_stats.record_failure(e.reason)
+            print(f"まとめ送信の応答の解析に失敗しました ({e.reason}): {e}")
+            return None
+        self.call_recorder.record(call_context, backend.model_name, timer, self._parts_size(image_parts), response, CALL_OK)
+        self.parse_stats.record_success(missing)
+        return results
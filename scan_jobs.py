@@ -0,0 +1,241 @@
+import datetime
+import os
+import socket
+import uuid
+from dataclasses import dataclass
+from sqlalchemy import DateTime, bindparam, text
+from models import get_db, ScanJob
+from rate_limiter import PRIORITY_CLASSES, PRIORITY_NORMAL
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+DEFAULT_LEASE_SECONDS = 60 # 実行中のワーカーはこの1/3ごとにリースを延長する
+MAX_JOB_ATTEMPTS = 3 # リース切れ（クラッシュ・強制終了）で再取得される上限
+FINISHED_JOB_RETENTION_DAYS = 7
+
+
+def _utcnow() -> datetime.datetime:
+    return datetime.datetime.utcnow()
+
+
+def new_worker_id() -> str:
+    """リースの所有者として記録するワーカーの識別子です（ホスト名・PID・乱数）。"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+@dataclass
+class ClaimedJob:
+    id: int
+    uploaded_file_id: int
+    condition_id: int
+    attempts: int
+    priority: str = PRIORITY_NORMAL
+
+
+class ScanJobQueue:
+    """
+    scan_jobs テーブルを使った永続ジョブキューです。
+    アプリの終了・クラッシュで中断した一括スキャンも、次回の起動時に残りのジョブから再開できます。
+    ジョブの取得は1つのUPDATE文で行うため、複数のワーカー・プロセスが同時に取得しても同じジョブを二重に実行しません。
+    """
+
+    def __init__(self, db_context=get_db, lease_seconds: int = DEFAULT_LEASE_SECONDS, max_attempts: int = MAX_JOB_ATTEMPTS):
+        self.db_context = db_context
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def enqueue(self, file_ids: list[int], condition_id: int, priority: str = PRIORITY_NORMAL) -> str:
+        """
+        ファイルを優先度クラス priority でキューに積み、バッチIDを返します。
+        同じファイル・条件の未完了ジョブがあれば積まずに、このバッチの優先度に変えます。
+        """
+        batch_id = uuid.uuid4().hex
+        rank = PRIORITY_CLASSES.index(priority)
+        now = _utcnow()
+        db = next(self.db_context())
+        try:
+            self._purge_finished(db, now)
+            active_ids = {
+                row.uploaded_file_id
+                for row in db.query(ScanJob.uploaded_file_id).filter(
+                    ScanJob.condition_id == condition_id,
+                    ScanJob.state.in_([JOB_QUEUED, JOB_RUNNING]),
+                ).all()
+            }
+            db.bulk_insert_mappings(ScanJob, [
+                {
+                    "batch_id": batch_id, "uploaded_file_id": file_id, "condition_id": condition_id,
+                    "state": JOB_QUEUED, "priority": rank, "attempts": 0, "created_at": now, "updated_at": now,
+                }
+                for file_id in file_ids if file_id not in active_ids
+            ])
+            # 既に積まれていたファイルもこのバッチの進捗として扱う
+            if active_ids:
+                db.query(ScanJob).filter(
+                    ScanJob.condition_id == condition_id,
+                    ScanJob.state.in_([JOB_QUEUED, JOB_RUNNING]),
+                    ScanJob.uploaded_file_id.in_([fid for fid in file_ids if fid in active_ids]),
+                ).update({ScanJob.batch_id: batch_id, ScanJob.priority: rank}, synchronize_session=False)
+            db.commit()
+            return batch_id
+        finally:
+            db.close()
+
+    def claim(self, worker_id: str, limit: int = 1, batch_id: str | None = None) -> list[ClaimedJob]:
+        """
+        待機中のジョブ、またはリース期限切れの実行中ジョブを優先度の高い順に最大 limit 件取得し、worker_id のリースを設定します。
+        リース期限切れのジョブのうち試行回数の上限に達したものは、取得せずに失敗にします。
+        """
+        now = _utcnow()
+        lease_token = f"{worker_id}/{uuid.uuid4().hex[:8]}"
+        batch_clause = "AND batch_id = :batch_id" if batch_id else ""
+        db = next(self.db_context())
+        try:
+            db.execute(text(f"""
+                UPDATE scan_jobs
+                SET state = :failed, error = 'リース期限切れのまま試行回数の上限に達しました', lease_owner = NULL,
+                    lease_expires_at = NULL, updated_at = :now
+                WHERE state = :running AND lease_expires_at < :now AND attempts >= :max_attempts {batch_clause}
+            """).bindparams(bindparam("now", type_=DateTime())), {
+                "failed": JOB_FAILED, "running": JOB_RUNNING, "now": now,
+                "max_attempts": self.max_attempts, "batch_id": batch_id,
+            })
+            db.execute(text(f"""
+                UPDATE scan_jobs
+                SET state = :running, lease_owner = :token, lease_expires_at = :expires, attempts = attempts + 1, updated_at = :now
+                WHERE id IN (
+                    SELECT id FROM scan_jobs
+                    WHERE (state = :queued OR (state = :running AND lease_expires_at < :now)) {batch_clause}
+                    ORDER BY priority, id
+                    LIMIT :limit
+                )
+            """).bindparams(bindparam("now", type_=DateTime()), bindparam("expires", type_=DateTime())), {
+                "running": JOB_RUNNING, "queued": JOB_QUEUED, "token": lease_token, "now": now,
+                "expires": now + datetime.timedelta(seconds=self.lease_seconds), "limit": limit, "batch_id": batch_id,
+            })
+            db.commit()
+            rows = db.query(ScanJob).filter(ScanJob.lease_owner == lease_token).order_by(ScanJob.priority, ScanJob.id).all()
+            return [ClaimedJob(row.id, row.uploaded_file_id, row.condition_id, row.attempts, PRIORITY_CLASSES[row.priority]) for row in rows]
+        finally:
+            db.close()
+
+    def renew(self, worker_id: str, job_ids: list[int]):
+        """実行中のジョブのリースを延長します。"""
+        if not job_ids:
+            return
+        now = _utcnow()
+        db = next(self.db_context())
+        try:
+            db.query(ScanJob).filter(
+                ScanJob.id.in_(job_ids),
+                ScanJob.state == JOB_RUNNING,
+                ScanJob.lease_owner.like(f"{worker_id}/%"),
+            ).update({
+                ScanJob.lease_expires_at: now + datetime.timedelta(seconds=self.lease_seconds),
+                ScanJob.updated_at: now,
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def finish(self, worker_id: str, job_id: int, error: str | None = None):
+        """ジョブを完了(error が None)または失敗にします。リースを失っている場合は何もしません。"""
+        db = next(self.db_context())
+        try:
+            db.query(ScanJob).filter(
+                ScanJob.id == job_id,
+                ScanJob.state == JOB_RUNNING,
+                ScanJob.lease_owner.like(f"{worker_id}/%"),
+            ).update({
+                ScanJob.state: JOB_FAILED if error else JOB_DONE,
+                ScanJob.error: error,
+                ScanJob.lease_owner: None,
+                ScanJob.lease_expires_at: None,
+                ScanJob.updated_at: _utcnow(),
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def release(self, worker_id: str, job_ids: list[int]):
+        """取得したまま実行しなかったジョブ（停止時など）を待機状態に戻します。"""
+        if not job_ids:
+            return
+        db = next(self.db_context())
+        try:
+            db.query(ScanJob).filter(
+                ScanJob.id.in_(job_ids),
+                ScanJob.state == JOB_RUNNING,
+                ScanJob.lease_owner.like(f"{worker_id}/%"),
+            ).update({
+                ScanJob.state: JOB_QUEUED,
+                ScanJob.attempts: ScanJob.attempts - 1,
+                ScanJob.lease_owner: None,
+                ScanJob.lease_expires_at: None,
+                ScanJob.updated_at: _utcnow(),
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def cancel_queued(self, batch_id: str | None = None) -> int:
+        """待機中のジョブを削除します（停止ボタン）。実行中のジョブはそのまま完了させます。"""
+        db = next(self.db_context())
+        try:
+            query = db.query(ScanJob).filter(ScanJob.state == JOB_QUEUED)
+            if batch_id:
+                query = query.filter(ScanJob.batch_id == batch_id)
+            deleted = query.delete(synchronize_session=False)
+            db.commit()
+            return deleted
+        finally:
+            db.close()
+
+    def unfinished_count(self, batch_id: str | None = None) -> int:
+        """待機中・実行中（リース期限切れを含む）のジョブ数です。"""
+        db = next(self.db_context())
+        try:
+            query = db.query(ScanJob).filter(ScanJob.state.in_([JOB_QUEUED, JOB_RUNNING]))
+            if batch_id:
+                query = query.filter(ScanJob.batch_id == batch_id)
+            return query.count()
+        finally:
+            db.close()
+
+    def unfinished_file_ids(self, batch_id: str | None = None) -> list[int]:
+        db = next(self.db_context())
+        try:
+            query = db.query(ScanJob.uploaded_file_id).filter(ScanJob.state.in_([JOB_QUEUED, JOB_RUNNING]))
+            if batch_id:
+                query = query.filter(ScanJob.batch_id == batch_id)
+            return [row.uploaded_file_id for row in query.order_by(ScanJob.id).all()]
+        finally:
+            db.close()
+
+    def next_foreign_lease_expiry(self, worker_id: str, batch_id: str | None = None) -> datetime.datetime | None:
+        """
+        他のワーカー（前回の起動時のものを含む）がリース中のジョブのうち、最も早く期限が切れる時刻です。
+        再開時、クラッシュしたプロセスのジョブをリース切れを待って引き継ぐために使います。
+        """
+        db = next(self.db_context())
+        try:
+            query = db.query(ScanJob.lease_expires_at).filter(
+                ScanJob.state == JOB_RUNNING,
+                ~ScanJob.lease_owner.like(f"{worker_id}/%"),
+            )
+            if batch_id:
+                query = query.filter(ScanJob.batch_id == batch_id)
+            row = query.order_by(ScanJob.lease_expires_at).first()
+            return row.lease_expires_at if row else None
+        finally:
+            db.close()
+
+    def _purge_finished(self, db, now: datetime.datetime):
+        cutoff = now - datetime.timedelta(days=FINISHED_JOB_RETENTION_DAYS)
+        db.query(ScanJob).filter(
+            ScanJob.state.in_([JOB_DONE, JOB_FAILED]),
+            ScanJob.updated_at < cutoff,
+        ).delete(synchronize_session=False)
@@ -0,0 +1,81 @@
+import os
+from dataclasses import dataclass, field, replace
+from image_preprocess import PreprocessOptions, PreprocessResult, preprocess_image_bytes
+from roi import RoiCropResult, RoiPlan, crop_regions
+
+DEFAULT_CPU_WORKERS = os.cpu_count() or 1 # 画像の前処理に使うプロセス数
+PREPARED_QUEUE_PER_API_WORKER = 2 # 前処理済みで送信待ちにしておく件数（APIワーカー1つあたり）
+
+
+@dataclass
+class PreparedImage:
+    """
+    送信する画像パートと、前処理・領域切り抜きの統計です。
+    前処理用のプロセスから受け取るため、ピクル可能な値だけを持ちます（統計には画像データを含めません）。
+    """
+    parts: list[dict] # バックエンドに渡す {"mime_type": ..., "data": ...}
+    prompt_hint: str = ""
+    preprocessed: list[PreprocessResult] = field(default_factory=list)
+    roi_crop: RoiCropResult | None = None
+
+    @property
+    def size(self) -> int:
+        return sum(len(part["data"]) for part in self.parts)
+
+
+def prepare_image(image_bytes: bytes, mime_type: str, options: PreprocessOptions, roi_plan: RoiPlan | None = None) -> PreparedImage:
+    """
+    画像のデコード・領域の切り抜き・縮小・再エンコードをまとめて行います（CPU負荷が高いため前処理用のプロセスで実行します）。
+    切り抜いた中間画像をプロセス間で受け渡さないよう、切り抜きと前処理を1回の呼び出しで済ませます。
+    """
+    images = [(image_bytes, mime_type)]
+    prompt_hint = ""
+    roi_crop = None
+    if roi_plan is not None:
+        roi_crop = crop_regions(image_bytes, roi_plan, options.max_pixels if options.enabled else 0)
+        images = [(crop, "image/png") for crop in roi_crop.images]
+        prompt_hint = roi_plan.prompt_hint()
+        roi_crop = replace(roi_crop, images=[])
+
+    parts = []
+    preprocessed = []
+    for data, part_mime_type in images:
+        if options.enabled:
+            result = preprocess_image_bytes(data, options)
+            parts.append({"mime_type": result.mime_type, "data": result.data})
+            preprocessed.append(replace(result, data=b""))
+        else:
+            parts.append({"mime_type": part_mime_type, "data": data})
+    return PreparedImage(parts, prompt_hint, preprocessed, roi_crop)
+
+
+class PipelineStats:
+    """一括スキャンの前処理段階とAPI段階の間のキューの状態を集計します。"""
+
+    def __init__(self):
+        self.cpu_workers = 0
+        self.queue_size = 0
+        self.prepared = 0
+        self.dequeued = 0
+        self.max_queue_depth = 0
+        self.queue_wait_seconds = 0.0 # 前処理済みの作業がAPI段階に取り出されるまで待った時間の合計
+        self.put_wait_seconds = 0.0 # キューが満杯で前処理段階が待たされた時間の合計（背圧）
+
+    def record_put(self, depth: int, waited: float):
+        self.prepared += 1
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        self.put_wait_seconds += waited
+
+    def record_get(self, waited: float):
+        self.dequeued += 1
+        self.queue_wait_seconds += waited
+
+    @property
+    def mean_queue_wait_seconds(self) -> float:
+        return self.queue_wait_seconds / self.dequeued if self.dequeued else 0.0
+
+    def summary_text(self) -> str:
+        return (
+            f"パイプライン: 前処理プロセス {self.cpu_workers} | キュー上限 {self.queue_size} (最大 {self.max_queue_depth} 件)"
+            f" | 送信待ち平均 {self.mean_queue_wait_seconds:.2f}秒 | 前処理の待機(背圧) {self.put_wait_seconds:.1f}秒"
+        )
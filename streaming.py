@@ -0,0 +1,96 @@
+import json
+import statistics
+
+_JSON_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+
+
+class IncrementalFieldParser:
+    """
+    ストリーミングで届くJSONオブジェクト {"項目名": "値", ...} を少しずつ読み進め、
+    値が確定した項目から順に返します。応答全体が届く前に画面へ表示するために使います。
+    最終的な検証は応答全体に対して ResponseValidator で別途行います。
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.started = False
+        self.finished = False
+
+    def _skip(self, chars: str):
+        while self.position < len(self.buffer) and self.buffer[self.position] in chars:
+            self.position += 1
+
+    def feed(self, chunk: str) -> list[tuple[str, object]]:
+        """受信したテキストを追加し、新たに値が確定した (項目名, 値) のリストを返します。"""
+        self.buffer += chunk
+        completed = []
+        if not self.started:
+            # 念のためコードブロックの ``` などの前置きは読み飛ばす
+            brace = self.buffer.find("{", self.position)
+            if brace < 0:
+                return completed
+            self.position = brace + 1
+            self.started = True
+
+        while not self.finished:
+            self._skip(_WHITESPACE + ",")
+            if self.position >= len(self.buffer):
+                break
+            if self.buffer[self.position] == "}":
+                self.finished = True
+                break
+            try:
+                key, after_key = _JSON_DECODER.raw_decode(self.buffer, self.position)
+            except ValueError:
+                break # キーがまだ途中
+            value_start = after_key
+            while value_start < len(self.buffer) and self.buffer[value_start] in _WHITESPACE + ":":
+                value_start += 1
+            if value_start >= len(self.buffer):
+                break
+            try:
+                value, value_end = _JSON_DECODER.raw_decode(self.buffer, value_start)
+            except ValueError:
+                break # 値がまだ途中
+            if not isinstance(value, str):
+                # 数値・true/false/null は続きが届くまで確定できない（"12" の後に "3" が届く場合がある）
+                rest = self.buffer[value_end:].lstrip(_WHITESPACE)
+                if not rest:
+                    break
+            if isinstance(key, str):
+                completed.append((key, value))
+            self.position = value_end
+        return completed
+
+
+class StreamingStats:
+    """ストリーミング時の最初の項目・最後の項目が確定するまでの時間（リクエスト送信から）を集計します。"""
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self.first_field_seconds = []
+        self.last_field_seconds = []
+
+    def record(self, first_field_seconds: float | None, last_field_seconds: float | None):
+        for samples, value in ((self.first_field_seconds, first_field_seconds), (self.last_field_seconds, last_field_seconds)):
+            if value is None:
+                continue
+            samples.append(value)
+            if len(samples) > self.max_samples:
+                del samples[0]
+
+    @property
+    def median_first_field_seconds(self) -> float:
+        return statistics.median(self.first_field_seconds) if self.first_field_seconds else 0.0
+
+    @property
+    def median_last_field_seconds(self) -> float:
+        return statistics.median(self.last_field_seconds) if self.last_field_seconds else 0.0
+
+    def summary_text(self) -> str:
+        return (
+            f"ストリーミング: {len(self.last_field_seconds)} 件 | 最初の項目まで 中央値 {self.median_first_field_seconds:.2f}秒"
+            f" | 最後の項目まで 中央値 {self.median_last_field_seconds:.2f}秒"
+        )
@@ -0,0 +1,118 @@
+"""
+テスト用の一時DB・実体の保存先と、フェイクバックエンドで動かす ScanEngine です。
+本番の ocr_settings.db と images/ には触れません。
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+from PIL import Image
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import blob_store  # noqa: E402
+import file_ingest  # noqa: E402
+import scan_engine  # noqa: E402
+from models import Base, Condition, DataItem, OcrList, UploadedFile  # noqa: E402
+from ocr_backends import FakeBackendOptions  # noqa: E402
+from scan_engine import ScanEngine, ScanSettings  # noqa: E402
+from thumbnails import ThumbnailCache  # noqa: E402
+
+
+@pytest.fixture
+def db_context(tmp_path):
+    """一時ファイルのSQLiteに全テーブルを作成し、get_db と同じ形のジェネレーター関数を返します。"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.close()
+
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def get_test_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    yield get_test_db
+    engine.dispose()
+
+
+@pytest.fixture
+def app_dir(tmp_path, monkeypatch):
+    """実体(images/blobs)とサムネイルの保存先を一時ディレクトリに向けます。"""
+    base_dir = tmp_path / "app"
+    base_dir.mkdir()
+    monkeypatch.setattr(blob_store, "APP_BASE_DIR", str(base_dir))
+    monkeypatch.setattr(blob_store, "BLOB_BASE_DIR", str(base_dir / blob_store.UPLOAD_DIR_NAME / blob_store.BLOB_DIR_NAME))
+    monkeypatch.setattr(file_ingest, "APP_BASE_DIR", str(base_dir))
+    monkeypatch.setattr(scan_engine, "APP_BASE_DIR", str(base_dir))
+    monkeypatch.setattr(file_ingest, "thumbnail_cache", ThumbnailCache(base_dir=str(base_dir / "thumbnails")))
+    return base_dir
+
+
+def make_png(path, index: int):
+    """内容がファイルごとに異なる小さなPNGを作ります。"""
+    image = Image.new("RGB", (120, 80), (255, 255, 255))
+    for x in range(index % 100 + 1):
+        image.putpixel((x, index % 80), (0, 0, 0))
+    image.save(path)
+    return str(path)
+
+
+@pytest.fixture
+def scan_target(tmp_path, db_context, app_dir):
+    """
+    OCRリスト・条件（データ項目 3 件）と、取り込み済みの PNG 5 件を作り、(リストID, 条件ID, ファイルIDのリスト) を返します。
+    """
+    db = next(db_context())
+    try:
+        ocr_list = OcrList(name="test-list")
+        condition = Condition(name="test-cond", data_items=[
+            DataItem(name="請求番号"), DataItem(name="金額", value_type="number"), DataItem(name="日付", value_type="date"),
+        ])
+        db.add_all([ocr_list, condition])
+        db.commit()
+        list_id, condition_id = ocr_list.id, condition.id
+    finally:
+        db.close()
+
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    picked = [(f"file{index}.png", make_png(source_dir / f"file{index}.png", index)) for index in range(5)]
+    progress = asyncio.run(file_ingest.ingest_files(picked, list_id, db_context))
+    assert progress.inserted == len(picked)
+
+    db = next(db_context())
+    try:
+        file_ids = [row.id for row in db.query(UploadedFile.id).order_by(UploadedFile.filename).all()]
+    finally:
+        db.close()
+    return list_id, condition_id, file_ids
+
+
+@pytest.fixture
+def make_engine(db_context):
+    """フェイクバックエンド（遅延ほぼ0）の ScanEngine を作る関数です。作ったエンジンはテストの終了時に停止します。"""
+    engines = []
+
+    def factory(**overrides) -> ScanEngine:
+        options = {"backend_name": "fake", "fake": FakeBackendOptions(latency_median=0.001, latency_sigma=0.0),
+                   "cpu_workers": 0, "max_concurrency": 2}
+        settings = ScanSettings(**{**options, **overrides})
+        engine = ScanEngine(settings=settings, db_context=db_context)
+        engines.append(engine)
+        return engine
+
+    yield factory
+    for engine in engines:
+        engine.shutdown()
@@ -0,0 +1,89 @@
+import os
+
+import blob_store
+from blob_store import PLACE_DEDUP, add_references, collect_garbage, release_pending, release_references, store_file
+from conftest import make_png
+from models import Blob, OcrList, UploadedFile
+
+
+def _ref_count(db, sha256):
+    db.expire_all()
+    blob = db.query(Blob).filter(Blob.sha256 == sha256).one_or_none()
+    return None if blob is None else blob.ref_count
+
+
+def test_same_content_is_stored_once(tmp_path, app_dir):
+    first = store_file(make_png(tmp_path / "a.png", 1), ".png")
+    second = store_file(make_png(tmp_path / "b.png", 1), ".png")
+    release_pending([first, second])
+    assert first.method != PLACE_DEDUP
+    assert second.method == PLACE_DEDUP
+    assert second.path == first.path
+    assert os.path.exists(app_dir / first.path)
+
+
+def test_blob_is_removed_only_when_last_reference_is_released(tmp_path, app_dir, db_context):
+    db = next(db_context())
+    try:
+        blobs = [store_file(make_png(tmp_path / f"{name}.png", 1), ".png") for name in ("a", "b")]
+        add_references(db, blobs)
+        db.commit()
+        release_pending(blobs)
+        sha256 = blobs[0].sha256
+        assert _ref_count(db, sha256) == 2
+
+        release_references(db, [sha256, None])
+        db.commit()
+        assert collect_garbage(db).blobs_removed == 0
+        assert os.path.exists(app_dir / blobs[0].path)
+
+        release_references(db, [sha256])
+        db.commit()
+        result = collect_garbage(db)
+        assert result.blobs_removed == 1
+        assert result.bytes_freed == blobs[0].size_bytes
+        assert not os.path.exists(app_dir / blobs[0].path)
+        assert _ref_count(db, sha256) is None
+    finally:
+        db.close()
+
+
+def test_blob_being_ingested_is_not_collected(tmp_path, app_dir, db_context):
+    db = next(db_context())
+    try:
+        blob = store_file(make_png(tmp_path / "a.png", 2), ".png")
+        add_references(db, [blob])
+        db.commit()
+        release_references(db, [blob.sha256])
+        db.commit()
+        # 同じ内容を別の取り込みが置いた直後（まだ参照を追加していない）
+        reserved = store_file(make_png(tmp_path / "b.png", 2), ".png")
+        assert collect_garbage(db).blobs_removed == 0
+        assert os.path.exists(app_dir / blob.path)
+
+        release_pending([blob, reserved])
+        assert collect_garbage(db).blobs_removed == 1
+    finally:
+        db.close()
+
+
+def test_migration_runs_once(tmp_path, app_dir, db_context, monkeypatch):
+    monkeypatch.setattr(blob_store, "MIGRATION_MARKER_PATH", str(app_dir / "images" / ".legacy_migrated"))
+    legacy_dir = app_dir / "images" / "1"
+    legacy_dir.mkdir(parents=True)
+    make_png(legacy_dir / "legacy.png", 3)
+    db = next(db_context())
+    try:
+        ocr_list = OcrList(name="legacy-list")
+        db.add(ocr_list)
+        db.commit()
+        db.add(UploadedFile(ocr_list_id=ocr_list.id, filename="legacy.png", filepath="images/1/legacy.png", filetype="png"))
+        db.commit()
+    finally:
+        db.close()
+
+    result = blob_store.migrate_legacy_files(db_context)
+    assert (result.files, result.blobs_created, result.skipped) == (1, 1, False)
+    assert not (legacy_dir / "legacy.png").exists()
+    assert blob_store.migrate_legacy_files(db_context).skipped
+    assert blob_store.migrate_legacy_files(db_context, force=True).files == 0
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from cascade import FAIL_MISSING, FAIL_TYPE, check_value
+from models import DataItem, ScannedData
+from scan_engine import ScanError
+
+
+def test_check_value_types_and_patterns():
+    amount = DataItem(name="金額", value_type="number")
+    date = DataItem(name="日付", value_type="date")
+    code = DataItem(name="請求番号", pattern=r"INV-\d{4}")
+    assert check_value(amount, "¥1,234") is None
+    assert check_value(amount, "金額-abc") == FAIL_TYPE
+    assert check_value(date, "令和6年4月1日") is None
+    assert check_value(date, "2024/4/1") is None
+    assert check_value(code, "INV-0001") is None
+    assert check_value(code, "0001") == "pattern"
+    assert check_value(code, "  ") == FAIL_MISSING
+
+
+def test_only_failing_fields_are_escalated(scan_target, make_engine, db_context):
+    _, condition_id, file_ids = scan_target
+    engine = make_engine(cascade_models=["cheap-model"], model_name="strong-model")
+    requested = []
+    extract_fields = engine.backend.extract_fields
+
+    async def spy(image_parts, data_items, response_schema, prompt_hint=""):
+        requested.append(sorted(item.name for item in data_items))
+        return await extract_fields(image_parts, data_items, response_schema, prompt_hint)
+
+    engine.backend.extract_fields = spy
+    summary = asyncio.run(engine.run_batch(file_ids, condition_id))
+    assert all(outcome.succeeded for outcome in summary.outcomes)
+
+    # フェイクの値 "<項目名>-<ハッシュ>" は数値・日付の確認に失敗するため、その2項目だけを上位のモデルに聞き直す
+    assert requested.count(["日付", "請求番号", "金額"]) == len(file_ids)
+    assert requested.count(["日付", "金額"]) == len(file_ids)
+    stats = engine.cascade_stats
+    assert stats.calls_by_model == {"cheap-model": len(file_ids), "strong-model": len(file_ids)}
+    assert stats.escalated_fields == 2 * len(file_ids)
+    assert stats.reasons == {FAIL_TYPE: 2 * len(file_ids)}
+    assert stats.unresolved_fields == 2 * len(file_ids)
+
+    db = next(db_context())
+    try:
+        rows = db.query(ScannedData).filter(ScannedData.data_item_name == "請求番号").all()
+        assert len(rows) == len(file_ids) and all(row.extracted_value for row in rows)
+    finally:
+        db.close()
+
+
+def _stub_stages(engine, answers):
+    """extract_prepared を、段ごとに answers の値（例外なら送出）を返すものに差し替えます。"""
+    calls = []
+
+    async def extract_prepared(prepared, data_items, on_field=None, call_context=None, backend=None, on_response=None):
+        answer = answers[len(calls)]
+        calls.append([item.name for item in data_items])
+        if isinstance(answer, Exception):
+            raise answer
+        for item in data_items:
+            if on_field is not None:
+                on_field(item.name, answer.get(item.name))
+        return {item.name: answer.get(item.name) for item in data_items}
+
+    engine.extract_prepared = extract_prepared
+    return calls
+
+
+def test_rejected_value_is_not_kept_or_streamed(make_engine):
+    engine = make_engine(cascade_models=["cheap-model"], model_name="strong-model")
+    items = [DataItem(name="金額", value_type="number"), DataItem(name="備考")]
+    calls = _stub_stages(engine, [{"金額": "abc", "備考": "メモ"}, {"金額": None}])
+    streamed = []
+
+    result = asyncio.run(engine.extract_cascaded(None, items, on_field=lambda name, value: streamed.append((name, value))))
+    assert calls == [["金額", "備考"], ["金額"]]
+    assert result == {"金額": None, "備考": "メモ"}
+    assert ("金額", "abc") not in streamed
+    assert engine.cascade_stats.unresolved_fields == 1
+
+
+def test_stats_are_recorded_when_final_stage_fails(make_engine):
+    engine = make_engine(cascade_models=["cheap-model"], model_name="strong-model")
+    items = [DataItem(name="金額", value_type="number")]
+    _stub_stages(engine, [{"金額": "abc"}, ScanError("boom")])
+
+    with pytest.raises(ScanError):
+        asyncio.run(engine.extract_cascaded(None, items))
+    assert engine.cascade_stats.files == 1
+    assert engine.cascade_stats.escalated_files == 1
+    assert engine.cascade_stats.unresolved_fields == 1
@@ -0,0 +1,70 @@
+import asyncio
+from dataclasses import replace
+
+from models import ScanResultCache, ScannedData
+from image_preprocess import PreprocessOptions
+
+
+def _saved_values(db_context) -> dict:
+    db = next(db_context())
+    try:
+        return {(row.uploaded_file_id, row.data_item_name): row.extracted_value for row in db.query(ScannedData).all()}
+    finally:
+        db.close()
+
+
+def test_second_scan_hits_cache_without_calling_backend(scan_target, make_engine, db_context):
+    _, condition_id, file_ids = scan_target
+    engine = make_engine()
+
+    first = asyncio.run(engine.run_batch(file_ids, condition_id))
+    assert all(outcome.succeeded and not outcome.from_cache for outcome in first.outcomes)
+    assert engine.backend.call_count == len(file_ids)
+    assert engine.result_cache.misses == len(file_ids)
+    values = _saved_values(db_context)
+
+    second = asyncio.run(engine.run_batch(file_ids, condition_id))
+    assert all(outcome.succeeded and outcome.from_cache for outcome in second.outcomes)
+    assert engine.backend.call_count == len(file_ids)
+    assert engine.result_cache.hits == len(file_ids)
+    assert _saved_values(db_context) == values
+
+
+def test_changing_preprocess_settings_misses_cache(scan_target, make_engine):
+    _, condition_id, file_ids = scan_target
+    engine = make_engine()
+    asyncio.run(engine.run_batch(file_ids, condition_id))
+
+    # 送信する画像が変わる設定では、以前の抽出結果を使わない
+    engine.apply_settings(replace(engine.settings, preprocess=PreprocessOptions(grayscale=True)))
+    summary = asyncio.run(engine.run_batch(file_ids, condition_id))
+    assert not any(outcome.from_cache for outcome in summary.outcomes)
+    assert engine.backend.call_count == 2 * len(file_ids)
+
+
+def test_apply_settings_keeps_fake_backend_state(make_engine):
+    engine = make_engine()
+    backend = engine.backend
+    engine.apply_settings(replace(engine.settings, max_concurrency=4))
+    assert engine.backend is backend
+    engine.apply_settings(replace(engine.settings, model_name="another-model"))
+    assert engine.backend is not backend
+
+
+def test_fake_backend_is_deterministic_across_engines(scan_target, make_engine, db_context):
+    _, condition_id, file_ids = scan_target
+    asyncio.run(make_engine().run_batch(file_ids, condition_id))
+    first = _saved_values(db_context)
+
+    # 結果とキャッシュを消し、別のエンジンでもう一度APIを呼んでスキャンする
+    db = next(db_context())
+    try:
+        db.query(ScannedData).delete()
+        db.query(ScanResultCache).delete()
+        db.commit()
+    finally:
+        db.close()
+    engine = make_engine()
+    asyncio.run(engine.run_batch(file_ids, condition_id))
+    assert engine.backend.call_count == len(file_ids)
+    assert _saved_values(db_context) == first
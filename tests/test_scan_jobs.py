@@ -0,0 +1,99 @@
+import asyncio
+import datetime
+
+from models import ScanJob
+from ocr_backends import FakeBackendOptions
+from scan_jobs import JOB_DONE, JOB_QUEUED, JOB_RUNNING, ScanJobQueue, new_worker_id
+
+
+def _states(db_context) -> dict:
+    db = next(db_context())
+    try:
+        return {row.uploaded_file_id: (row.state, row.attempts, row.lease_owner) for row in db.query(ScanJob).all()}
+    finally:
+        db.close()
+
+
+def test_claim_is_exclusive_and_release_returns_jobs(scan_target, db_context):
+    _, condition_id, file_ids = scan_target
+    queue = ScanJobQueue(db_context=db_context)
+    batch_id = queue.enqueue(file_ids, condition_id)
+
+    worker_a, worker_b = new_worker_id(), new_worker_id()
+    claimed_a = queue.claim(worker_a, 2, batch_id)
+    claimed_b = queue.claim(worker_b, 10, batch_id)
+    assert len(claimed_a) == 2
+    assert len(claimed_b) == len(file_ids) - 2
+    assert not {job.id for job in claimed_a} & {job.id for job in claimed_b}
+    assert queue.claim(new_worker_id(), 10, batch_id) == []
+
+    # 他のワーカーのジョブは戻せない
+    queue.release(worker_b, [job.id for job in claimed_a])
+    assert all(_states(db_context)[job.uploaded_file_id][0] == JOB_RUNNING for job in claimed_a)
+
+    queue.release(worker_a, [job.id for job in claimed_a])
+    states = _states(db_context)
+    for job in claimed_a:
+        assert states[job.uploaded_file_id] == (JOB_QUEUED, 0, None)
+    assert {job.id for job in queue.claim(worker_a, 10, batch_id)} == {job.id for job in claimed_a}
+
+
+def test_expired_lease_is_taken_over(scan_target, db_context):
+    _, condition_id, file_ids = scan_target
+    queue = ScanJobQueue(db_context=db_context)
+    batch_id = queue.enqueue(file_ids[:1], condition_id)
+    crashed_worker = new_worker_id()
+    [job] = queue.claim(crashed_worker, 1, batch_id)
+
+    assert queue.claim(new_worker_id(), 1, batch_id) == []
+    db = next(db_context())
+    try:
+        db.query(ScanJob).filter(ScanJob.id == job.id).update(
+            {ScanJob.lease_expires_at: datetime.datetime.utcnow() - datetime.timedelta(seconds=1)})
+        db.commit()
+    finally:
+        db.close()
+
+    [taken_over] = queue.claim(new_worker_id(), 1, batch_id)
+    assert taken_over.id == job.id
+    assert taken_over.attempts == 2
+    # リースを失ったワーカーは完了にできない
+    queue.finish(crashed_worker, job.id)
+    assert _states(db_context)[job.uploaded_file_id][0] == JOB_RUNNING
+
+
+def test_run_jobs_resumes_unfinished_jobs(scan_target, make_engine, db_context):
+    _, condition_id, file_ids = scan_target
+    engine = make_engine()
+    engine.job_queue.enqueue(file_ids, condition_id)
+    # 前回の起動時に途中まで実行して止まったジョブ（自分で戻したもの）
+    worker_id = new_worker_id()
+    claimed = engine.job_queue.claim(worker_id, 2)
+    engine.job_queue.release(worker_id, [job.id for job in claimed])
+
+    summary = asyncio.run(engine.run_jobs())
+    assert summary.total == len(file_ids)
+    assert all(outcome.succeeded for outcome in summary.outcomes)
+    assert {state for state, _, _ in _states(db_context).values()} == {JOB_DONE}
+    assert engine.job_queue.unfinished_count() == 0
+
+
+def test_cancelled_run_returns_claimed_jobs_to_queue(scan_target, make_engine, db_context):
+    _, condition_id, file_ids = scan_target
+    engine = make_engine(fake=FakeBackendOptions(latency_median=0.3, latency_sigma=0.0), max_concurrency=1)
+    batch_id = engine.job_queue.enqueue(file_ids, condition_id)
+
+    async def run_and_cancel():
+        task = asyncio.create_task(engine.run_jobs(batch_id))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run_and_cancel())
+    states = _states(db_context)
+    assert not any(state == JOB_RUNNING for state, _, _ in states.values())
+    assert all(attempts == 0 for state, attempts, _ in states.values() if state == JOB_QUEUED)
+    assert engine.job_queue.unfinished_count(batch_id) > 0
@@ -0,0 +1,253 @@
+"""
+プレビューダイアログとファイル一覧に表示するサムネイルを、決まった大きさ(THUMBNAIL_SIZES)で作成して
+images/thumbnails/<大きさ>/ab/<キー>.jpg にキャッシュします。キーは実体(blob_store)の SHA-256 です。
+
+サムネイルはバックグラウンドのスレッドで作成します（取り込み直後に schedule、表示時に無ければ get が作成を依頼）。
+キャッシュの合計が max_bytes を超えたら、最後に使った時刻(mtime)が古いものから削除します。
+"""
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image, ImageOps
+from pdf_pages import iter_pdf_page_images
+
+APP_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+THUMBNAIL_BASE_DIR = os.path.join(APP_BASE_DIR, "images", "thumbnails")
+
+SIZE_LIST = 64 # ファイル一覧の行（40px で表示し、高DPIの画面でもぼやけない大きさ）
+SIZE_PREVIEW = 480 # プレビューダイアログ（幅 380px で表示）
+THUMBNAIL_SIZES = (SIZE_LIST, SIZE_PREVIEW)
+THUMBNAIL_FILE_TYPES = {"png", "jpg", "jpeg", "pdf"} # PDFは1ページ目
+
+DEFAULT_MAX_CACHE_BYTES = 256 * 1024 * 1024
+EVICT_TARGET_RATIO = 0.9 # 上限を超えたら、合計がこの割合になるまで削除する（毎回の削除を避ける）
+TOUCH_INTERVAL_SECONDS = 60 # 使った時刻(mtime)の更新をこの間隔より細かく行わない
+THUMBNAIL_WORKERS = 1 # スキャン・取り込みのCPUを奪わないよう1枚ずつ作成する
+JPEG_QUALITY = 80
+PDF_THUMBNAIL_DPI = 72 # A4で約 600x840px。SIZE_PREVIEW に縮小するのに十分な解像度
+
+
+def thumbnail_key(file_obj) -> str:
+    """サムネイルのキーです。実体の SHA-256 を使い、移行前のファイルはパスから求めます。"""
+    if file_obj.blob_sha256:
+        return file_obj.blob_sha256
+    return "path-" + hashlib.sha256(file_obj.filepath.encode("utf-8")).hexdigest()
+
+
+def _load_source_image(source_path: str, filetype: str, max_size: int) -> Image.Image:
+    """元画像（PDFは1ページ目）を縮小前の RGB/L 画像として読み込みます。ファイルは閉じてから返します。"""
+    if filetype == "pdf":
+        pages = iter_pdf_page_images(source_path, dpi=PDF_THUMBNAIL_DPI)
+        try:
+            _, png_bytes = next(pages)
+        finally:
+            pages.close()
+        source = Image.open(io.BytesIO(png_bytes))
+    else:
+        source = Image.open(source_path)
+        # JPEG は縮小した解像度で直接デコードし、大きな写真でも全画素を展開しない
+        source.draft("RGB", (max_size, max_size))
+    with source:
+        image = ImageOps.exif_transpose(source) # 回転が不要でも複製を返すため、以降は source を閉じてよい
+        if image.mode not in ("RGB", "L"):
+            # JPEGはアルファチャンネルを扱えないため白背景に合成する
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            else:
+                image = image.convert("RGB")
+        image.load()
+    return image
+
+
+def render_thumbnails(source_path: str, filetype: str, destinations: dict[int, str]) -> int:
+    """
+    元画像を一度だけデコードし、{大きさ: 保存先} のすべてのサムネイルを大きい順に作成します。書き込んだバイト数を返します。
+    書き込み途中のファイルを表示しないよう、一時ファイルに書いてから置き換えます。
+    """
+    written = 0
+    image = _load_source_image(source_path, filetype, max(destinations))
+    for size in sorted(destinations, reverse=True):
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        destination = destinations[size]
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        temp_path = f"{destination}.{threading.get_ident()}.tmp"
+        image.save(temp_path, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        os.replace(temp_path, destination)
+        written += os.path.getsize(destination)
+    return written
+
+
+class ThumbnailStats:
+    """キャッシュの当たり・作成・削除の件数です。"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.failed = 0
+        self.evicted = 0
+        self.generate_seconds = 0.0
+
+    def summary_text(self, total_bytes: int | None = None, max_bytes: int | None = None) -> str:
+        requests = self.hits + self.misses
+        text = f"サムネイル: 作成 {self.generated} 件"
+        if self.generated:
+            text += f" (平均 {self.generate_seconds / self.generated * 1000:.0f}ms)"
+        if self.failed:
+            text += f" | 失敗 {self.failed} 件"
+        if requests:
+            text += f" | キャッシュ命中 {self.hits}/{requests} ({self.hits / requests:.0%})"
+        if total_bytes is not None:
+            text += f" | {total_bytes / 1024 / 1024:.1f}MB"
+            if max_bytes:
+                text += f" / {max_bytes / 1024 / 1024:.0f}MB"
+        if self.evicted:
+            text += f" | 削除 {self.evicted} 件"
+        return text
+
+
+class ThumbnailCache:
+    """
+    サムネイルのディスクキャッシュと、作成を行うバックグラウンドのスレッドです。
+    on_ready(パス または None) は作成したスレッドから呼ばれるため、画面側は control.page を確認してから更新します。
+    """
+
+    def __init__(self, base_dir: str = THUMBNAIL_BASE_DIR, max_bytes: int = DEFAULT_MAX_CACHE_BYTES,
+                 workers: int = THUMBNAIL_WORKERS):
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.stats = ThumbnailStats()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._in_flight = {} # キー -> Future
+        self._total_bytes = None # 最初の作成時にディレクトリを走査して求める
+
+    def path_for(self, key: str, size: int) -> str:
+        return os.path.join(self.base_dir, str(size), key[:2], f"{key}.jpg")
+
+    def _submit(self, key: str, source_path: str, filetype: str) -> Future:
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix="thumbnail")
+                future = self._executor.submit(self._generate, key, source_path, filetype)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda _, key=key: self._forget(key))
+            return future
+
+    def _forget(self, key: str):
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def schedule(self, items: list[tuple[str, str, str]]):
+        """(キー, 元ファイルのパス, 種類) のサムネイルをバックグラウンドで作成します。作成済みのものは何もしません。"""
+        for key, source_path, filetype in items:
+            if filetype in THUMBNAIL_FILE_TYPES:
+                self._submit(key, source_path, filetype)
+
+    def get(self, key: str, source_path: str, filetype: str, size: int, on_ready=None) -> str | None:
+        """
+        キャッシュ済みのサムネイルのパスを返します。無ければ作成を依頼して None を返し、作成後に on_ready を呼びます。
+        対応していない種類のファイルは None を返し、on_ready は呼びません。
+        """
+        if filetype not in THUMBNAIL_FILE_TYPES:
+            return None
+        path = self.path_for(key, size)
+        try:
+            modified_at = os.path.getmtime(path)
+        except OSError:
+            modified_at = None
+        if modified_at is not None:
+            self.stats.hits += 1
+            if time.time() - modified_at > TOUCH_INTERVAL_SECONDS:
+                self._touch(path)
+            return path
+        self.stats.misses += 1
+        future = self._submit(key, source_path, filetype)
+        if on_ready is not None:
+            future.add_done_callback(
+                lambda done: on_ready(path if done.exception() is None and os.path.exists(path) else None))
+        return None
+
+    def _touch(self, path: str):
+        try:
+            os.utime(path)
+        except OSError:
+            pass # 削除された直後なら次の表示で作り直す
+
+    def _generate(self, key: str, source_path: str, filetype: str):
+        destinations = {size: self.path_for(key, size) for size in THUMBNAIL_SIZES}
+        missing = {size: path for size, path in destinations.items() if not os.path.exists(path)}
+        if not missing:
+            return
+        started_at = time.monotonic()
+        try:
+            written = render_thumbnails(source_path, filetype, missing)
+        except Exception as e:
+            self.stats.failed += 1
+            print(f"サムネイルを作成できませんでした ({source_path}): {e}")
+            raise
+        self.stats.generated += 1
+        self.stats.generate_seconds += time.monotonic() - started_at
+        self._add_bytes(written)
+
+    def _cached_files(self) -> list[tuple[float, int, str]]:
+        files = []
+        for directory, _, filenames in os.walk(self.base_dir):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._cached_files())
+            return self._total_bytes
+
+    def _add_bytes(self, written: int):
+        self.total_bytes()
+        with self._lock:
+            self._total_bytes += written
+            over_limit = self._total_bytes > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def evict(self) -> int:
+        """使った時刻が古いものから、合計が上限の EVICT_TARGET_RATIO になるまで削除します。削除した件数を返します。"""
+        files = sorted(self._cached_files())
+        total = sum(size for _, size, _ in files)
+        target = int(self.max_bytes * EVICT_TARGET_RATIO)
+        removed = 0
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with self._lock:
+            self._total_bytes = total
+        self.stats.evicted += removed
+        return removed
+
+    def summary_text(self) -> str:
+        return self.stats.summary_text(self.total_bytes(), self.max_bytes)
+
+
+# プレビュー・ファイル一覧・取り込みで共有するキャッシュ
+thumbnail_cache = ThumbnailCache()
@@ -0,0 +1,248 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import time
+import uuid
+from dataclasses import dataclass, field
+from scan_calls import percentile
+
+DEFAULT_TRACE_HISTORY = 200 # 保持する直近のトレース（スキャン）の件数
+TRACE_FORMAT_CHROME = "chrome" # chrome://tracing / Perfetto で開ける trace-event 形式
+TRACE_FORMAT_OTLP = "otlp" # OpenTelemetry Collector の otlpjsonfile などで読める OTLP/JSON 形式
+TRACE_FORMATS = [TRACE_FORMAT_CHROME, TRACE_FORMAT_OTLP]
+SERVICE_NAME = "flet-ocr-app"
+LOOP_LAG_INTERVAL_SECONDS = 0.01 # イベントループの遅延を測るための待機間隔
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+@dataclass
+class Span:
+    trace_id: str # 32桁の16進数
+    span_id: str # 16桁の16進数
+    parent_id: str | None
+    name: str
+    start_ns: int # UNIX時刻(ナノ秒)
+    end_ns: int = 0
+    attributes: dict = field(default_factory=dict)
+
+    @property
+    def duration_seconds(self) -> float:
+        return max(0, self.end_ns - self.start_ns) / 1e9
+
+
+@dataclass
+class Trace:
+    """1回のスキャン（ルートスパン）とその中のスパンです。"""
+    trace_id: str
+    spans: list[Span] = field(default_factory=list)
+    finished: bool = False
+
+    @property
+    def root(self) -> Span | None:
+        return self.spans[0] if self.spans else None
+
+
+@dataclass
+class StageTiming:
+    stage: str
+    count: int
+    total_seconds: float
+    p50_seconds: float
+    p95_seconds: float
+    max_seconds: float
+
+
+class Tracer:
+    """
+    スキャン処理の各段階（ファイル読み込み・前処理・API呼び出し・解析・DB書き込みなど）の所要時間をスパンとして記録します。
+    親子関係は contextvars で受け渡すため、asyncio の並行ワーカーごとに独立したトレースになります。
+    直近 history 件のトレースだけをメモリに保持し、段階ごとの百分位数の集計とファイルへの書き出しに使います。
+    """
+
+    def __init__(self, history: int = DEFAULT_TRACE_HISTORY, enabled: bool = True):
+        self.enabled = enabled
+        self.traces = collections.deque(maxlen=max(1, history))
+        self._open_traces = {}
+
+    def set_history(self, history: int):
+        if history != self.traces.maxlen:
+            self.traces = collections.deque(self.traces, maxlen=max(1, history))
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """
+        with tracer.span("段階名", 属性=値): の形で処理を囲みます。
+        実行中のスパンがなければ新しいトレース（ルートスパン）を開始します。
+        """
+        if not self.enabled:
+            yield None
+            return
+        parent = _current_span.get()
+        trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        span = Span(trace_id, uuid.uuid4().hex[:16], parent.span_id if parent else None, name, time.time_ns(), attributes=attributes)
+        if parent is None:
+            trace = Trace(trace_id)
+            self._open_traces[trace_id] = trace
+            self.traces.append(trace)
+        trace = self._open_traces.get(trace_id)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.attributes["error"] = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_ns = time.time_ns()
+            if trace is not None and parent is not None:
+                trace.spans.append(span)
+            elif trace is not None:
+                trace.spans.insert(0, span) # ルートスパンは先頭に置く
+                trace.finished = True
+                self._open_traces.pop(trace_id, None)
+
+    def traced(self, name: str, coroutine_factory, **attributes):
+        """coroutine_factory() の実行をスパンで囲む非同期関数を返します（throttle.call の再試行ごとの記録用）。"""
+        async def run():
+            with self.span(name, **attributes):
+                return await coroutine_factory()
+        return run
+
+    def finished_traces(self) -> list[Trace]:
+        return [trace for trace in list(self.traces) if trace.finished]
+
+    # --- 集計 ---
+
+    def stage_timings(self) -> list[StageTiming]:
+        """直近のトレースの段階（スパン名）ごとの回数・合計・p50/p95/最大を、合計時間の大きい順に返します。"""
+        durations = {}
+        for trace in self.finished_traces():
+            for span in trace.spans:
+                durations.setdefault(span.name, []).append(span.duration_seconds)
+        timings = []
+        for name, values in durations.items():
+            values.sort()
+            timings.append(StageTiming(name, len(values), sum(values), percentile(values, 0.50), percentile(values, 0.95), values[-1]))
+        return sorted(timings, key=lambda t: t.total_seconds, reverse=True)
+
+    def summary_text(self) -> str:
+        traces = self.finished_traces()
+        if not traces:
+            return "トレース: 記録なし"
+        stages = " | ".join(f"{t.stage} p50 {t.p50_seconds:.3f}秒 / p95 {t.p95_seconds:.3f}秒" for t in self.stage_timings()[:4])
+        return f"トレース: 直近 {len(traces)} 件 | {stages}"
+
+    # --- 書き出し ---
+
+    def export(self, path: str, trace_format: str = TRACE_FORMAT_CHROME) -> int:
+        """保持しているトレースを path に書き出し、スパンの件数を返します。"""
+        traces = self.finished_traces()
+        if trace_format == TRACE_FORMAT_OTLP:
+            document = self._to_otlp(traces)
+        else:
+            document = self._to_chrome(traces)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(document, f, ensure_ascii=False)
+        return sum(len(trace.spans) for trace in traces)
+
+    @staticmethod
+    def _to_chrome(traces: list[Trace]) -> dict:
+        # 並行して実行されたスキャンが重ならないよう、トレースごとに別の行(tid)に並べる
+        events = []
+        for lane, trace in enumerate(traces, start=1):
+            root = trace.root
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": lane,
+                           "args": {"name": f"{root.name} {root.attributes.get('file_id', '')}".strip()}})
+            for span in trace.spans:
+                events.append({
+                    "name": span.name, "cat": "scan", "ph": "X", "pid": 1, "tid": lane,
+                    "ts": span.start_ns / 1000, "dur": max(0, span.end_ns - span.start_ns) / 1000,
+                    "args": dict(span.attributes),
+                })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    @staticmethod
+    def _to_otlp(traces: list[Trace]) -> dict:
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            if isinstance(value, float):
+                return {"key": key, "value": {"doubleValue": value}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        spans = []
+        for trace in traces:
+            for span in trace.spans:
+                otlp_span = {
+                    "traceId": span.trace_id,
+                    "spanId": span.span_id,
+                    "name": span.name,
+                    "kind": 1, # SPAN_KIND_INTERNAL
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns),
+                    "attributes": [attribute(key, value) for key, value in span.attributes.items()],
+                    "status": {"code": 2 if "error" in span.attributes else 1},
+                }
+                if span.parent_id:
+                    otlp_span["parentSpanId"] = span.parent_id
+                spans.append(otlp_span)
+        return {"resourceSpans": [{
+            "resource": {"attributes": [attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "scan_engine"}, "spans": spans}],
+        }]}
+
+
+@dataclass
+class LoopLag:
+    samples: int
+    p50_seconds: float
+    p95_seconds: float
+    max_seconds: float
+
+    def summary_text(self) -> str:
+        return (
+            f"イベントループの遅延: p50 {self.p50_seconds * 1000:.1f}ms / p95 {self.p95_seconds * 1000:.1f}ms"
+            f" / 最大 {self.max_seconds * 1000:.1f}ms ({self.samples} 回計測)"
+        )
+
+
+class LoopLagMonitor:
+    """
+    interval 秒ごとに asyncio.sleep し、予定より遅れて再開した時間をイベントループの遅延として記録します。
+    同期的なファイル・DB処理がループ上で実行されていると遅延が大きくなり、画面の操作が固まって見えます。
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_SECONDS):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> LoopLag:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        return self.result()
+
+    async def _run(self):
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.monotonic() - started_at - self.interval))
+
+    def result(self) -> LoopLag:
+        values = sorted(self.lags)
+        return LoopLag(len(values), percentile(values, 0.50), percentile(values, 0.95), values[-1] if values else 0.0)
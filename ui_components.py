@@ -4,6 +4,7 @@ from ocr_list import OcrListScreen
 from file_manager import FileManagerScreen
 from scan import ScanScreen
 from export import ExportScreen
+from usage_report import UsageReportScreen
 
 class AIOCRAppUI:
     def __init__(self, page: ft.Page):
@@ -19,6 +20,7 @@ class AIOCRAppUI:
         self.file_manager_screen = FileManagerScreen(self.page)
         self.scan_screen = ScanScreen(self.page)
         self.export_screen = ExportScreen(self.page)
+        self.usage_report_screen = UsageReportScreen(self.page)
 
         # ★★★★★★★★★★★★★★★★★★★★★★★★★★★★★★
         # 修正点①：ビュー辞書にはUI部品そのものではなく、「画面クラスのインスタンス」を格納する
@@ -28,7 +30,8 @@ class AIOCRAppUI:
             "ocr_list": self.ocr_list_screen,
             "file_manager": self.file_manager_screen,
             "scan": self.scan_screen,
-            "export": self.export_screen
+            "export": self.export_screen,
+            "usage_report": self.usage_report_screen
         }
         
         self.create_ui()
@@ -88,6 +91,15 @@ class AIOCRAppUI:
                         leading=ft.Icon(ft.Icons.DESCRIPTION_SHARP),
                         title=ft.Text("エクスポート"),
                     ),
+                ),
+                ft.Container(
+                    border_radius=ft.border_radius.all(10),
+                    ink=True,
+                    on_click=lambda e: self.change_view("usage_report"),
+                    content=ft.ListTile(
+                        leading=ft.Icon(ft.Icons.INSIGHTS),
+                        title=ft.Text("API利用状況"),
+                    ),
                 )
             ], spacing=5)
         )
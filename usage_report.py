@@ -0,0 +1,96 @@
+import flet as ft
+from models import get_db
+from scan_calls import ScanCallRecorder, ROLLUP_BY_LIST, ROLLUP_BY_CONDITION, ROLLUP_BY_DAY
+
+PERIOD_OPTIONS = [7, 30, 90]
+DEFAULT_PERIOD_DAYS = 30
+
+
+class UsageReportScreen:
+    """scan_calls に記録したAPI呼び出しを、リスト・条件・日付ごとに集計して表示する画面です。"""
+
+    def __init__(self, page: ft.Page):
+        self.page = page
+        self.db_context = get_db
+        self.recorder = ScanCallRecorder(db_context=self.db_context)
+
+        # --- UIコントロール ---
+        self.group_dropdown = ft.Dropdown(
+            label="集計単位",
+            options=[
+                ft.dropdown.Option(ROLLUP_BY_LIST, "OCRリスト別"),
+                ft.dropdown.Option(ROLLUP_BY_CONDITION, "条件別"),
+                ft.dropdown.Option(ROLLUP_BY_DAY, "日別"),
+            ],
+            value=ROLLUP_BY_LIST,
+            on_change=lambda e: self.refresh(),
+            width=200,
+        )
+        self.period_dropdown = ft.Dropdown(
+            label="期間",
+            options=[ft.dropdown.Option(str(days), f"直近 {days} 日") for days in PERIOD_OPTIONS],
+            value=str(DEFAULT_PERIOD_DAYS),
+            on_change=lambda e: self.refresh(),
+            width=160,
+        )
+        self.totals_text = ft.Text("", size=14)
+        self.rollup_table = ft.DataTable(
+            columns=[
+                ft.DataColumn(ft.Text("名前")),
+                ft.DataColumn(ft.Text("呼び出し"), numeric=True),
+                ft.DataColumn(ft.Text("ファイル"), numeric=True),
+                ft.DataColumn(ft.Text("失敗"), numeric=True),
+                ft.DataColumn(ft.Text("再試行"), numeric=True),
+                ft.DataColumn(ft.Text("入力トークン"), numeric=True),
+                ft.DataColumn(ft.Text("出力トークン"), numeric=True),
+                ft.DataColumn(ft.Text("送信量(MB)"), numeric=True),
+                ft.DataColumn(ft.Text("p50(秒)"), numeric=True),
+                ft.DataColumn(ft.Text("p95(秒)"), numeric=True),
+                ft.DataColumn(ft.Text("費用(USD)"), numeric=True),
+                ft.DataColumn(ft.Text("1,000ファイルあたり"), numeric=True),
+            ],
+            rows=[],
+        )
+
+    def refresh(self):
+        """画面が表示されたとき・集計単位や期間を変えたときに集計し直します。"""
+        days = int(self.period_dropdown.value or DEFAULT_PERIOD_DAYS)
+        totals = self.recorder.totals(days)
+        self.totals_text.value = totals.summary_text() if totals.calls else "この期間のAPI呼び出しの記録はありません。"
+        self.rollup_table.rows = [
+            ft.DataRow(cells=[
+                ft.DataCell(ft.Text(rollup.label)),
+                ft.DataCell(ft.Text(f"{rollup.calls:,}")),
+                ft.DataCell(ft.Text(f"{rollup.files:,}")),
+                ft.DataCell(ft.Text(f"{rollup.failures:,}")),
+                ft.DataCell(ft.Text(f"{rollup.retries:,}")),
+                ft.DataCell(ft.Text(f"{rollup.prompt_tokens:,}")),
+                ft.DataCell(ft.Text(f"{rollup.candidates_tokens:,}")),
+                ft.DataCell(ft.Text(f"{rollup.bytes_sent / 1024 / 1024:.1f}")),
+                ft.DataCell(ft.Text(f"{rollup.p50_latency_seconds:.2f}")),
+                ft.DataCell(ft.Text(f"{rollup.p95_latency_seconds:.2f}")),
+                ft.DataCell(ft.Text(f"{rollup.cost_usd:.4f}")),
+                ft.DataCell(ft.Text(f"{rollup.cost_per_1000_files:.4f}")),
+            ])
+            for rollup in self.recorder.rollup(self.group_dropdown.value, days)
+        ]
+        for control in (self.totals_text, self.rollup_table):
+            if control.page: control.update()
+
+    def build_content(self) -> ft.Column:
+        return ft.Column(
+            expand=True,
+            scroll=ft.ScrollMode.AUTO,
+            spacing=15,
+            controls=[
+                ft.Text("API利用状況", size=24, weight=ft.FontWeight.BOLD),
+                ft.Row([
+                    self.group_dropdown,
+                    self.period_dropdown,
+                    ft.IconButton(icon=ft.Icons.REFRESH, tooltip="再集計", on_click=lambda e: self.refresh()),
+                ], spacing=10, vertical_alignment=ft.CrossAxisAlignment.CENTER),
+                self.totals_text,
+                ft.Text("費用はモデルごとの公表単価から見積もった概算です。", size=12, color=ft.Colors.BLACK54),
+                ft.Row([self.rollup_table], scroll=ft.ScrollMode.AUTO),
+            ]
+        )